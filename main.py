@@ -1,11 +1,18 @@
 import os
 import json
 
-from src.utils import load_video, load_calibration_data, get_D_and_K_from_calibration, get_last_frame, get_X_frames
-from src.april_tag import detect_april_tag_in_frame
+import numpy as np
+
+from src.utils import load_calibration_data, get_D_and_K_from_calibration
+from src.pipeline import detect_tags_in_video
+from src.april_tag import AprilTagDetector
+from src.tracking import TagTracker
+from src.stream import detect_live
+from src.detection_store import DetectionStore, get_detection_cache_path
 from src.tag_graph import TagGraph
-from src.geometry import calculate_tag_corners, get_center_from_corners
-from src.visualization import plot_tags, plot_tags_2d
+from src.geometry import make_tag_data, get_center_from_corners, get_camera_positions
+from src.mapping import map_tags
+from src import instrumentation
 
 def main():
     
@@ -13,75 +20,185 @@ def main():
     tag_size            = 0.042 # meter
     video_path          = "data/plantage_shed.mp4"
     calibration_path    = "data/cam.json"
+    live_source         = None # camera index, stream URL or a video played at real time, mapped while it is captured
+    live_buffer         = 2 # frames waiting for the detector in live mode, small keeps the latency low
+    drop_policy         = "drop_oldest" # live mode with a full buffer: "drop_oldest", "drop_newest" or "block"
     output_file         = "tag_positions.json"
+    cache_dir           = ".detection_cache" # detections are reused when video, calibration and detector match
     test_tags           = [2,39]
+    frame_stride        = 1 # use every n-th frame
+    prefetch_frames     = 8 # number of frames decoded ahead in the background
+    detection_workers   = os.cpu_count() # worker processes running decode and detection
+    detector_threads    = None # threads inside each AprilTag detector, None to share the cores between workers
+    frame_transport     = "chunks" # "shared_memory": decode once, workers detect on gray frames in shared memory (needs track_tags off)
+    quad_decimate       = 2.0 # detect quads on a downscaled image, trades recall for speed
+    refine_corners      = False # refine the corners on the full resolution frame, keeps accuracy with a large quad_decimate
+    undistort_mode      = "image" # undistort full frames, "remap" the same with cached maps, "points" only the tag corners (faster)
+    track_tags          = False # search only around the tags of the previous frames instead of every full frame
+    redetect_interval   = 10 # search the full frame every n-th frame to find new tags
+    skip_redundant      = False # drop near-duplicate and motion-blurred frames before detection
+    min_frame_change    = 6.0 # mean gray level change to the last used frame a frame needs to be used
+    fuse_edges          = False # average every co-observation of a tag pair instead of using its best frame
+    optimize_map        = False # refine all tag poses with bundle adjustment over every detection
+    online_mapping      = False # update the map after every frame instead of once at the end
+    max_pose_updates    = 200 # tag poses recomputed per frame in online mapping, bounds the latency
+    instrument          = False # record timers, counters and histograms of every stage
+    metrics_file        = "metrics.json" # summary of the records
+    trace_file          = "trace.json" # records as Chrome trace, open in chrome://tracing or ui.perfetto.dev
+    headless            = os.environ.get("HEADLESS", "").lower() in ("1", "true", "yes") # no plot at the end and no plotting imports, for runs without display
+    plot_camera_path    = True # draw the camera trajectory over the tags
     
-    detected_tags       = []
+    if instrument:
+        instrumentation.enable()
     
     ## Load data
-    video               = load_video(video_path)
-    print(f".. loaded video from {video_path}")
     calibration_data    = load_calibration_data(calibration_path)
     K, D, fx, fy, cx, cy = get_D_and_K_from_calibration(calibration_data) 
     print(f".. loaded calibration data from {calibration_path}")
     # print(f"Calibration Data: \n{calibration_data}")
     # print(f"K: {K}\nD: {D}")
     
-    ## Open video and detect tags
-    print(f".. reading tags from video")
-    # Select only a subset of frames from the video for effiency
-    # TODO: make faster and use all frames
-    frames = []
-    ret, first_frame = video.read()
-    frames.append(first_frame)
-    last_frame = get_last_frame(video_path)
-    frames.append(last_frame)
-    for frame in get_X_frames(video_path=video_path, number_of_frames=3):
-        frames.append(frame) #TODO: don't; also why doesn't it work with even numbers?
-        
-    # Detect April tags in the selected subset of frames
-    for frame in frames:
-        detected_tags.append(detect_april_tag_in_frame(frame=frame, 
-                                                tag_standard="tagStandard52h13",
-                                                K=K, D=D, fx=fx, fy=fy, cx=cx, cy=cy,
-                                                tag_size=tag_size))
+    # Every worker creates its detector once, building it allocates the large tag family tables
+    detector_settings = dict(tag_standard="tagStandard52h13",
+                             K=K, D=D, fx=fx, fy=fy, cx=cx, cy=cy,
+                             tag_size=tag_size,
+                             nthreads=detector_threads,
+                             quad_decimate=quad_decimate,
+                             refine_corners=refine_corners,
+                             undistort_mode=undistort_mode)
+    tracking = dict(redetect_interval=redetect_interval) if track_tags else None
+    selection = dict(min_change=min_frame_change) if skip_redundant else None
+    
+    # Initialize the graph, in online mode it keeps the map up to date after every frame
+    tag_graph = TagGraph(origin_tag=origin_tag if online_mapping else None,
+                         max_pose_updates=max_pose_updates)
+    
+    ## Open video and detect tags, unless the detections are cached already
+    cache_path = None
+    if live_source is None:
+        cache_path = get_detection_cache_path(cache_dir=cache_dir,
+                                              video_path=video_path,
+                                              calibration_data=calibration_data,
+                                              detector_settings=detector_settings,
+                                              stride=frame_stride,
+                                              tracking=tracking,
+                                              selection=selection)
+    if live_source is not None:
+        ## Live source, frames are detected as they come in and dropped when the detector falls behind
+        detected_tags = DetectionStore()
+        detector = AprilTagDetector(**detector_settings)
+        if tracking is not None:
+            detector = TagTracker(detector, **tracking)
+        print(f".. reading tags from live source {live_source}, stop with Ctrl+C")
+        latencies = []
+        try:
+            for frame_index, tag_collection, latency in detect_live(source=live_source,
+                                                                     detector=detector,
+                                                                     buffer_size=live_buffer,
+                                                                     policy=drop_policy):
+                detected_tags.add_frame(frame_index=frame_index,
+                                        detected_tags=tag_collection)
+                tag_graph.add_frame(detected_tags=tag_collection,
+                                    frame_index=frame_index)
+                latencies.append(latency * 1000)
+        except KeyboardInterrupt:
+            pass
+        if latencies:
+            print(f".. {len(latencies)} frames, capture to pose latency p50 {np.percentile(latencies, 50):.1f}ms, "
+                  f"p95 {np.percentile(latencies, 95):.1f}ms, max {np.max(latencies):.1f}ms")
+    elif os.path.exists(cache_path):
+        detected_tags = DetectionStore.load(cache_path)
+        print(f".. loaded {len(detected_tags)} cached detections from {cache_path}")
+        # Add new nodes for every frame
+        for frame_index, tag_collection in detected_tags.frames():
+            tag_graph.add_frame(detected_tags=tag_collection, 
+                                frame_index=frame_index)
+    else:
+        detected_tags = DetectionStore()
+        print(f".. reading tags from video {video_path} with {detection_workers} workers")
+        # Frames are decoded and detected in chunks by the workers, results arrive in frame order
+        for frame_index, tag_collection in detect_tags_in_video(video_path=video_path, 
+                                                                detector_settings=detector_settings,
+                                                                workers=detection_workers,
+                                                                stride=frame_stride,
+                                                                prefetch=prefetch_frames,
+                                                                tracking=tracking,
+                                                                selection=selection,
+                                                                transport=frame_transport):
+            detected_tags.add_frame(frame_index=frame_index, 
+                                    detected_tags=tag_collection)
+            # Add new nodes for every frame
+            tag_graph.add_frame(detected_tags=tag_collection, 
+                                frame_index=frame_index)
+        detected_tags.save(cache_path)
+        print(f".. cached detections in {cache_path}")
 
-    ## Create a graph and find shortest path to origin tag
     print(f".. calculate tag positions")
+    if online_mapping:
+        ## The map was updated with every frame already
+        tag_ids, transforms = tag_graph.get_tag_transforms()
+        latency = tag_graph.get_latency_report()
+        print(f".. online map update latency: mean {latency['mean_ms']:.2f}ms, "
+              f"p95 {latency['p95_ms']:.2f}ms, max {latency['max_ms']:.2f}ms")
+    else:
+        ## Shortest path tree from the origin tag, chained with the fused edge transforms
+        tag_ids, transforms, _ = map_tags(detected_tags=detected_tags,
+                                          origin_tag=origin_tag,
+                                          tag_graph=tag_graph,
+                                          fuse_edges=fuse_edges)
     
-    # Initialize the graph
-    tag_graph = TagGraph()
-    # Add new nodes for every frame
-    for index, tag_collection in enumerate(detected_tags):
-        tag_graph.add_frame(detected_tags=tag_collection, 
-                            frame_index=index)
-
-    ## Get shotest paths from all tags to the origin tag
-    paths = tag_graph.get_paths_to_origin(origin_tag)
-    # print(paths)
+    ## Jointly refine all tag poses, starting from the shortest path solution
+    if optimize_map:
+        from src.optimization import optimize_tag_poses
+        tag_ids, transforms, report = optimize_tag_poses(detection_store=detected_tags,
+                                                         tag_ids=tag_ids,
+                                                         transforms=transforms,
+                                                         K=K,
+                                                         tag_size=tag_size)
+        if report["observations"]:
+            print(f".. optimized {len(tag_ids)} tags from {report['observations']} detections in "
+                  f"{report['iterations']} iterations, {report['time_s']:.2f}s, rms {report['final_rms']:.2f}px")
+        else:
+            print(f".. no detections of mapped tags, map not optimized")
     
-    ## Calculate position in reference to the origin tag based on shortest path
-    tag_positions = []
-    for tag_id, path in paths.items():
-        tag_positions.append(calculate_tag_corners(tag_collection=detected_tags, 
-                                                                path=path,
-                                                                tag_size_mm=tag_size*1000))
-        # if tag_id in test_tags:
-        #     center = get_center_from_corners(corners=corners)
-        #     distance = np.linalg.norm(center)
-        #     print(f"Test tag {tag_id} distance from origin tag {origin_tag}: {distance}mm")
-            
+    tag_positions = make_tag_data(tag_ids=tag_ids, 
+                                  transforms=transforms, 
+                                  tag_size_mm=tag_size*1000)
+    # for tag in tag_positions:
+    #     if tag["id"] in test_tags:
+    #         center = get_center_from_corners(corners=tag["corners"])
+    #         distance = np.linalg.norm(center)
+    #         print(f"Test tag {tag['id']} distance from origin tag {origin_tag}: {distance}mm")
         
     # Save to JSON
-    with open(output_file, 'w') as f:
-        json.dump(tag_positions, f, indent=2)
+    with instrumentation.stage("serialization"):
+        with open(output_file, 'w') as f:
+            json.dump(tag_positions, f, indent=2)
     print(f".. results saved in {output_file}")
+    
+    if instrument:
+        recorder = instrumentation.disable()
+        recorder.export_summary(metrics_file)
+        recorder.export_trace(trace_file)
+        print(f".. stage metrics saved in {metrics_file}, trace in {trace_file}")
 
+    if headless:
+        return
+    
+    # Plotly is imported only when plotting, it is slow to import and not needed headless
+    from src.visualization import plot_tags, plot_tags_2d
+    
+    camera_positions = None
+    if plot_camera_path:
+        _, camera_positions = get_camera_positions(detection_store=detected_tags,
+                                                   tag_ids=tag_ids,
+                                                   transforms=transforms)
+    
     # # Vizualize in 3D for debugging purposes
-    # fig = plot_tags(tag_data=tag_positions)
+    # fig = plot_tags(tag_data=tag_positions, camera_positions=camera_positions)
     # fig.show()
     
-    fig = plot_tags_2d(tag_data=tag_positions)
+    fig = plot_tags_2d(tag_data=tag_positions, camera_positions=camera_positions)
     fig.show()
         
 
@@ -1,28 +1,486 @@
 # src/april_tag.py
 
+import os
+from collections import namedtuple
+
 import cv2
 from pupil_apriltags import Detector
 import numpy as np
 
-def detect_april_tag_in_frame(frame, tag_standard: str, K, D, fx, fy, cx, cy, tag_size):
-    frame = cv2.cvtColor(src=frame, code=cv2.COLOR_BGR2GRAY) # we don't need color
+from src.instrumentation import stage, timed
+
+# Compact, picklable copy of a pupil_apriltags Detection (which keeps a reference to the C detection)
+TagDetection = namedtuple("TagDetection", ["tag_id", "hamming", "decision_margin", "center", "corners",
+                                           "pose_R", "pose_t", "pose_err"])
+
+def compact_detection(detection):
+    """
+    Converts a pupil_apriltags Detection into a TagDetection.
+
+    Args:
+    - detection (Detection): A detection returned by the detector.
+
+    Returns:
+    - tag (TagDetection): The same fields, with float32 corners and center.
+    """
+    return TagDetection(tag_id=int(detection.tag_id),
+                        hamming=int(detection.hamming),
+                        decision_margin=float(detection.decision_margin),
+                        center=np.asarray(detection.center, dtype=np.float32),
+                        corners=np.asarray(detection.corners, dtype=np.float32),
+                        pose_R=np.asarray(detection.pose_R, dtype=np.float64),
+                        pose_t=np.asarray(detection.pose_t, dtype=np.float64),
+                        pose_err=float(detection.pose_err))
+
+class AprilTagDetector:
+    """
+    Long-lived AprilTag detector engine.
+
+    Building a pupil_apriltags Detector allocates the lookup tables of the tag family, which is
+    expensive for large families like tagStandard52h13. Create this object once per run and use
+    it for every frame. Detectors with the same detector settings share the pupil_apriltags
+    Detector (see get_detector), so one per calibration or tag size is cheap.
+
+    Args:
+    - tag_standard (str): The tag family, e.g. "tagStandard52h13".
+    - K (numpy array): The 3x3 camera matrix.
+    - D (numpy array): The distortion coefficients.
+    - fx, fy, cx, cy (float): The camera intrinsics.
+    - tag_size (float): The size of the tag (length of a side) in meters.
+    - nthreads (int): Number of threads the C detector uses. Default is all cores.
+    - quad_decimate (float): Detect quads on an image decimated by this factor. Default is 2.0.
+    - quad_sigma (float): Gaussian blur applied to the image before quad detection. Default is 0.0.
+    - refine_edges (bool): Snap the quad edges to strong gradients. Default is True.
+    - decode_sharpening (float): Sharpening applied to the decoded tag image. Default is 0.25.
+    - undistort_mode (str): How lens distortion is removed, one of UNDISTORT_MODES. Default is "image".
+    - refine_corners (bool): Refine the corners on the full resolution image and recompute the poses
+        from them, so a large quad_decimate keeps close to full resolution accuracy. Default is False.
+    - refine_radius (float): Largest distance in pixels the tag edges are searched from the detected corners.
+        Default is 4.0.
+    """
+    def __init__(self, tag_standard: str, K, D, fx, fy, cx, cy, tag_size,
+                 nthreads=None, quad_decimate=2.0, quad_sigma=0.0, refine_edges=True, decode_sharpening=0.25,
+                 undistort_mode="image", refine_corners=False, refine_radius=4.0):
+        if undistort_mode not in UNDISTORT_MODES:
+            raise ValueError(f"Unknown undistort mode {undistort_mode}, use one of {UNDISTORT_MODES}")
+        self.tag_standard = tag_standard
+        self.K = K
+        self.D = D
+        self.fx, self.fy, self.cx, self.cy = fx, fy, cx, cy
+        self.tag_size = tag_size
+        self.nthreads = nthreads or os.cpu_count() or 1
+        self.quad_decimate = quad_decimate
+        self.quad_sigma = quad_sigma
+        self.refine_edges = refine_edges
+        self.decode_sharpening = decode_sharpening
+        self.undistort_mode = undistort_mode
+        self.refine_corners = refine_corners
+        self.refine_radius = refine_radius
+        self.detector = get_detector(tag_standard=tag_standard,
+                                     nthreads=self.nthreads,
+                                     quad_decimate=quad_decimate,
+                                     quad_sigma=quad_sigma,
+                                     refine_edges=refine_edges,
+                                     decode_sharpening=decode_sharpening)
+
+    def detect(self, frame):
+        """
+        Detects the tags in a single BGR or grayscale frame, see detect_april_tag_in_frame.
+        """
+        return detect_april_tag_in_frame(frame=frame,
+                                         tag_standard=self.tag_standard,
+                                         K=self.K, D=self.D, fx=self.fx, fy=self.fy, cx=self.cx, cy=self.cy,
+                                         tag_size=self.tag_size,
+                                         detector=self.detector,
+                                         undistort_mode=self.undistort_mode,
+                                         refine_corners=self.refine_corners,
+                                         refine_radius=self.refine_radius)
+
+    def detect_many(self, frames):
+        """
+        Detects the tags in a batch of frames with the same detector.
+
+        Args:
+        - frames (iterable): BGR or grayscale frames.
+
+        Returns:
+        - detected_tags (list of lists): The Detection objects of every frame, in order.
+        """
+        return [self.detect(frame) for frame in frames]
+
+class _Detector(Detector):
+    """
+    pupil_apriltags Detector that is destroyed in a safe order.
+
+    Detector.__del__ frees the tag families before the C detector, and destroying the C detector
+    then reads the freed families to free their decode tables. Depending on the heap layout this
+    aborts the process ("corrupted size vs. prev_size"). Detaching the families first avoids it.
+    """
+    def __del__(self):
+        if self.tag_detector_ptr is not None:
+            self.libc.apriltag_detector_clear_families.restype = None
+            self.libc.apriltag_detector_clear_families(self.tag_detector_ptr)
+        super().__del__()
+
+# (tag_standard, nthreads, quad_decimate, quad_sigma, refine_edges, decode_sharpening) -> Detector
+_detectors = {}
+
+def get_detector(tag_standard, nthreads=1, quad_decimate=2.0, quad_sigma=0.0, refine_edges=True,
+                 decode_sharpening=0.25):
+    """
+    Returns the cached pupil_apriltags Detector of this process for the given settings.
+
+    The detector doesn't depend on the camera or the tag size, those are passed per detection.
+    A Detector must not be used by several threads at once.
+    """
+    key = (tag_standard, nthreads, float(quad_decimate), float(quad_sigma), bool(refine_edges),
+           float(decode_sharpening))
+    if key not in _detectors:
+        _detectors[key] = _Detector(families=tag_standard,
+                                    nthreads=nthreads,
+                                    quad_decimate=quad_decimate,
+                                    quad_sigma=quad_sigma,
+                                    refine_edges=int(refine_edges),
+                                    decode_sharpening=decode_sharpening)
+    return _detectors[key]
+
+# How lens distortion is removed before the pose is estimated:
+# - "image": undistort every full frame with cv2.undistort and detect on the result
+# - "remap": same, with the undistortion maps computed once per resolution and cached
+# - "points": detect on the distorted frame, undistort only the tag corners and solve the pose with PnP
+UNDISTORT_MODES = ("image", "remap", "points")
+
+# (width, height, K, D) -> maps for cv2.remap
+_undistort_maps = {}
+
+def get_undistort_maps(K, D, image_size):
+    """
+    Returns the cached cv2.remap tables that undistort images of the given size.
+
+    Args:
+    - K (numpy array): The 3x3 camera matrix.
+    - D (numpy array): The distortion coefficients.
+    - image_size (tuple): (width, height) of the images.
+
+    Returns:
+    - map1, map2 (numpy arrays): Fixed point maps for cv2.remap.
+    """
+    key = (image_size, np.asarray(K, dtype=np.float64).tobytes(), np.asarray(D, dtype=np.float64).tobytes())
+    if key not in _undistort_maps:
+        _undistort_maps[key] = cv2.initUndistortRectifyMap(cameraMatrix=K,
+                                                           distCoeffs=D,
+                                                           R=None,
+                                                           newCameraMatrix=K,
+                                                           size=image_size,
+                                                           m1type=cv2.CV_16SC2)
+    return _undistort_maps[key]
+
+def get_tag_object_points(tag_size):
+    """
+    Returns the corners of a tag in its own coordinate frame, in the order the detector reports them.
+
+    Args:
+    - tag_size (float): The size of the tag (length of a side).
+
+    Returns:
+    - object_points (numpy array): 4x3 array, x to the right, y down, z into the tag.
+    """
+    half_size = tag_size / 2.0
+    return np.array([
+        [-half_size, half_size, 0],   # Bottom-left in the image
+        [half_size, half_size, 0],    # Bottom-right
+        [half_size, -half_size, 0],   # Top-right
+        [-half_size, -half_size, 0]   # Top-left
+    ])
+
+def solve_tag_pose(corners, tag_size, K):
+    """
+    Estimates the pose of a tag from its undistorted corners with a PnP solve.
+
+    Args:
+    - corners (numpy array): 4x2 corner pixel coordinates in detector order, free of lens distortion.
+    - tag_size (float): The size of the tag (length of a side) in meters.
+    - K (numpy array): The 3x3 camera matrix.
+
+    Returns:
+    - pose_R (numpy array): 3x3 rotation of the tag in the camera frame.
+    - pose_t (numpy array): 3x1 translation of the tag in the camera frame in meters.
+    - pose_err (float): Object-space error of the pose, defined like the one of pupil_apriltags.
+    """
+    object_points = get_tag_object_points(tag_size)
+    corners = np.asarray(corners, dtype=np.float64)
+    _, rvec, tvec = cv2.solvePnP(objectPoints=object_points,
+                                 imagePoints=corners,
+                                 cameraMatrix=K,
+                                 distCoeffs=None,
+                                 flags=cv2.SOLVEPNP_IPPE_SQUARE)
+    pose_R, _ = cv2.Rodrigues(rvec)
+    pose_t = tvec.reshape(3, 1)
+
+    # Sum of the squared distances of the corners in 3D to the lines of sight through the pixels
+    rays = np.column_stack([(corners[:, 0] - K[0, 2]) / K[0, 0],
+                            (corners[:, 1] - K[1, 2]) / K[1, 1],
+                            np.ones(len(corners))])
+    rays /= np.linalg.norm(rays, axis=1, keepdims=True)
+    points = object_points @ pose_R.T + pose_t.T
+    residuals = points - np.sum(points * rays, axis=1, keepdims=True) * rays
+    pose_err = float(np.sum(residuals ** 2))
+    return pose_R, pose_t, pose_err
+
+def undistort_tag_detections(detected_tags, K, D, tag_size):
+    """
+    Undistorts the corners of tags detected on a distorted frame and recomputes their poses.
+
+    Args:
+    - detected_tags (list): Detection objects found on the distorted frame.
+    - K (numpy array): The 3x3 camera matrix.
+    - D (numpy array): The distortion coefficients, None if the frame was undistorted already
+        and only the poses are needed.
+    - tag_size (float): The size of the tag (length of a side) in meters.
+
+    Returns:
+    - tags (list of TagDetection): The tags with corners and center in undistorted pixel
+        coordinates, as if detected on an undistorted frame, and the PnP pose.
+    """
+    if len(detected_tags) == 0:
+        return []
+
+    # Undistort the corners and centers of all tags in one call
+    points = np.concatenate([np.vstack([tag.corners, tag.center]) for tag in detected_tags])
+    points = points.reshape(-1, 5, 2).astype(np.float64)
+    if D is not None:
+        with stage("undistort"):
+            points = cv2.undistortPoints(src=points.reshape(-1, 1, 2),
+                                         cameraMatrix=K,
+                                         distCoeffs=D,
+                                         P=K).reshape(-1, 5, 2)
+
+    tags = []
+    with stage("pose"):
+        for tag, tag_points in zip(detected_tags, points):
+            corners = tag_points[:4]
+            pose_R, pose_t, pose_err = solve_tag_pose(corners=corners, tag_size=tag_size, K=K)
+            tags.append(TagDetection(tag_id=int(tag.tag_id),
+                                     hamming=int(tag.hamming),
+                                     decision_margin=float(tag.decision_margin),
+                                     center=tag_points[4].astype(np.float32),
+                                     corners=corners.astype(np.float32),
+                                     pose_R=pose_R,
+                                     pose_t=pose_t,
+                                     pose_err=pose_err))
+    return tags
+
+def preprocess_frame(frame, K, D, undistort_mode="image"):
+    """
+    Converts a BGR frame into the grayscale image the detector runs on.
+
+    Args:
+    - frame (numpy array): The BGR frame, or a grayscale frame which is used as is (no copy).
+    - K (numpy array): The 3x3 camera matrix.
+    - D (numpy array): The distortion coefficients.
+    - undistort_mode (str): One of UNDISTORT_MODES. Default is "image".
+
+    Returns:
+    - image (numpy array): The grayscale frame, undistorted unless the mode is "points".
+    """
+    if undistort_mode not in UNDISTORT_MODES:
+        raise ValueError(f"Unknown undistort mode {undistort_mode}, use one of {UNDISTORT_MODES}")
+
+    if frame.ndim == 3:
+        with stage("grayscale"):
+            frame = cv2.cvtColor(src=frame, code=cv2.COLOR_BGR2GRAY) # we don't need color
     # cv2.imshow("Test Image", frame)
     # cv2.waitKey(0)
     # cv2.destroyAllWindows()
-    frame_undistorted = cv2.undistort(
-                                        src=frame, 
-                                        cameraMatrix=K, 
-                                        distCoeffs=D)
-    # TODO, maybe detect tags first and then undistord the pixel coordinates afterwards? cheaper?
+    if undistort_mode == "image":
+        with stage("undistort"):
+            frame_undistorted = cv2.undistort(
+                                                src=frame,
+                                                cameraMatrix=K,
+                                                distCoeffs=D)
+    elif undistort_mode == "remap":
+        # Same result as cv2.undistort, without recomputing the maps for every frame
+        with stage("undistort"):
+            map1, map2 = get_undistort_maps(K=K, D=D, image_size=(frame.shape[1], frame.shape[0]))
+            frame_undistorted = cv2.remap(src=frame, map1=map1, map2=map2, interpolation=cv2.INTER_LINEAR)
+    else:
+        # Detect on the distorted frame, only the corners get undistorted afterwards
+        frame_undistorted = frame
     # cv2.imshow("Test Image: Undistorted", frame_undistorted)
     # cv2.waitKey(0)
     # cv2.destroyAllWindows()
+    return frame_undistorted
+
+def detect_tags_in_region(detector, image, region, fx, fy, cx, cy, tag_size, estimate_tag_pose=True,
+                          undistort_maps=None, refine_radius=None):
+    """
+    Detects the tags inside a rectangular region of a grayscale image.
+
+    The principal point is shifted by the origin of the region, so the poses are the same as
+    if the full image had been searched.
+
+    Args:
+    - detector (Detector): A pupil_apriltags detector.
+    - image (numpy array): The grayscale image, see preprocess_frame.
+    - region (tuple): (x0, y0, x1, y1) pixel bounds of the region, end exclusive.
+    - fx, fy, cx, cy (float): The camera intrinsics.
+    - tag_size (float): The size of the tag (length of a side) in meters.
+    - estimate_tag_pose (bool): Estimate the poses, otherwise they are None. Default is True.
+    - undistort_maps (tuple): The maps of get_undistort_maps for a distorted image, only the region
+        is undistorted. The pixels are those "remap" mode gives for the full image. Default is None,
+        the image is searched as it is.
+    - refine_radius (float): Refine the corners on the region with this max_radius, see
+        refine_tag_corners. Default is None, the corners of the detector are kept.
+
+    Returns:
+    - tags (list of TagDetection): The tags with corners and center in full image coordinates.
+    """
+    x0, y0, x1, y1 = region
+    if undistort_maps is None:
+        # The detector needs a contiguous buffer
+        crop = np.ascontiguousarray(image[y0:y1, x0:x1])
+    else:
+        with stage("undistort"):
+            map1, map2 = undistort_maps
+            crop = cv2.remap(src=image, map1=map1[y0:y1, x0:x1], map2=map2[y0:y1, x0:x1],
+                             interpolation=cv2.INTER_LINEAR)
+    with stage("detect"):
+        if estimate_tag_pose:
+            detected_tags = detector.detect(img=crop,
+                                            estimate_tag_pose=True,
+                                            camera_params=[fx, fy, cx - x0, cy - y0],
+                                            tag_size=tag_size)
+        else:
+            detected_tags = detector.detect(img=crop)
+    if refine_radius is not None:
+        detected_tags = refine_tag_corners(image=crop, detected_tags=detected_tags, max_radius=refine_radius)
+
+    offset = np.array([x0, y0], dtype=np.float32)
+    return [TagDetection(tag_id=int(tag.tag_id),
+                         hamming=int(tag.hamming),
+                         decision_margin=float(tag.decision_margin),
+                         center=np.asarray(tag.center, dtype=np.float32) + offset,
+                         corners=np.asarray(tag.corners, dtype=np.float32) + offset,
+                         pose_R=tag.pose_R,
+                         pose_t=tag.pose_t,
+                         pose_err=tag.pose_err)
+            for tag in detected_tags]
+
+def _sample_bilinear(image, points):
+    # Bilinear interpolation of a grayscale image at ...x2 float pixel coordinates
+    height, width = image.shape
+    x = np.clip(points[..., 0], 0, width - 1.001)
+    y = np.clip(points[..., 1], 0, height - 1.001)
+    x0 = x.astype(np.intp)
+    y0 = y.astype(np.intp)
+    fx = x - x0
+    fy = y - y0
+    top = image[y0, x0] * (1 - fx) + image[y0, x0 + 1] * fx
+    bottom = image[y0 + 1, x0] * (1 - fx) + image[y0 + 1, x0 + 1] * fx
+    return top * (1 - fy) + bottom * fy
+
+@timed("refine corners")
+def refine_tag_corners(image, detected_tags, max_radius=4.0, samples_per_edge=16):
+    """
+    Refines the corners of detected tags on the full resolution image.
+
+    Corners found on a decimated image are off by up to the decimation factor. Every side of the
+    black tag border is searched along its normal for the intensity edge, with sub-pixel accuracy
+    from the gradient-weighted mean position. A line is fitted to the edge points of every side
+    and the corners are the intersections of neighboring lines. The search stays within half a
+    border cell, so the data bits of the tag don't disturb it. All tags are refined at once.
+
+    Args:
+    - image (numpy array): The grayscale image the tags were detected on, at full resolution.
+    - detected_tags (list): Detection or TagDetection objects.
+    - max_radius (float): Largest distance in pixels the edges are searched from the detected
+        corners. Default is 4.0.
+    - samples_per_edge (int): Number of points searched along every side. Default is 16.
+
+    Returns:
+    - tags (list of TagDetection): The tags with refined corners and without poses.
+    """
+    if len(detected_tags) == 0:
+        return []
+
+    corners = np.stack([np.asarray(tag.corners, dtype=np.float64) for tag in detected_tags])
+    # Side k runs from corner k to corner k + 1
+    directions = np.roll(corners, -1, axis=1) - corners
+    lengths = np.linalg.norm(directions, axis=2, keepdims=True)
+    units = directions / np.maximum(lengths, 1e-9)
+    normals = np.stack([-units[..., 1], units[..., 0]], axis=-1)
+    # The cells along the border are an eighth (tag36h11) to a sixth (tagStandard52h13) of the side
+    radii = np.clip(lengths.min(axis=(1, 2)) / 16, 0.5, max_radius)
+
+    fractions = np.linspace(0.15, 0.85, samples_per_edge)
+    steps = np.linspace(-1.0, 1.0, 17)
+    offsets = radii[:, None, None, None] * steps  # tags x 1 x 1 x steps
+    edge_points = corners[:, :, None, :] + fractions[None, None, :, None] * directions[:, :, None, :]
+    search_points = edge_points[:, :, :, None, :] + offsets[..., None] * normals[:, :, None, None, :]
+    profiles = _sample_bilinear(np.asarray(image, dtype=np.float32), search_points)
+
+    # Gradient-weighted mean position of the edge along every search line
+    weights = np.abs(np.diff(profiles, axis=3))
+    midpoints = (offsets[..., 1:] + offsets[..., :-1]) / 2
+    weight_sums = weights.sum(axis=3)
+    edge_offsets = np.where(weight_sums > 0,
+                            (weights * midpoints).sum(axis=3) / np.maximum(weight_sums, 1e-9),
+                            0.0)
+    edge_points = edge_points + edge_offsets[..., None] * normals[:, :, None, :]
+
+    # Fit a line to the edge points of every side
+    centroids = edge_points.mean(axis=2)
+    _, _, vt = np.linalg.svd(edge_points - centroids[:, :, None, :])
+    line_directions = vt[:, :, 0, :]
+
+    # Corner k is where side k - 1 meets side k
+    previous_centroids = np.roll(centroids, 1, axis=1)
+    previous_directions = np.roll(line_directions, 1, axis=1)
+    matrices = np.stack([previous_directions, -line_directions], axis=-1)
+    determinants = np.linalg.det(matrices)
+    valid = np.abs(determinants) > 1e-6
+    matrices[~valid] = np.eye(2)
+    parameters = np.linalg.solve(matrices, (centroids - previous_centroids)[..., None])[..., 0]
+    refined = previous_centroids + parameters[..., :1] * previous_directions
+    # Keep the detected corner where the lines are parallel or the corner moved implausibly far
+    moved = np.linalg.norm(refined - corners, axis=2)
+    keep = ~valid | (moved > 2 * radii[:, None])
+    refined[keep] = corners[keep]
+
+    return [TagDetection(tag_id=int(tag.tag_id),
+                         hamming=int(tag.hamming),
+                         decision_margin=float(tag.decision_margin),
+                         center=np.asarray(tag.center, dtype=np.float32),
+                         corners=tag_corners.astype(np.float32),
+                         pose_R=None,
+                         pose_t=None,
+                         pose_err=None)
+            for tag, tag_corners in zip(detected_tags, refined)]
+
+def detect_april_tag_in_frame(frame, tag_standard: str, K, D, fx, fy, cx, cy, tag_size, detector=None,
+                              undistort_mode="image", refine_corners=False, refine_radius=4.0):
+    frame_undistorted = preprocess_frame(frame=frame, K=K, D=D, undistort_mode=undistort_mode)
+
+    if detector is None:
+        # Expensive, pass a long-lived detector (see AprilTagDetector) when processing many frames
+        detector = _Detector(families=tag_standard)
 
-    detector = Detector(families=tag_standard)
-    
-    detected_tags = detector.detect(img=frame_undistorted,
-                                    estimate_tag_pose=True,
-                                    camera_params=[fx, fy, cx, cy],
-                                    tag_size=tag_size)
-    print(f".... tags found: {len(detected_tags)}")
+    if undistort_mode == "points" or refine_corners:
+        # The poses are solved from the final corners afterwards
+        with stage("detect"):
+            detected_tags = detector.detect(img=frame_undistorted)
+        if refine_corners:
+            detected_tags = refine_tag_corners(image=frame_undistorted,
+                                               detected_tags=detected_tags,
+                                               max_radius=refine_radius)
+        detected_tags = undistort_tag_detections(detected_tags=detected_tags,
+                                                 K=K,
+                                                 D=D if undistort_mode == "points" else None,
+                                                 tag_size=tag_size)
+    else:
+        with stage("detect"):
+            detected_tags = detector.detect(img=frame_undistorted,
+                                            estimate_tag_pose=True,
+                                            camera_params=[fx, fy, cx, cy],
+                                            tag_size=tag_size)
     return detected_tags
@@ -0,0 +1,378 @@
+# src/batch.py
+#
+# Maps the tags of many videos with one shared pool of worker processes.
+#
+# Usage: python -m src.batch manifest.json --workers 8 --output-dir results
+#
+# The manifest is a JSON file:
+# {
+#     "defaults": {"calibration_path": "data/cam.json", "tag_size": 0.042},
+#     "jobs": [
+#         {"video_path": "data/shed.mp4", "origin_tag": 3},
+#         {"name": "site_b", "video_path": "data/b.mp4", "calibration_path": "data/cam_b.json",
+#          "origin_tag": 12, "tag_size": 0.1, "output_file": "results/site_b.json"}
+#     ]
+# }
+# Every job takes the settings of main.py, see DEFAULT_JOB_SETTINGS.
+
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.utils import load_video, get_frame_range, load_calibration_data, get_D_and_K_from_calibration
+from src.pipeline import _init_worker, _detect_chunk, split_frame_range
+from src.detection_store import DetectionStore, get_detection_cache_key, get_detection_cache_path
+from src.geometry import make_tag_data
+from src.mapping import map_tags
+from src import instrumentation
+
+# Settings of a job that are not given in the manifest, video_path and origin_tag are required
+DEFAULT_JOB_SETTINGS = dict(calibration_path="data/cam.json",
+                            tag_size=0.042, # meter
+                            tag_standard="tagStandard52h13",
+                            output_file=None, # default is <output dir>/<name>_tag_positions.json
+                            frame_stride=1,
+                            quad_decimate=2.0,
+                            undistort_mode="image",
+                            refine_corners=False,
+                            track_tags=False,
+                            redetect_interval=10,
+                            skip_redundant=False,
+                            min_frame_change=6.0,
+                            fuse_edges=False,
+                            optimize_map=False)
+
+def load_manifest(manifest_path):
+    """
+    Loads the jobs of a manifest, with the defaults of the manifest and DEFAULT_JOB_SETTINGS filled in.
+
+    Args:
+    - manifest_path (str): Path to the manifest JSON file, an object with "jobs" and optional
+        "defaults", or just the list of jobs.
+
+    Returns:
+    - jobs (list of dicts): The settings of every job, each with a unique "name".
+    """
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+    if isinstance(manifest, list):
+        manifest = {"jobs": manifest}
+
+    jobs = []
+    names = set()
+    for job in manifest["jobs"]:
+        job = {**DEFAULT_JOB_SETTINGS, **manifest.get("defaults", {}), **job}
+        name = job.get("name") or os.path.splitext(os.path.basename(str(job.get("video_path"))))[0]
+        # Videos with the same file name in different folders get numbered
+        unique_name, number = name, 1
+        while unique_name in names:
+            number += 1
+            unique_name = f"{name}_{number}"
+        names.add(unique_name)
+        job["name"] = unique_name
+        jobs.append(job)
+    return jobs
+
+def get_job_settings(job, calibration_data, nthreads=1):
+    """
+    Translates the settings of a job into the arguments of detect_tags_in_video.
+
+    Args:
+    - job (dict): The settings of the job, see DEFAULT_JOB_SETTINGS.
+    - calibration_data (dict): The calibration of the camera of the job.
+    - nthreads (int): Threads of the detector, None for all cores. Default is 1.
+
+    Returns:
+    - detector_settings (dict): Keyword arguments for AprilTagDetector.
+    - tracking (dict): Keyword arguments for TagTracker, None without tracking.
+    - selection (dict): Keyword arguments for FrameSelector, None without frame selection.
+    """
+    K, D, fx, fy, cx, cy = get_D_and_K_from_calibration(calibration_data)
+    detector_settings = dict(tag_standard=job["tag_standard"],
+                             K=K, D=D, fx=fx, fy=fy, cx=cx, cy=cy,
+                             tag_size=job["tag_size"],
+                             nthreads=nthreads,
+                             quad_decimate=job["quad_decimate"],
+                             undistort_mode=job["undistort_mode"],
+                             refine_corners=job["refine_corners"])
+    tracking = dict(redetect_interval=job["redetect_interval"]) if job["track_tags"] else None
+    selection = dict(min_change=job["min_frame_change"]) if job["skip_redundant"] else None
+    return detector_settings, tracking, selection
+
+def _prepare_job(job, output_dir, cache_dir, chunk_size):
+    # Settings, cache path and frame chunks of a job, raises if the job can't run
+    for key in ("video_path", "origin_tag"):
+        if job.get(key) is None:
+            raise ValueError(f"Job {job['name']} has no {key}")
+
+    calibration_data = load_calibration_data(job["calibration_path"])
+    # The pool processes fill the cores, one thread per detector
+    detector_settings, tracking, selection = get_job_settings(job, calibration_data, nthreads=1)
+
+    video = load_video(job["video_path"])
+    start_frame, stop_frame = get_frame_range(video)
+    video.release()
+    stride = job["frame_stride"]
+    if stop_frame is None:
+        # Length unknown, the whole video is one task
+        chunks = [(start_frame, None)]
+    else:
+        chunks = split_frame_range(start_frame, stop_frame, chunk_size, stride)
+
+    # Jobs with the same key detect the same, see run_batch
+    cache_key = get_detection_cache_key(video_path=job["video_path"],
+                                        calibration_data=calibration_data,
+                                        detector_settings=detector_settings,
+                                        stride=stride,
+                                        tracking=tracking,
+                                        selection=selection)
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = get_detection_cache_path(cache_dir=cache_dir,
+                                              video_path=job["video_path"],
+                                              calibration_data=calibration_data,
+                                              detector_settings=detector_settings,
+                                              key=cache_key)
+    output_file = job["output_file"] or os.path.join(output_dir, f"{job['name']}_tag_positions.json")
+    return dict(K=detector_settings["K"],
+                detector_settings=detector_settings,
+                tracking=tracking,
+                selection=selection,
+                stride=stride,
+                chunks=chunks,
+                # None if the length of the video is unknown
+                frames=None if stop_frame is None else sum(len(range(start, stop, stride)) for start, stop in chunks),
+                cache_key=cache_key,
+                cache_path=cache_path,
+                output_file=output_file)
+
+def _load_detections(state, chunk_results):
+    # The detections of a job, from the results of its chunks or from the cache
+    if chunk_results is None:
+        return DetectionStore.load(state["cache_path"])
+    detected_tags = DetectionStore()
+    for results in chunk_results:
+        for frame_index, tag_collection in results:
+            detected_tags.add_frame(frame_index=frame_index, detected_tags=tag_collection)
+    if state["cache_path"] is not None:
+        detected_tags.save(state["cache_path"])
+    return detected_tags
+
+def _finish_job(job, state, detected_tags):
+    # Maps the tags of a job from its detections and writes the output
+    tag_ids, transforms, _ = map_tags(detected_tags=detected_tags,
+                                      origin_tag=job["origin_tag"],
+                                      fuse_edges=job["fuse_edges"],
+                                      optimize_map=job["optimize_map"],
+                                      K=state["K"],
+                                      tag_size=job["tag_size"])
+    tag_positions = make_tag_data(tag_ids=tag_ids,
+                                  transforms=transforms,
+                                  tag_size_mm=job["tag_size"] * 1000)
+    directory = os.path.dirname(state["output_file"])
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with instrumentation.stage("serialization"):
+        with open(state["output_file"], "w") as file:
+            json.dump(tag_positions, file, indent=2)
+    return len(detected_tags), len(tag_ids)
+
+def run_batch(jobs, workers=None, chunk_size=256, output_dir=".", cache_dir=None):
+    """
+    Detects and maps the tags of many videos, with the frames of all videos on one process pool.
+
+    Every video is split into chunks of frames. The chunks of all videos are interleaved, so small
+    and large videos share the workers and the cores stay busy until the last chunk. A video is
+    mapped in this process as soon as all its chunks are done, while the workers carry on with the
+    others. A video that fails is reported and the batch carries on. Jobs that would detect the same
+    (same detection cache key, e.g. one video mapped from two origin tags) are detected once.
+
+    Args:
+    - jobs (list of dicts): The settings of every job, see load_manifest.
+    - workers (int): Number of worker processes. Default is the number of cores.
+    - chunk_size (int): Number of frames per task. Default is 256.
+    - output_dir (str): Folder of the outputs of jobs without output_file. Default is ".".
+    - cache_dir (str): Folder of the detection cache, None to always detect. Default is None.
+
+    Returns:
+    - summary (dict): Per job its status, error, frames, detections, mapped tags, the seconds the
+        workers spent on it and its throughput, and the totals of the batch (frames detected in
+        this batch, wall time and frames per second). The frames of a detected job are the frames
+        its workers processed, also for the jobs sharing its detections. Jobs with cached detections
+        have the frames of the video, None if unknown.
+    """
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    reports = [{"name": job["name"], "video_path": job.get("video_path"), "status": "pending", "error": None}
+               for job in jobs]
+    states = [None] * len(jobs)
+
+    def fail(index, error):
+        reports[index]["status"] = "failed"
+        reports[index]["error"] = f"{type(error).__name__}: {error}"
+        reports[index]["traceback"] = traceback.format_exc()
+        print(f".. {jobs[index]['name']} failed: {reports[index]['error']}")
+
+    def fail_detection(index, error):
+        # The jobs sharing the detections fail with it
+        for each in [index] + duplicates[index]:
+            fail(each, error)
+
+    def finish(index, chunk_results):
+        # Maps the job and the jobs sharing its detections
+        try:
+            detected_tags = _load_detections(states[index], chunk_results)
+        except Exception as error:
+            fail_detection(index, error)
+            return
+        # Frames the workers processed, None if the detections come from the cache
+        detected_frames = None if chunk_results is None else sum(len(results) for results in chunk_results)
+        for each in [index] + duplicates[index]:
+            try:
+                detections, tags = _finish_job(jobs[each], states[each], detected_tags)
+            except Exception as error:
+                fail(each, error)
+                continue
+            state = states[each]
+            detected = detected_frames is not None and each == index
+            frames = state["frames"] if detected_frames is None else detected_frames
+            worker_seconds = sum(state["chunk_seconds"])
+            reports[each].update(status="done",
+                                 cached=not detected,
+                                 detections_from=None if each == index else jobs[index]["name"],
+                                 output_file=state["output_file"],
+                                 frames=frames,
+                                 detections=detections,
+                                 tags=tags,
+                                 worker_seconds=worker_seconds,
+                                 wall_seconds=time.perf_counter() - start,
+                                 fps=frames / worker_seconds if detected and worker_seconds > 0 else None)
+            print(f".. {jobs[each]['name']}: {tags} tags from {detections} detections saved in {state['output_file']}")
+
+    # Settings of every job, cached jobs only need the mapping, jobs with the detections of an
+    # earlier job only wait for it
+    cached = []
+    duplicates = {index: [] for index in range(len(jobs))}
+    first_jobs = {}  # cache key -> index of the first job with it
+    for index, job in enumerate(jobs):
+        try:
+            states[index] = _prepare_job(job, output_dir, cache_dir, chunk_size)
+        except Exception as error:
+            fail(index, error)
+            continue
+        states[index]["chunk_seconds"] = []
+        cache_key = states[index]["cache_key"]
+        if cache_key in first_jobs:
+            duplicates[first_jobs[cache_key]].append(index)
+            continue
+        first_jobs[cache_key] = index
+        cache_path = states[index]["cache_path"]
+        if cache_path is not None and os.path.exists(cache_path):
+            cached.append(index)
+
+    # Interleave the chunks of the videos: the first chunk of every video, then the second ...
+    pending = [index for index in first_jobs.values() if index not in cached]
+    tasks = []
+    for chunk_number in range(max([len(states[index]["chunks"]) for index in pending], default=0)):
+        for index in pending:
+            if chunk_number < len(states[index]["chunks"]):
+                tasks.append((index, chunk_number))
+    chunk_results = {index: [None] * len(states[index]["chunks"]) for index in pending}
+    remaining = {index: len(states[index]["chunks"]) for index in pending}
+
+    recorder = instrumentation.get_recorder()
+    print(f".. {len(jobs)} videos, {len(tasks)} tasks on {workers} workers")
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(None, recorder is not None, recorder is None or recorder.trace)) as executor:
+        futures = {}
+        for index, chunk_number in tasks:
+            state = states[index]
+            chunk_start, chunk_stop = state["chunks"][chunk_number]
+            future = executor.submit(_detect_chunk, state["detector_settings"], jobs[index]["video_path"],
+                                     chunk_start, chunk_stop, state["stride"], state["tracking"], state["selection"])
+            futures[future] = (index, chunk_number)
+
+        # Map the cached videos while the workers detect the others
+        for index in cached:
+            finish(index, None)
+
+        for future in as_completed(futures):
+            index, chunk_number = futures[future]
+            if reports[index]["status"] == "failed" or future.cancelled():
+                continue
+            try:
+                results, worker_records, seconds = future.result()
+            except Exception as error:
+                fail_detection(index, error)
+                # Don't spend the workers on the rest of a failed video
+                for other, (other_index, _) in futures.items():
+                    if other_index == index:
+                        other.cancel()
+                continue
+            if worker_records is not None and recorder is not None:
+                recorder.merge(worker_records)
+            chunk_results[index][chunk_number] = results
+            states[index]["chunk_seconds"].append(seconds)
+            remaining[index] -= 1
+            if remaining[index] == 0:
+                finish(index, chunk_results.pop(index))
+
+    wall_seconds = time.perf_counter() - start
+    done = [report for report in reports if report["status"] == "done"]
+    # Frames of cached videos and of jobs sharing detections were not detected again in this batch
+    total_frames = sum(report["frames"] for report in done if not report["cached"])
+    return {"jobs": reports,
+            "total": {"jobs": len(jobs),
+                      "done": len(done),
+                      "failed": len(jobs) - len(done),
+                      "frames": total_frames,
+                      "wall_seconds": wall_seconds,
+                      "fps": total_frames / wall_seconds if wall_seconds > 0 else None}}
+
+def print_summary(summary):
+    for report in summary["jobs"]:
+        if report["status"] == "done" and report["cached"]:
+            frames = "-" if report["frames"] is None else report["frames"]
+            source = ("cached detections" if report["detections_from"] is None
+                      else f"detections of {report['detections_from']}")
+            print(f".... {report['name']:<24} {frames:>7} frames {report['tags']:5d} tags ({source})")
+        elif report["status"] == "done":
+            fps = "-" if report["fps"] is None else f"{report['fps']:.1f}"
+            print(f".... {report['name']:<24} {report['frames']:7d} frames {report['tags']:5d} tags "
+                  f"{report['worker_seconds']:8.1f} worker s {fps:>8} frames/s per worker")
+        else:
+            print(f".... {report['name']:<24} {report['status']}: {report['error']}")
+    total = summary["total"]
+    fps = "-" if total["fps"] is None else f"{total['fps']:.1f}"
+    print(f".. {total['done']}/{total['jobs']} videos done, {total['frames']} frames in "
+          f"{total['wall_seconds']:.1f}s, {fps} frames/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Map the tags of every video of a manifest.")
+    parser.add_argument("manifest", help="JSON manifest of the videos, see the top of src/batch.py")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--output-dir", default=".")
+    parser.add_argument("--cache-dir", default=".detection_cache")
+    parser.add_argument("--summary", default=None, help="default is <output dir>/batch_summary.json")
+    args = parser.parse_args()
+
+    jobs = load_manifest(args.manifest)
+    summary = run_batch(jobs=jobs,
+                        workers=args.workers,
+                        chunk_size=args.chunk_size,
+                        output_dir=args.output_dir,
+                        cache_dir=args.cache_dir)
+    print_summary(summary)
+    summary_file = args.summary or os.path.join(args.output_dir, "batch_summary.json")
+    os.makedirs(os.path.dirname(summary_file) or ".", exist_ok=True)
+    with open(summary_file, "w") as file:
+        json.dump(summary, file, indent=2)
+    print(f".. batch summary saved in {summary_file}")
+
+if __name__ == "__main__":
+    main()
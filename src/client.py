@@ -0,0 +1,129 @@
+# src/client.py
+#
+# Thin client of src/service.py, only the standard library so it starts instantly.
+#
+# Usage:
+# python -m src.client map data/plantage_shed.mp4 --origin-tag 3 --output tag_positions.json
+# python -m src.client detect frame.png --set tag_size=0.042
+# python -m src.client status
+
+import argparse
+import json
+import os
+import sys
+import time
+from urllib.parse import urlencode
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+
+def get_status(url=DEFAULT_URL):
+    """Returns the status of the service."""
+    with urlopen(f"{url}/status") as response:
+        return json.load(response)
+
+def map_video(job, url=DEFAULT_URL):
+    """
+    Sends a job to the service and yields its messages as they arrive.
+
+    Args:
+    - job (dict): The settings of the job, see DEFAULT_JOB_SETTINGS in src/batch.py. Relative
+        paths are made absolute, the service may run in another folder.
+    - url (str): The address of the service. Default is DEFAULT_URL.
+
+    Returns:
+    - messages (generator): {"frame", "tags"} dicts if job["stream_detections"], the last message
+        has the tag positions (or an error).
+    """
+    job = dict(job)
+    for key in ("video_path", "calibration_path"):
+        if job.get(key):
+            job[key] = os.path.abspath(job[key])
+    request = Request(f"{url}/map", data=json.dumps(job).encode(), headers={"Content-Type": "application/json"})
+    with urlopen(request) as response:
+        for line in response:
+            yield json.loads(line)
+
+def detect_image(image, settings=None, url=DEFAULT_URL):
+    """
+    Detects the tags in an encoded image (PNG, JPEG bytes) with the service.
+
+    Returns:
+    - tags (list of dicts): The detected tags with id, corners, center and pose.
+    """
+    query = urlencode({key: json.dumps(value) if not isinstance(value, str) else value
+                       for key, value in (settings or {}).items()})
+    request = Request(f"{url}/detect?{query}", data=image, headers={"Content-Type": "application/octet-stream"})
+    with urlopen(request) as response:
+        return json.load(response)["tags"]
+
+def _parse_settings(pairs):
+    # key=value pairs, values are JSON if they parse
+    settings = {}
+    for pair in pairs:
+        key, _, value = pair.partition("=")
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+    return settings
+
+def main():
+    parser = argparse.ArgumentParser(description="Client of the detection service (python -m src.service).")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    commands = parser.add_subparsers(dest="command", required=True)
+    map_parser = commands.add_parser("map", help="map the tags of a video")
+    map_parser.add_argument("video_path")
+    map_parser.add_argument("--origin-tag", type=int, required=True)
+    map_parser.add_argument("--calibration", default=None)
+    map_parser.add_argument("--output", default="tag_positions.json")
+    map_parser.add_argument("--detections", default=None, help="also save the detections of every frame as JSON lines")
+    map_parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="other job settings")
+    detect_parser = commands.add_parser("detect", help="detect the tags in an image")
+    detect_parser.add_argument("image_path")
+    detect_parser.add_argument("--set", nargs="*", default=[], metavar="KEY=VALUE", help="job settings")
+    commands.add_parser("status", help="show the status of the service")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    try:
+        run_command(args, start)
+    except HTTPError as error:
+        sys.exit(f".. service error: {json.load(error).get('error')}")
+    except URLError as error:
+        sys.exit(f".. no service at {args.url} ({error.reason}), start it with python -m src.service")
+
+def run_command(args, start):
+    if args.command == "status":
+        print(json.dumps(get_status(args.url), indent=2))
+    elif args.command == "detect":
+        with open(args.image_path, "rb") as file:
+            tags = detect_image(file.read(), _parse_settings(args.set), args.url)
+        print(json.dumps(tags, indent=2))
+    else:
+        job = {"video_path": args.video_path, "origin_tag": args.origin_tag,
+               "stream_detections": args.detections is not None, **_parse_settings(args.set)}
+        if args.calibration:
+            job["calibration_path"] = args.calibration
+        detections_file = open(args.detections, "w") if args.detections else None
+        try:
+            for message in map_video(job, args.url):
+                if "error" in message:
+                    sys.exit(f".. service error: {message['error']}")
+                if "frame" in message:
+                    # Streamed with --set stream_detections=true but no --detections to save them to
+                    if detections_file is not None:
+                        detections_file.write(json.dumps(message) + "\n")
+                    continue
+                with open(args.output, "w") as file:
+                    json.dump(message["tag_positions"], file, indent=2)
+                print(f".. {len(message['tag_positions'])} tags from {message['detections']} detections saved in "
+                      f"{args.output}, service {message['total_s']:.2f}s, "
+                      f"end to end {time.perf_counter() - start:.2f}s")
+        finally:
+            if detections_file is not None:
+                detections_file.close()
+
+if __name__ == "__main__":
+    main()
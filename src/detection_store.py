@@ -0,0 +1,216 @@
+# src/detection_store.py
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from src.instrumentation import timed
+
+# One row per detected tag
+DETECTION_DTYPE = np.dtype([
+    ("frame_index", np.int32),
+    ("tag_id", np.int32),
+    ("pose_R", np.float64, (3, 3)),
+    ("pose_t", np.float64, (3, 1)),
+    ("corners", np.float32, (4, 2)),
+    ("center", np.float32, (2,)),
+    ("decision_margin", np.float32),
+    ("pose_err", np.float64),
+    ("hamming", np.int8),
+])
+
+class DetectionStore:
+    """
+    Columnar store of all tag detections of a video, backed by a NumPy structured array.
+
+    Rows are sorted by (frame_index, tag_id), so a detection is found with a binary search
+    instead of scanning the tags of a frame. store[frame_index] returns the rows of a frame as
+    a record array, its rows have the same attributes as a Detection (tag_id, pose_R, pose_t, ...).
+
+    Args:
+    - records (numpy structured array): Rows with DETECTION_DTYPE, may be memory-mapped. Default is empty.
+    """
+    def __init__(self, records=None):
+        self._records = np.zeros(0, dtype=DETECTION_DTYPE) if records is None else records
+        self._pending = []
+        self._build_index()
+
+    def _build_index(self):
+        records = self._records
+        keys = self._make_keys(records["frame_index"], records["tag_id"])
+        if np.any(keys[1:] < keys[:-1]):
+            order = np.argsort(keys, kind="stable")
+            records, keys = records[order], keys[order]
+            self._records = records
+        self._keys = keys
+        self._frame_indexes, self._frame_starts = np.unique(records["frame_index"], return_index=True)
+
+    @staticmethod
+    def _make_keys(frame_indexes, tag_ids):
+        return (np.asarray(frame_indexes, dtype=np.int64) << 32) | np.asarray(tag_ids, dtype=np.int64)
+
+    def _consolidate(self):
+        if self._pending:
+            self._records = np.concatenate([self._records] + self._pending)
+            self._pending = []
+            self._build_index()
+
+    @property
+    def records(self):
+        """All rows, sorted by (frame_index, tag_id)."""
+        self._consolidate()
+        return self._records
+
+    def add_frame(self, frame_index, detected_tags):
+        """
+        Adds the tags detected in a frame.
+
+        Args:
+        - frame_index (int): Index of the frame in the video.
+        - detected_tags (list): Detection or TagDetection objects.
+        """
+        rows = np.zeros(len(detected_tags), dtype=DETECTION_DTYPE)
+        rows["frame_index"] = frame_index
+        for row, tag in zip(rows, detected_tags):
+            row["tag_id"] = tag.tag_id
+            row["pose_R"] = tag.pose_R
+            row["pose_t"] = np.reshape(tag.pose_t, (3, 1))
+            row["corners"] = tag.corners
+            row["center"] = tag.center
+            row["decision_margin"] = tag.decision_margin
+            row["pose_err"] = tag.pose_err
+            row["hamming"] = tag.hamming
+        self._pending.append(rows)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, frame_index):
+        """Rows of a frame as a record array, empty if nothing was detected in the frame."""
+        self._consolidate()
+        position = np.searchsorted(self._frame_indexes, frame_index)
+        if position == len(self._frame_indexes) or self._frame_indexes[position] != frame_index:
+            return self._records[:0].view(np.recarray)
+        start = self._frame_starts[position]
+        stop = self._frame_starts[position + 1] if position + 1 < len(self._frame_starts) else len(self._records)
+        return self._records[start:stop].view(np.recarray)
+
+    def frame_indexes(self):
+        """Indexes of the frames with at least one detection, in order."""
+        self._consolidate()
+        return self._frame_indexes
+
+    def frames(self):
+        """
+        Iterates over the frames with detections.
+
+        Returns:
+        - frames (generator): (frame_index, rows) tuples in frame order.
+        """
+        for frame_index in self.frame_indexes():
+            yield int(frame_index), self[frame_index]
+
+    def rows(self, frame_indexes, tag_ids):
+        """
+        Looks up many detections at once.
+
+        Args:
+        - frame_indexes (array-like): Frame index of every lookup.
+        - tag_ids (array-like): Tag ID of every lookup.
+
+        Returns:
+        - rows (numpy array): Row numbers into records, -1 where the tag wasn't seen in the frame.
+        """
+        self._consolidate()
+        keys = self._make_keys(frame_indexes, tag_ids)
+        positions = np.searchsorted(self._keys, keys)
+        positions = np.minimum(positions, max(len(self._keys) - 1, 0))
+        found = (len(self._keys) > 0) & (self._keys[positions] == keys)
+        return np.where(found, positions, -1)
+
+    def row(self, frame_index, tag_id):
+        """Row number of a single detection, -1 if the tag wasn't seen in the frame."""
+        return int(self.rows([frame_index], [tag_id])[0])
+
+    def get_tag(self, frame_index, tag_id):
+        """
+        Returns the detection of a tag in a frame.
+
+        Raises:
+        - KeyError: If the tag wasn't detected in the frame.
+        """
+        row = self.row(frame_index, tag_id)
+        if row < 0:
+            raise KeyError(f"Tag {tag_id} was not detected in frame {frame_index}")
+        return self._records.view(np.recarray)[row]
+
+    @timed("serialization")
+    def save(self, path):
+        """Saves the store as a .npy file that can be memory-mapped."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so an interrupted run doesn't leave a broken cache
+        temporary_path = f"{path}.tmp.npy"
+        np.save(temporary_path, self.records)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a store saved with save, memory-mapped read-only unless mmap is False."""
+        return cls(np.load(path, mmap_mode="r" if mmap else None))
+
+def _hash_file(path, chunk_size=1 << 20):
+    file_hash = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_detection_cache_key(video_path, calibration_data, detector_settings, stride=1, tracking=None,
+                            selection=None):
+    """
+    Returns a key that changes whenever the detections of a video would change.
+
+    The key covers the content of the video, the calibration and the detector settings, but not
+    the origin tag or how the graph is built, so changing those reuses the cached detections.
+
+    Args:
+    - video_path (str): Path to the video file.
+    - calibration_data (dict): The camera calibration, see load_calibration_data.
+    - detector_settings (dict): Keyword arguments for AprilTagDetector.
+    - stride (int): Every n-th frame was used.
+    - tracking (dict): The TagTracker settings, None if every full frame was searched.
+    - selection (dict): The FrameSelector settings, None if every frame was detected.
+
+    Returns:
+    - key (str): A hex digest.
+    """
+    # The number of threads doesn't change the detections
+    settings = {name: value for name, value in detector_settings.items() if name != "nthreads"}
+    description = {"video": _hash_file(video_path),
+                   "calibration": calibration_data,
+                   "detector": settings,
+                   "stride": stride}
+    if tracking is not None:
+        # Only added when used, so caches of full-frame runs stay valid
+        description["tracking"] = tracking
+    if selection is not None:
+        description["selection"] = selection
+    description = json.dumps(description,
+                             sort_keys=True,
+                             default=lambda value: np.asarray(value).tolist())
+    return hashlib.sha1(description.encode()).hexdigest()
+
+def get_detection_cache_path(cache_dir, video_path, calibration_data, detector_settings, stride=1, tracking=None,
+                             selection=None, key=None):
+    """
+    Returns the path of the cached DetectionStore of a video, see get_detection_cache_key. Pass
+    the key if it was computed already, it hashes the whole video.
+    """
+    if key is None:
+        key = get_detection_cache_key(video_path, calibration_data, detector_settings, stride, tracking, selection)
+    video_name = os.path.splitext(os.path.basename(video_path))[0]
+    return os.path.join(cache_dir, f"{video_name}_{key}.npy")
@@ -0,0 +1,115 @@
+# src/frame_selection.py
+
+from collections import deque
+
+import cv2
+import numpy as np
+
+from src.instrumentation import stage, count
+
+class FrameSelector:
+    """
+    Cheap pre-filter that drops redundant frames before the detector runs.
+
+    Every frame is scored on a small grayscale thumbnail:
+    - change: mean absolute difference to the last selected frame, near-duplicates of it are
+        dropped, so slow camera motion accumulates until the view has changed enough.
+    - sharpness: variance of the Laplacian, frames much blurrier than the recent frames
+        (motion blur) are dropped.
+    A frame is always selected after max_skip dropped frames, so the graph never starves.
+
+    Args:
+    - thumbnail_width (int): Width in pixels the frames are downsampled to. Default is 160.
+    - min_change (float): Mean gray level difference to the last selected frame a frame needs
+        to be selected. Default is 6.0.
+    - min_sharpness_ratio (float): Frames with a sharpness below this fraction of the median of
+        the recent frames are dropped as blurred. Default is 0.6.
+    - sharpness_window (int): Number of recent frames the sharpness is compared to. Default is 30.
+    - max_skip (int): Select a frame after this many dropped frames in a row. Default is 30.
+    """
+    def __init__(self, thumbnail_width=160, min_change=6.0, min_sharpness_ratio=0.6, sharpness_window=30,
+                 max_skip=30):
+        self.thumbnail_width = thumbnail_width
+        self.min_change = min_change
+        self.min_sharpness_ratio = min_sharpness_ratio
+        self.max_skip = max_skip
+        self.recent_sharpness = deque(maxlen=sharpness_window)
+        self.last_selected = None
+        self.skipped = 0
+        self.statistics = {"selected": 0, "duplicate": 0, "blurred": 0}
+
+    def get_thumbnail(self, frame):
+        """Downsamples a BGR or grayscale frame to a float32 grayscale thumbnail."""
+        height, width = frame.shape[:2]
+        size = (self.thumbnail_width, max(1, round(height * self.thumbnail_width / width)))
+        # Shrink first, the conversion is cheaper on the small image
+        thumbnail = cv2.resize(src=frame, dsize=size, interpolation=cv2.INTER_AREA)
+        if thumbnail.ndim == 3:
+            thumbnail = cv2.cvtColor(src=thumbnail, code=cv2.COLOR_BGR2GRAY)
+        return thumbnail.astype(np.float32)
+
+    def score(self, frame):
+        """
+        Scores a frame without changing the state of the selector.
+
+        Args:
+        - frame (numpy array): The BGR or grayscale frame.
+
+        Returns:
+        - change (float): Mean gray level difference to the last selected frame, inf if there is none.
+        - sharpness (float): Variance of the Laplacian of the thumbnail.
+        - thumbnail (numpy array): The thumbnail the scores were computed on.
+        """
+        thumbnail = self.get_thumbnail(frame)
+        change = np.inf if self.last_selected is None else float(np.mean(np.abs(thumbnail - self.last_selected)))
+        sharpness = float(cv2.Laplacian(src=thumbnail, ddepth=cv2.CV_32F).var())
+        return change, sharpness, thumbnail
+
+    def select(self, frame):
+        """
+        Decides whether a frame is worth detecting and updates the state of the selector.
+
+        Args:
+        - frame (numpy array): The next BGR or grayscale frame of the video.
+
+        Returns:
+        - selected (bool): True if the frame should be passed to the detector.
+        """
+        change, sharpness, thumbnail = self.score(frame)
+        reference_sharpness = np.median(self.recent_sharpness) if self.recent_sharpness else 0.0
+        self.recent_sharpness.append(sharpness)
+
+        if self.skipped < self.max_skip:
+            if sharpness < self.min_sharpness_ratio * reference_sharpness:
+                self.statistics["blurred"] += 1
+                self.skipped += 1
+                return False
+            if change < self.min_change:
+                self.statistics["duplicate"] += 1
+                self.skipped += 1
+                return False
+
+        self.statistics["selected"] += 1
+        self.skipped = 0
+        self.last_selected = thumbnail
+        return True
+
+def select_frames(frames, **selector_settings):
+    """
+    Filters a stream of frames with a FrameSelector.
+
+    Args:
+    - frames (iterable): (frame_index, frame) tuples, see iter_frames.
+    - selector_settings: Keyword arguments for FrameSelector.
+
+    Returns:
+    - frames (generator): The selected (frame_index, frame) tuples, in order.
+    """
+    selector = FrameSelector(**selector_settings)
+    for frame_index, frame in frames:
+        with stage("frame selection"):
+            selected = selector.select(frame)
+        if selected:
+            yield frame_index, frame
+        else:
+            count("frames skipped")
@@ -0,0 +1,153 @@
+# src/fusion.py
+
+import numpy as np
+
+from src.geometry import calculate_relative_transforms, invert_transforms
+from src.instrumentation import timed
+
+def project_to_rotations(matrices):
+    """
+    Projects a stack of 3x3 matrices onto the closest rotation matrices (in Frobenius norm).
+    """
+    u, _, vt = np.linalg.svd(matrices)
+    # Flip the last axis where the closest orthogonal matrix would be a reflection
+    signs = np.sign(np.linalg.det(u @ vt))
+    u[:, :, 2] *= signs[:, None]
+    return u @ vt
+
+def average_rotations(rotations, groups, n_groups, weights=None):
+    """
+    Chordal L2 mean of the rotations of every group, for all groups at once.
+
+    Args:
+    - rotations (numpy array): Nx3x3 rotation matrices.
+    - groups (numpy array): The group of every rotation, 0 <= group < n_groups.
+    - n_groups (int): The number of groups.
+    - weights (numpy array): Optional weight of every rotation.
+
+    Returns:
+    - means (numpy array): n_groups x3x3 rotation matrices, the identity for empty groups.
+    """
+    if weights is not None:
+        rotations = rotations * weights[:, None, None]
+    sums = np.zeros((n_groups, 3, 3))
+    np.add.at(sums, groups, rotations)
+    sums[np.all(sums == 0, axis=(1, 2))] = np.eye(3)
+    return project_to_rotations(sums)
+
+def group_median(values, groups, n_groups):
+    """
+    Median of the values of every group, for all groups at once.
+
+    Args:
+    - values (numpy array): N or NxK values.
+    - groups (numpy array): The group of every value, 0 <= group < n_groups.
+    - n_groups (int): The number of groups.
+
+    Returns:
+    - medians (numpy array): n_groups or n_groups xK medians, NaN for empty groups.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    columns = values.reshape(len(values), -1)
+    counts = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    lower = starts + np.maximum(counts - 1, 0) // 2
+    upper = starts + counts // 2
+
+    medians = np.full((n_groups, columns.shape[1]), np.nan)
+    has_values = counts > 0
+    for k in range(columns.shape[1]):
+        # Sorted by group first, then by value
+        ordered = columns[np.lexsort((columns[:, k], groups)), k]
+        medians[has_values, k] = (ordered[lower[has_values]] + ordered[upper[has_values]]) / 2
+    return medians.reshape((n_groups,) + values.shape[1:])
+
+def rotation_angles(rotations_a, rotations_b):
+    """
+    Angles in radians of the rotations between two stacks of rotation matrices.
+    """
+    cosines = (np.einsum("nij,nij->n", rotations_a, rotations_b) - 1) / 2
+    return np.arccos(np.clip(cosines, -1.0, 1.0))
+
+@timed("fusion")
+def fuse_edge_transforms(tag_collection, tag_graph, pairs=None, outlier_factor=3.0,
+                         min_translation_tolerance=0.002, min_rotation_tolerance=np.radians(2.0)):
+    """
+    Fuses all co-observations of pairs of tags into one relative transform per pair.
+
+    The relative transforms of every frame in which both tags were seen are computed in one batch.
+    Per pair, observations far from the element-wise median transform are rejected as outliers
+    (e.g. AprilTag pose flips), the remaining rotations are averaged with the chordal mean and the
+    translations with the arithmetic mean.
+
+    Args:
+    - tag_collection (DetectionStore, dict or list): The detections of every frame, indexed by frame index.
+    - tag_graph (TagGraph): The graph holding the frames of every edge.
+    - pairs (list of tuples): The (tag ID, tag ID) pairs to fuse. Default is every edge of the graph.
+    - outlier_factor (float): Observations further from the median than this many times the median
+        deviation of their pair are rejected. Default is 3.0.
+    - min_translation_tolerance (float): Translation deviation in meters that is always accepted.
+        Default is 2 mm.
+    - min_rotation_tolerance (float): Rotation deviation in radians that is always accepted.
+        Default is 2 degrees.
+
+    Returns:
+    - edge_transforms (dict): (tag ID a, tag ID b) -> 4x4 transform from b to a coordinates, for
+        both orders of every pair.
+    - statistics (dict): (smaller tag ID, larger tag ID) -> (number of inliers, number of observations).
+    """
+    if pairs is None:
+        pairs = list(tag_graph.edges.keys())
+    pairs = [(min(pair), max(pair)) for pair in pairs]
+    if not pairs:
+        return {}, {}
+
+    # Flatten all co-observations, every observation belongs to the group of its pair
+    frames = [tag_graph.get_edge_frames(*pair) for pair in pairs]
+    counts = np.array([len(pair_frames) for pair_frames in frames])
+    groups = np.repeat(np.arange(len(pairs)), counts)
+    pairs_array = np.array(pairs, dtype=np.int64)
+    observations = calculate_relative_transforms(tag_collection,
+                                                 frame_indexes=np.concatenate(frames).astype(np.int64),
+                                                 from_tags=pairs_array[groups, 0],
+                                                 to_tags=pairs_array[groups, 1])
+    rotations = observations[:, :3, :3]
+    translations = observations[:, :3, 3]
+
+    # Robust reference per pair: the element-wise median, projected back onto a rotation
+    median_transforms = group_median(observations[:, :3, :], groups, len(pairs))
+    reference_rotations = project_to_rotations(median_transforms[:, :, :3])
+    reference_translations = median_transforms[:, :, 3]
+
+    translation_errors = np.linalg.norm(translations - reference_translations[groups], axis=1)
+    rotation_errors = rotation_angles(rotations, reference_rotations[groups])
+    translation_tolerances = np.maximum(outlier_factor * group_median(translation_errors, groups, len(pairs)),
+                                        min_translation_tolerance)
+    rotation_tolerances = np.maximum(outlier_factor * group_median(rotation_errors, groups, len(pairs)),
+                                     min_rotation_tolerance)
+    inliers = ((translation_errors <= translation_tolerances[groups])
+               & (rotation_errors <= rotation_tolerances[groups]))
+
+    # Average the inliers of every pair
+    inlier_groups = groups[inliers]
+    inlier_counts = np.bincount(inlier_groups, minlength=len(pairs))
+    fused = np.zeros((len(pairs), 4, 4))
+    fused[:, :3, :3] = average_rotations(rotations[inliers], inlier_groups, len(pairs))
+    translation_sums = np.zeros((len(pairs), 3))
+    np.add.at(translation_sums, inlier_groups, translations[inliers])
+    fused[:, :3, 3] = translation_sums / np.maximum(inlier_counts, 1)[:, None]
+    fused[:, 3, 3] = 1.0
+
+    # Pairs without inliers keep the median
+    empty = inlier_counts == 0
+    fused[empty, :3, :3] = reference_rotations[empty]
+    fused[empty, :3, 3] = reference_translations[empty]
+
+    inverse = invert_transforms(fused)
+    edge_transforms = {}
+    for (tag1, tag2), transform, inverse_transform in zip(pairs, fused, inverse):
+        edge_transforms[(tag1, tag2)] = transform
+        edge_transforms[(tag2, tag1)] = inverse_transform
+    statistics = {pair: (int(inlier_count), int(count))
+                  for pair, inlier_count, count in zip(pairs, inlier_counts, counts)}
+    return edge_transforms, statistics
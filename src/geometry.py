@@ -1,5 +1,7 @@
 import numpy as np
 
+from src.instrumentation import timed
+
 def calculate_distance_between_tags(detected_tags, tag_id_1, tag_id_2):
     tag1 = None
     tag2 = None
@@ -32,98 +34,313 @@ def calculate_distance_between_tags(detected_tags, tag_id_1, tag_id_2):
     
     return distance_mm, distance_vector
 
+def get_tag_in_frame(tag_collection, frame_index, tag_id):
+    """
+    Returns the detection of a tag in a frame.
+
+    Uses the (frame, tag_id) index of a DetectionStore, falls back to scanning the tags of the
+    frame for plain lists of Detection objects.
+    """
+    if hasattr(tag_collection, "get_tag"):
+        return tag_collection.get_tag(frame_index, tag_id)
+    return next(tag for tag in tag_collection[frame_index] if tag.tag_id == tag_id)
+
+# Maps the frame of the origin tag (x right, y down, z into the wall) to the frame of the
+# results (x right, y up, z out of the wall)
+ORIGIN_FRAME = np.diag([1.0, -1.0, -1.0, 1.0])
+
+def get_local_corners(tag_size):
+    """
+    Returns the corners of a tag in its own frame (x right, y down, z into the tag), in the
+    order of the results: top-left, top-right, bottom-right, bottom-left.
+    """
+    half_size = tag_size / 2.0
+    return np.array([
+        [-half_size, -half_size, 0],  # Top-left corner
+        [half_size, -half_size, 0],   # Top-right corner
+        [half_size, half_size, 0],    # Bottom-right corner
+        [-half_size, half_size, 0]    # Bottom-left corner
+    ])
+
+def make_transforms(rotations, translations):
+    """
+    Stacks rotations and translations into 4x4 homogeneous transforms.
+
+    Args:
+    - rotations (numpy array): Nx3x3 rotation matrices.
+    - translations (numpy array): Nx3 or Nx3x1 translation vectors.
+
+    Returns:
+    - transforms (numpy array): Nx4x4 transforms.
+    """
+    rotations = np.asarray(rotations, dtype=np.float64)
+    transforms = np.zeros((len(rotations), 4, 4))
+    transforms[:, :3, :3] = rotations
+    transforms[:, :3, 3] = np.asarray(translations, dtype=np.float64).reshape(len(rotations), 3)
+    transforms[:, 3, 3] = 1.0
+    return transforms
+
+def invert_transforms(transforms):
+    """
+    Inverts a stack of rigid 4x4 transforms.
+    """
+    rotations_t = np.swapaxes(transforms[:, :3, :3], 1, 2)
+    inverse = np.zeros_like(transforms)
+    inverse[:, :3, :3] = rotations_t
+    inverse[:, :3, 3] = -np.einsum("nij,nj->ni", rotations_t, transforms[:, :3, 3])
+    inverse[:, 3, 3] = 1.0
+    return inverse
+
+def get_tag_poses(tag_collection, frame_indexes, tag_ids):
+    """
+    Returns the poses of tags in the camera frame as 4x4 transforms.
+
+    Args:
+    - tag_collection (DetectionStore, dict or list): The detections of every frame, indexed by frame index.
+    - frame_indexes (array-like): The frame of every pose.
+    - tag_ids (array-like): The tag of every pose.
+
+    Returns:
+    - transforms (numpy array): Nx4x4 transforms from tag to camera coordinates, in meters.
+    """
+    if hasattr(tag_collection, "rows"):
+        # Gather all poses at once through the (frame, tag_id) index of the DetectionStore
+        rows = tag_collection.rows(frame_indexes, tag_ids)
+        if np.any(rows < 0):
+            missing = int(np.argmax(rows < 0))
+            raise KeyError(f"Tag {tag_ids[missing]} was not detected in frame {frame_indexes[missing]}")
+        records = tag_collection.records
+        return make_transforms(records["pose_R"][rows], records["pose_t"][rows])
+
+    tags = [get_tag_in_frame(tag_collection, frame_index, tag_id)
+            for frame_index, tag_id in zip(frame_indexes, tag_ids)]
+    return make_transforms([tag.pose_R for tag in tags], [tag.pose_t for tag in tags])
+
+def calculate_relative_transforms(tag_collection, frame_indexes, from_tags, to_tags):
+    """
+    Calculates the transforms from to_tags to from_tags coordinates, each observed in one frame.
+
+    Both tags are seen by the same camera, so T_from_to = inv(T_camera_from) @ T_camera_to.
+
+    Returns:
+    - transforms (numpy array): Nx4x4 transforms in meters.
+    """
+    from_poses = get_tag_poses(tag_collection, frame_indexes, from_tags)
+    to_poses = get_tag_poses(tag_collection, frame_indexes, to_tags)
+    return invert_transforms(from_poses) @ to_poses
+
+def get_tree_levels(parents, origin_tag):
+    """
+    Orders the tags of a shortest path tree breadth-first from the origin.
+
+    Args:
+    - parents (dict): tag ID -> (parent tag ID, frame index), see TagGraph.shortest_path_tree.
+    - origin_tag (int): The tag ID of the root.
+
+    Returns:
+    - levels (list of lists): The (tag ID, parent tag ID, frame index) edges of every depth, the
+        first level holds the children of the origin.
+    """
+    children = {}
+    for tag, (parent, frame_index) in parents.items():
+        if parent is not None:
+            children.setdefault(parent, []).append((tag, parent, frame_index))
+
+    levels = []
+    level = children.get(origin_tag, [])
+    while level:
+        levels.append(level)
+        level = [edge for tag, _, _ in level for edge in children.get(tag, [])]
+    return levels
+
+@timed("geometry")
+def calculate_tag_transforms(tag_collection, parents, origin_tag, edge_transforms=None):
+    """
+    Calculates the pose of every tag of a shortest path tree relative to the origin tag.
+
+    The relative transforms of all tree edges are computed in one batch, then they are chained
+    breadth-first from the origin, one matrix product per depth level, so every tag is computed
+    exactly once and shared path prefixes are reused.
+
+    Args:
+    - tag_collection (DetectionStore, dict or list): The detections of every frame, indexed by frame index.
+    - parents (dict): tag ID -> (parent tag ID, frame index), see TagGraph.shortest_path_tree.
+    - origin_tag (int): The tag ID of the root.
+    - edge_transforms (dict): Optional (parent tag ID, tag ID) -> 4x4 transform from tag to parent
+        coordinates, e.g. fused over many frames (see fuse_edge_transforms). By default the transform
+        is taken from the frame of the edge in the tree.
+
+    Returns:
+    - tag_ids (numpy array): The tag IDs, starting with the origin tag.
+    - transforms (numpy array): Nx4x4 transforms from tag to origin tag coordinates, in meters.
+    """
+    levels = get_tree_levels(parents, origin_tag)
+    edges = [edge for level in levels for edge in level]
+    tag_ids = np.array([origin_tag] + [tag for tag, _, _ in edges], dtype=np.int64)
+
+    transforms = np.empty((len(tag_ids), 4, 4))
+    transforms[0] = np.eye(4)
+    if not edges:
+        return tag_ids, transforms
+
+    # T_parent_tag for every edge of the tree
+    if edge_transforms is not None:
+        relative_transforms = np.array([edge_transforms[(parent, tag)] for tag, parent, _ in edges])
+    else:
+        relative_transforms = calculate_relative_transforms(tag_collection,
+                                                            frame_indexes=[frame_index for _, _, frame_index in edges],
+                                                            from_tags=[parent for _, parent, _ in edges],
+                                                            to_tags=[tag for tag, _, _ in edges])
+
+    positions = {origin_tag: 0}
+    start = 1
+    for level in levels:
+        stop = start + len(level)
+        parent_positions = [positions[parent] for _, parent, _ in level]
+        # T_origin_tag = T_origin_parent @ T_parent_tag, for the whole level at once
+        transforms[start:stop] = transforms[parent_positions] @ relative_transforms[start - 1:stop - 1]
+        positions.update((tag, position) for position, (tag, _, _) in enumerate(level, start=start))
+        start = stop
+    return tag_ids, transforms
+
+def transform_tag_corners(transforms, tag_size_mm=42.0):
+    """
+    Calculates the corners of many tags from their poses relative to the origin tag.
+
+    Args:
+    - transforms (numpy array): Nx4x4 transforms from tag to origin tag coordinates, in meters.
+    - tag_size_mm (float): The size of the tag (length of a side) in millimeters. Default is 42.0 mm.
+
+    Returns:
+    - corners (numpy array): Nx4x3 corner positions in millimeters, in the frame of the results.
+    """
+    transforms = ORIGIN_FRAME @ transforms
+    local_corners = get_local_corners(tag_size_mm)
+    return (np.einsum("nij,cj->nci", transforms[:, :3, :3], local_corners)
+            + transforms[:, None, :3, 3] * 1000)  # Convert to millimeters
+
+def calculate_all_tag_corners(tag_collection, parents, origin_tag, tag_size_mm=42.0, edge_transforms=None):
+    """
+    Calculates the positions of the corners of every tag of a shortest path tree.
+
+    Args:
+    - tag_collection (DetectionStore, dict or list): The detections of every frame, indexed by frame index.
+    - parents (dict): tag ID -> (parent tag ID, frame index), see TagGraph.shortest_path_tree.
+    - origin_tag (int): The tag ID of the origin.
+    - tag_size_mm (float): The size of the tag (length of a side) in millimeters. Default is 42.0 mm.
+    - edge_transforms (dict): Optional relative transforms of the tree edges, see calculate_tag_transforms.
+
+    Returns:
+    - tag_data (list of dicts): For every tag, sorted by ID, a dictionary containing the tag ID and
+        the 3D positions of its four corners in millimeters. The origin tag lies in the X-Y plane,
+        centered at 0, with Y up and Z pointing out of the wall.
+    """
+    if origin_tag not in parents:
+        return []
+    tag_ids, transforms = calculate_tag_transforms(tag_collection, parents, origin_tag, edge_transforms)
+    return make_tag_data(tag_ids, transforms, tag_size_mm)
+
+def make_tag_data(tag_ids, transforms, tag_size_mm=42.0):
+    """
+    Turns tag poses relative to the origin tag into the tag data of the results.
+
+    Args:
+    - tag_ids (array-like): The tag IDs.
+    - transforms (numpy array): Nx4x4 transforms from tag to origin tag coordinates, in meters.
+    - tag_size_mm (float): The size of the tag (length of a side) in millimeters. Default is 42.0 mm.
+
+    Returns:
+    - tag_data (list of dicts): For every tag, sorted by ID, the tag ID and its corners in millimeters.
+    """
+    tag_ids = np.asarray(tag_ids)
+    corners = np.round(transform_tag_corners(transforms, tag_size_mm), decimals=1)
+    order = np.argsort(tag_ids)
+    return [{"id": int(tag_ids[i]), "corners": corners[i].tolist()} for i in order]
+
+def get_camera_positions(detection_store, tag_ids, transforms):
+    """
+    Calculates the position of the camera in every frame from the tag map.
+
+    The camera pose of a frame comes from its mapped tag with the highest decision margin:
+    T_origin_camera = T_origin_tag @ inv(T_camera_tag).
+
+    Args:
+    - detection_store (DetectionStore): The detections of every frame.
+    - tag_ids (array-like): The tag IDs of the map.
+    - transforms (numpy array): Nx4x4 transforms from tag to origin tag coordinates, in meters.
+
+    Returns:
+    - frame_indexes (numpy array): The frames with at least one mapped tag, in order.
+    - positions (numpy array): Nx3 camera positions in millimeters, in the frame of the results.
+    """
+    records = detection_store.records
+    tag_ids = np.asarray(tag_ids)
+    records = records[np.isin(records["tag_id"], tag_ids)]
+    # Best detection of every frame: sort by frame, then by decreasing margin, keep the first row
+    order = np.lexsort((-records["decision_margin"], records["frame_index"]))
+    records = records[order]
+    frame_indexes, first_rows = np.unique(records["frame_index"], return_index=True)
+    records = records[first_rows]
+
+    positions_in_map = np.searchsorted(tag_ids[np.argsort(tag_ids)], records["tag_id"])
+    tag_transforms = transforms[np.argsort(tag_ids)][positions_in_map]
+    camera_poses = make_transforms(records["pose_R"], records["pose_t"])
+    camera_transforms = ORIGIN_FRAME @ tag_transforms @ invert_transforms(camera_poses)
+    return frame_indexes, camera_transforms[:, :3, 3] * 1000  # Convert to millimeters
+
+def _get_parents_from_path(path):
+    # Turns a path to the origin (see TagGraph.get_paths_to_origin) into a single branch tree
+    origin_tag = path[-1][1]
+    parents = {origin_tag: (None, None)}
+    for tag, parent, frame_index in path:
+        parents[tag] = (parent, frame_index)
+    return parents, origin_tag
+
 def calculate_R_and_t_to_origin(tag_collection, path):
     """
-    Calculates the relative position and orientation of the end tag in the path relative to the start tag (origin).
+    Calculates the relative position and orientation of the start tag in the path relative to the origin at its end.
     
     Args:
-    - tag_collection (list of lists): A list where each element is a list of Detection objects from a frame.
-    - path (list of tuples): The path from the origin to the target tag, including frame indexes.
+    - tag_collection (DetectionStore, dict or list): The detections of every frame, indexed by frame index.
+    - path (list of tuples): The path from the target tag to the origin, including frame indexes.
     
     Returns:
-    - relative_position (numpy array): The position of the end node relative to the origin in millimeters.
-    - relative_rotation (numpy array): The rotation matrix of the end node relative to the origin.
+    - relative_position (numpy array): The position of the tag relative to the origin in millimeters.
+    - relative_rotation (numpy array): The rotation matrix of the tag relative to the origin.
     """
-    current_position = np.array([0.0, 0.0, 0.0])  # Start at the origin
-    current_rotation = np.eye(3)  # Start with no rotation (identity matrix)
-    
-    for start_node, end_node, frame_index in path:
-        # Get the relevant frame from the tag_collection
-        frame = tag_collection[frame_index]
-        
-        # Find the Detection objects for the start and end nodes in the frame
-        start_tag = next(tag for tag in frame if tag.tag_id == start_node)
-        end_tag = next(tag for tag in frame if tag.tag_id == end_node)
-        
-        # Calculate the relative rotation and translation between the start and end tags
-        rotation_matrix = np.array(end_tag.pose_R)
-        translation_vector = np.array(end_tag.pose_t).flatten() - np.array(start_tag.pose_t).flatten()
-        # TODO: something is wrong in here
-        
-        # Transform the translation vector by the current rotation
-        transformed_translation = np.dot(current_rotation, translation_vector)
-        
-        # Update the current position by adding the transformed translation vector
-        current_position += transformed_translation * 1000  # Convert to millimeters
-        
-        # Update the current rotation by applying the relative rotation
-        current_rotation = np.dot(current_rotation, rotation_matrix)
-    
-    return current_position, current_rotation
+    parents, origin_tag = _get_parents_from_path(path)
+    tag_ids, transforms = calculate_tag_transforms(tag_collection, parents, origin_tag)
+    transform = transforms[list(tag_ids).index(path[0][0])]
+    return transform[:3, 3] * 1000, transform[:3, :3]  # Convert to millimeters
 
 def calculate_tag_corners(tag_collection, path, tag_size_mm=42.0):
     """
     Calculates the positions of the corners of the tag based on the relative translation and rotation from the origin.
     
     Args:
-    - tag_collection (list of lists): A list where each element is a list of Detection objects from a frame.
-    - path (list of tuples): The path from the origin to the target tag, including frame indexes.
+    - tag_collection (DetectionStore, dict or list): The detections of every frame, indexed by frame index.
+    - path (list of tuples): The path from the target tag to the origin tag, including frame indexes.
     - tag_size_mm (float): The size of the tag (length of a side) in millimeters. Default is 42.0 mm.
     
     Returns:
-    - tag_data (list of dicts): A list where each element is a dictionary containing the tag ID and the 
+    - tag_data (list of dicts): A list with a single dictionary containing the tag ID and the 
         3D positions of its four corners in millimeters.
     """
-    tag_data = []
-    
-    # Define the corners of the tag
-    half_size = tag_size_mm / 2.0
-    local_corners = np.array([
-        [-half_size, half_size, 0],   # Top-left corner
-        [half_size, half_size, 0],    # Top-right corner
-        [half_size, -half_size, 0],   # Bottom-right corner
-        [-half_size, -half_size, 0]   # Bottom-left corner
-    ])
-    
-    # Do coordinate transformation unless it's the origin tag
     if isinstance(path[0], int):
         # Origin Tag doesn't have a path
-        global_corners = local_corners
         end_tag_id = path[0]
+        transform = np.eye(4)
     else:
-        # Calculate the relative rotation and translation for the tag at the end of the path
-        relative_position, relative_rotation = calculate_R_and_t_to_origin(tag_collection, path)
-
-        # Calculate the global positions of the corners by applying the rotation and translation
-        global_corners = [np.dot(relative_rotation, corner) + relative_position for corner in local_corners]
-        
-        # Correct the X-axis (flip X coordinates)
-        # TODO: don't, fix translation
-        global_corners = [[-corner[0], corner[1], corner[2]] for corner in global_corners]
-        
-        # Get the tag ID for the end tag
         end_tag_id = path[0][0]
-    
-    # Round
-    global_corners = np.round(global_corners, decimals=1)
-    
-    # Create the tag data dictionary
-    tag_data.append({
+        parents, origin_tag = _get_parents_from_path(path)
+        tag_ids, transforms = calculate_tag_transforms(tag_collection, parents, origin_tag)
+        transform = transforms[list(tag_ids).index(end_tag_id)]
+
+    global_corners = np.round(transform_tag_corners(transform[None], tag_size_mm)[0], decimals=1)
+    return [{
         "id": end_tag_id,
         "corners": global_corners.tolist()
-    })
-    
-    return tag_data
+    }]
 
 
 def get_center_from_corners(corners):
@@ -0,0 +1,221 @@
+# src/instrumentation.py
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+# The active recorder, None while instrumentation is disabled
+_recorder = None
+
+class Recorder:
+    """
+    Collects timers, counters and histograms of the pipeline stages.
+
+    Timers record the duration of every call of a stage, histograms any other value per event
+    (tags per frame, queue depths), counters are plain sums. Durations are also kept as Chrome
+    trace events (chrome://tracing, Perfetto) unless trace is False.
+
+    Args:
+    - trace (bool): Keep the events for export_trace. Default is True.
+    - max_trace_events (int): Stop keeping events after this many, the summary is still complete.
+        Default is 1,000,000.
+    """
+    def __init__(self, trace=True, max_trace_events=1_000_000):
+        self.trace = trace
+        self.max_trace_events = max_trace_events
+        self.start_time = time.perf_counter()
+        self.timers = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(list)
+        self.events = []
+        self.dropped_events = 0
+
+    def _add_event(self, event):
+        if not self.trace:
+            return
+        if len(self.events) < self.max_trace_events:
+            self.events.append(event)
+        else:
+            self.dropped_events += 1
+
+    def add_duration(self, name, start_ns, end_ns):
+        """Records a call of a stage from start_ns to end_ns (time.perf_counter_ns)."""
+        self.timers[name].append((end_ns - start_ns) / 1e9)
+        self._add_event({"name": name, "ph": "X", "ts": start_ns / 1000, "dur": (end_ns - start_ns) / 1000,
+                         "pid": os.getpid(), "tid": threading.get_ident()})
+
+    def count(self, name, value=1):
+        """Adds value to a counter."""
+        self.counters[name] += value
+
+    def observe(self, name, value):
+        """Records a value of a histogram, also shown as a counter track in the trace."""
+        self.histograms[name].append(value)
+        self._add_event({"name": name, "ph": "C", "ts": time.perf_counter_ns() / 1000,
+                         "pid": os.getpid(), "args": {name: value}})
+
+    def drain(self):
+        """
+        Returns everything recorded so far and starts over, to send it from a worker process to
+        the recorder of the main process, see merge.
+        """
+        data = {"timers": dict(self.timers), "counters": dict(self.counters),
+                "histograms": dict(self.histograms), "events": self.events,
+                "dropped_events": self.dropped_events}
+        self.timers = defaultdict(list)
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(list)
+        self.events = []
+        self.dropped_events = 0
+        return data
+
+    def merge(self, data):
+        """Adds the records drained from another recorder."""
+        for name, values in data["timers"].items():
+            self.timers[name].extend(values)
+        for name, value in data["counters"].items():
+            self.counters[name] += value
+        for name, values in data["histograms"].items():
+            self.histograms[name].extend(values)
+        self.dropped_events += data["dropped_events"]
+        for event in data["events"]:
+            self._add_event(event)
+
+    def summary(self):
+        """
+        Summarizes the records.
+
+        Returns:
+        - summary (dict): Per timer the number of calls, the total seconds and the mean, p50, p95
+            and max milliseconds. Per histogram the number of values and their mean, min, p50, p95
+            and max. The counters and the wall time since the recorder was created.
+        """
+        timers = {}
+        for name, durations in self.timers.items():
+            milliseconds = np.asarray(durations) * 1000
+            timers[name] = {"count": len(durations),
+                            "total_s": float(milliseconds.sum() / 1000),
+                            "mean_ms": float(milliseconds.mean()),
+                            "p50_ms": float(np.percentile(milliseconds, 50)),
+                            "p95_ms": float(np.percentile(milliseconds, 95)),
+                            "max_ms": float(milliseconds.max())}
+        histograms = {}
+        for name, values in self.histograms.items():
+            values = np.asarray(values, dtype=np.float64)
+            histograms[name] = {"count": len(values),
+                                "mean": float(values.mean()),
+                                "min": float(values.min()),
+                                "p50": float(np.percentile(values, 50)),
+                                "p95": float(np.percentile(values, 95)),
+                                "max": float(values.max())}
+        return {"wall_time_s": time.perf_counter() - self.start_time,
+                "timers": timers,
+                "counters": dict(self.counters),
+                "histograms": histograms,
+                "dropped_trace_events": self.dropped_events}
+
+    def export_summary(self, path):
+        """Writes the summary as JSON."""
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=4)
+
+    def export_trace(self, path):
+        """Writes the events in the Chrome trace format, open it in chrome://tracing or ui.perfetto.dev."""
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file)
+
+class _Stage:
+    # Times a with block into the recorder
+    __slots__ = ("recorder", "name", "start_ns")
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.recorder.add_duration(self.name, self.start_ns, time.perf_counter_ns())
+        return False
+
+class _NullStage:
+    # Does nothing, used while instrumentation is disabled
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+def enable(trace=True, max_trace_events=1_000_000):
+    """
+    Starts recording with a new Recorder.
+
+    Returns:
+    - recorder (Recorder): The active recorder.
+    """
+    global _recorder
+    _recorder = Recorder(trace=trace, max_trace_events=max_trace_events)
+    return _recorder
+
+def disable():
+    """
+    Stops recording.
+
+    Returns:
+    - recorder (Recorder): The recorder that was active, or None.
+    """
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+def is_enabled():
+    return _recorder is not None
+
+def get_recorder():
+    """Returns the active Recorder, or None while instrumentation is disabled."""
+    return _recorder
+
+def stage(name):
+    """
+    Times a block as a call of a stage, e.g. with stage("detect"): ...
+
+    While instrumentation is disabled this returns a shared no-op context manager.
+    """
+    if _recorder is None:
+        return _NULL_STAGE
+    return _Stage(_recorder, name)
+
+def timed(name):
+    """
+    Decorator that times every call of a function as a call of a stage.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return function(*args, **kwargs)
+            with _Stage(_recorder, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value=1):
+    """Adds value to a counter, if instrumentation is enabled."""
+    if _recorder is not None:
+        _recorder.count(name, value)
+
+def observe(name, value):
+    """Records a value of a histogram, if instrumentation is enabled."""
+    if _recorder is not None:
+        _recorder.observe(name, value)
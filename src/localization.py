@@ -0,0 +1,254 @@
+# src/localization.py
+#
+# Localizes the camera against a saved tag map (tag_positions.json), frame by frame.
+#
+# Usage: python -m src.localization --map tag_positions.json --video data/plantage_shed.mp4
+#
+# Latency target: LATENCY_TARGET_MS per frame from the decoded frame to the camera pose, detection
+# included, so the pose keeps up with a 30 fps camera. The PnP solve itself takes well under a
+# millisecond, detection dominates; use a larger quad_decimate with refine_corners to stay within
+# the target on large frames.
+
+import argparse
+import json
+import time
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from src.utils import load_calibration_data, get_D_and_K_from_calibration, iter_frames
+from src.april_tag import AprilTagDetector
+from src.stream import live_frames
+from src.geometry import invert_transforms
+from src.instrumentation import stage, count
+
+# Per frame, decoded frame to camera pose
+LATENCY_TARGET_MS = 33.0
+
+# Pose of the camera in the map, None fields if the frame had too few mapped tags
+CameraPose = namedtuple("CameraPose", ["transform", "position", "tag_ids", "inlier_tag_ids", "reprojection_error",
+                                       "warm_started"])
+
+def load_tag_map(map_path):
+    """
+    Loads a tag map into an array of tag corners indexed by tag ID.
+
+    Args:
+    - map_path (str): Path to the tag positions, see make_tag_data.
+
+    Returns:
+    - corners (numpy array): (max tag ID + 1)x4x3 corners in meters in the map frame, in detector
+        order (see get_tag_object_points), NaN for tags that are not in the map.
+    """
+    with open(map_path) as file:
+        tag_data = json.load(file)
+    max_id = max((tag["id"] for tag in tag_data), default=-1)
+    corners = np.full((max_id + 1, 4, 3), np.nan)
+    for tag in tag_data:
+        # The results list top-left, top-right, bottom-right, bottom-left, the detector the reverse
+        corners[tag["id"]] = np.asarray(tag["corners"], dtype=np.float64)[::-1] / 1000
+    return corners
+
+class Localizer:
+    """
+    Estimates the pose of the camera from the tags of a frame and a saved tag map.
+
+    All visible mapped tags are solved jointly with one PnP over their corners. The solve starts
+    from the pose of the previous frame when it still fits (warm start), otherwise from scratch
+    with SQPnP. RANSAC drops tags that don't fit the others, e.g. tags that were moved after
+    mapping. The warm start skips RANSAC on steady frames and keeps frames with a single far tag
+    from flipping to the mirrored pose; without RANSAC a cold SQPnP solve is about as fast.
+
+    Args:
+    - tag_map (numpy array): The corners of the mapped tags, see load_tag_map.
+    - detector (AprilTagDetector): The detector of the frames, its camera matrix is used.
+    - use_ransac (bool): Reject tags that disagree with the others. Default is False.
+    - ransac_error (float): Largest reprojection error in pixels of a RANSAC inlier. Default is 3.0.
+    - warm_start (bool): Start from the pose of the previous frame. Default is True.
+    - max_warm_start_error (float): Solve from scratch when the warm started pose has a larger
+        RMS reprojection error in pixels. Default is 2.0.
+    - min_tags (int): Fewest mapped tags a frame needs for a pose. Default is 1.
+    """
+    def __init__(self, tag_map, detector, use_ransac=False, ransac_error=3.0, warm_start=True,
+                 max_warm_start_error=2.0, min_tags=1):
+        self.tag_map = tag_map
+        self.detector = detector
+        self.K = np.asarray(detector.K, dtype=np.float64)
+        self.use_ransac = use_ransac
+        self.ransac_error = ransac_error
+        self.warm_start = warm_start
+        self.max_warm_start_error = max_warm_start_error
+        self.min_tags = min_tags
+        self.reset()
+
+    def reset(self):
+        """Forgets the previous pose, the next frame is solved from scratch."""
+        self.rvec = None
+        self.tvec = None
+
+    def _get_rms_error(self, object_points, image_points, rvec, tvec):
+        projected, _ = cv2.projectPoints(object_points, rvec, tvec, self.K, None)
+        return float(np.sqrt(np.mean(np.sum((projected.reshape(-1, 2) - image_points) ** 2, axis=1))))
+
+    def _solve(self, object_points, image_points):
+        # Returns rvec, tvec, which tags the pose fits and whether the previous pose was used
+        inlier_tags = np.ones(len(image_points) // 4, dtype=bool)
+        if self.warm_start and self.rvec is not None:
+            rvec, tvec = cv2.solvePnPRefineLM(object_points, image_points, self.K, None,
+                                              self.rvec.copy(), self.tvec.copy())
+            if self._get_rms_error(object_points, image_points, rvec, tvec) <= self.max_warm_start_error:
+                return rvec, tvec, inlier_tags, True
+
+        if self.use_ransac and len(inlier_tags) > 1:
+            found, rvec, tvec, inliers = cv2.solvePnPRansac(object_points, image_points, self.K, None,
+                                                            reprojectionError=self.ransac_error,
+                                                            iterationsCount=100,
+                                                            confidence=0.999)
+            if not found or inliers is None:
+                return None
+            # A tag is kept if all its corners fit
+            inlier_corners = np.zeros(len(image_points), dtype=bool)
+            inlier_corners[inliers.ravel()] = True
+            inlier_tags = inlier_corners.reshape(-1, 4).all(axis=1)
+            if inlier_tags.sum() < self.min_tags:
+                return None
+            object_points = object_points.reshape(-1, 4, 3)[inlier_tags].reshape(-1, 3)
+            image_points = image_points.reshape(-1, 4, 2)[inlier_tags].reshape(-1, 2)
+        else:
+            found, rvec, tvec = cv2.solvePnP(object_points, image_points, self.K, None, flags=cv2.SOLVEPNP_SQPNP)
+            if not found:
+                return None
+        rvec, tvec = cv2.solvePnPRefineLM(object_points, image_points, self.K, None, rvec, tvec)
+        return rvec, tvec, inlier_tags, False
+
+    def solve(self, detected_tags):
+        """
+        Estimates the camera pose from the tags detected in a frame.
+
+        Args:
+        - detected_tags (list): Detection or TagDetection objects with corners free of lens
+            distortion, as returned by AprilTagDetector.detect.
+
+        Returns:
+        - pose (CameraPose): The 4x4 transform from camera to map coordinates in millimeters, the
+            camera position in millimeters, the mapped tags of the frame, the tags the pose was
+            solved from, the RMS reprojection error in pixels and whether it was warm started.
+            The transform and position are None if the frame had too few mapped tags.
+        """
+        tag_ids = np.array([tag.tag_id for tag in detected_tags], dtype=np.int64)
+        known = tag_ids < len(self.tag_map)
+        known[known] = ~np.isnan(self.tag_map[tag_ids[known], 0, 0])
+        tag_ids = tag_ids[known]
+        if len(tag_ids) < max(1, self.min_tags):
+            count("frames without pose")
+            self.reset()
+            return CameraPose(None, None, tag_ids, tag_ids[:0], None, False)
+
+        object_points = self.tag_map[tag_ids].reshape(-1, 3)
+        image_points = np.concatenate([np.asarray(tag.corners, dtype=np.float64)
+                                       for tag, is_known in zip(detected_tags, known) if is_known])
+        with stage("localization"):
+            solution = self._solve(object_points, image_points)
+        if solution is None:
+            count("frames without pose")
+            self.reset()
+            return CameraPose(None, None, tag_ids, tag_ids[:0], None, False)
+        rvec, tvec, inlier_tags, warm_started = solution
+        self.rvec, self.tvec = rvec, tvec
+        error = self._get_rms_error(object_points.reshape(-1, 4, 3)[inlier_tags].reshape(-1, 3),
+                                    image_points.reshape(-1, 4, 2)[inlier_tags].reshape(-1, 2),
+                                    rvec, tvec)
+
+        # T_map_camera = inv(T_camera_map), in millimeters
+        transform = np.eye(4)
+        transform[:3, :3], _ = cv2.Rodrigues(rvec)
+        transform[:3, 3] = tvec.ravel()
+        transform = invert_transforms(transform[None])[0]
+        transform[:3, 3] *= 1000
+        return CameraPose(transform, transform[:3, 3].copy(), tag_ids, tag_ids[inlier_tags], error, warm_started)
+
+    def localize(self, frame):
+        """Detects the tags of a BGR or grayscale frame and estimates the camera pose, see solve."""
+        return self.solve(self.detector.detect(frame))
+
+def localize_video(video_path, localizer, stride=1):
+    """
+    Localizes the camera in every frame of a video.
+
+    Returns:
+    - poses (generator): (frame_index, pose, latency in milliseconds) tuples, the latency runs
+        from the decoded frame to the pose.
+    """
+    for frame_index, frame in iter_frames(video_path, stride=stride):
+        start = time.perf_counter()
+        pose = localizer.localize(frame)
+        yield frame_index, pose, (time.perf_counter() - start) * 1000
+
+def localize_live(source, localizer, buffer_size=2, policy="drop_oldest", realtime=None):
+    """
+    Localizes the camera in the frames of a live source as they are captured, see live_frames.
+
+    Returns:
+    - poses (generator): (frame_index, pose, latency in milliseconds) tuples, the latency runs
+        from the capture of the frame to the pose.
+    """
+    for frame_index, frame, capture_time in live_frames(source, buffer_size, policy, realtime):
+        pose = localizer.localize(frame)
+        yield frame_index, pose, (time.perf_counter() - capture_time) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Localize the camera of a video against a saved tag map.")
+    parser.add_argument("--map", default="tag_positions.json")
+    parser.add_argument("--video", required=True, help="video file, or camera index or stream URL with --live")
+    parser.add_argument("--live", action="store_true", help="read as a live source, files are played at real time")
+    parser.add_argument("--buffer", type=int, default=2, help="frames waiting for the detector in live mode")
+    parser.add_argument("--policy", default="drop_oldest", help="live mode with a full buffer: drop_oldest, drop_newest or block")
+    parser.add_argument("--calibration", default="data/cam.json")
+    parser.add_argument("--family", default="tagStandard52h13")
+    parser.add_argument("--tag-size", type=float, default=0.042, help="meter")
+    parser.add_argument("--quad-decimate", type=float, default=2.0)
+    parser.add_argument("--refine-corners", action="store_true")
+    parser.add_argument("--ransac", action="store_true")
+    parser.add_argument("--no-warm-start", action="store_true")
+    parser.add_argument("--output", default=None, help="save the camera positions of every frame as JSON")
+    args = parser.parse_args()
+
+    K, D, fx, fy, cx, cy = get_D_and_K_from_calibration(load_calibration_data(args.calibration))
+    detector = AprilTagDetector(tag_standard=args.family,
+                                K=K, D=D, fx=fx, fy=fy, cx=cx, cy=cy,
+                                tag_size=args.tag_size,
+                                quad_decimate=args.quad_decimate,
+                                undistort_mode="points",
+                                refine_corners=args.refine_corners)
+    localizer = Localizer(tag_map=load_tag_map(args.map),
+                          detector=detector,
+                          use_ransac=args.ransac,
+                          warm_start=not args.no_warm_start)
+
+    trajectory = []
+    latencies = []
+    if args.live:
+        poses = localize_live(args.video, localizer, buffer_size=args.buffer, policy=args.policy)
+    else:
+        poses = localize_video(args.video, localizer)
+    for frame_index, pose, latency in poses:
+        latencies.append(latency)
+        if pose.position is not None:
+            trajectory.append({"frame": frame_index,
+                               "position": pose.position.round(1).tolist(),
+                               "tags": len(pose.inlier_tag_ids),
+                               "error_px": round(pose.reprojection_error, 3)})
+    latencies = np.array(latencies)
+    if len(trajectory) == 0:
+        print(f".. no frames localized ({len(latencies)} frames read)")
+    else:
+        print(f".. localized {len(trajectory)}/{len(latencies)} frames, latency p50 {np.percentile(latencies, 50):.1f}ms "
+              f"p95 {np.percentile(latencies, 95):.1f}ms max {latencies.max():.1f}ms, target {LATENCY_TARGET_MS:.0f}ms")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(trajectory, file, indent=2)
+        print(f".. camera positions saved in {args.output}")
+
+if __name__ == "__main__":
+    main()
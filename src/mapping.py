@@ -0,0 +1,69 @@
+# src/mapping.py
+
+import numpy as np
+
+from src.tag_graph import TagGraph
+from src.geometry import calculate_tag_transforms
+from src.fusion import fuse_edge_transforms
+
+def map_tags(detected_tags, origin_tag, tag_graph=None, fuse_edges=False, optimize_map=False, K=None, tag_size=None):
+    """
+    Calculates the poses of all tags relative to the origin tag from the detections of a video.
+
+    The shortest path tree from the origin tag is chained together, with the relative transforms
+    of the tree edges fused over all frames if fuse_edges, and optionally refined by bundle
+    adjustment over every detection.
+
+    Args:
+    - detected_tags (DetectionStore): The detections of every frame.
+    - origin_tag (int): The tag ID of the origin.
+    - tag_graph (TagGraph): The graph of the detections. Default is built from detected_tags.
+    - fuse_edges (bool): Average every co-observation of a tag pair instead of using its best frame.
+        Default is False.
+    - optimize_map (bool): Refine all tag poses with bundle adjustment. Default is False.
+    - K (numpy array): The 3x3 camera matrix, needed for optimize_map.
+    - tag_size (float): The size of the tags (length of a side) in meters, needed for optimize_map.
+
+    Returns:
+    - tag_ids (numpy array): The tag IDs, starting with the origin tag. Empty, like the online map
+        of TagGraph.get_tag_transforms, if the origin tag was never seen together with another tag.
+    - transforms (numpy array): Nx4x4 transforms from tag to origin tag coordinates, in meters.
+    - report (dict): The report of optimize_tag_poses, None without optimize_map or with an empty map.
+    """
+    if tag_graph is None:
+        tag_graph = TagGraph()
+        for frame_index, tag_collection in detected_tags.frames():
+            tag_graph.add_frame(detected_tags=tag_collection,
+                                frame_index=frame_index)
+
+    ## Get the shortest path tree from the origin tag to all tags
+    parents, _ = tag_graph.shortest_path_tree(origin_tag)
+    if origin_tag not in parents:
+        print(f".. origin tag {origin_tag} was not detected together with any other tag, the map is empty")
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 4, 4)), None
+
+    ## Fuse the relative transforms of the tree edges over all frames both tags were seen in
+    edge_transforms = None
+    if fuse_edges:
+        tree_edges = [(tag, parent) for tag, (parent, _) in parents.items() if parent is not None]
+        edge_transforms, _ = fuse_edge_transforms(tag_collection=detected_tags,
+                                                  tag_graph=tag_graph,
+                                                  pairs=tree_edges)
+
+    ## Calculate position in reference to the origin tag based on shortest path, all tags at once
+    tag_ids, transforms = calculate_tag_transforms(tag_collection=detected_tags,
+                                                   parents=parents,
+                                                   origin_tag=origin_tag,
+                                                   edge_transforms=edge_transforms)
+
+    ## Jointly refine all tag poses, starting from the shortest path solution
+    report = None
+    if optimize_map:
+        # Imported on demand, scipy is the slowest import of the mapping path
+        from src.optimization import optimize_tag_poses
+        tag_ids, transforms, report = optimize_tag_poses(detection_store=detected_tags,
+                                                         tag_ids=tag_ids,
+                                                         transforms=transforms,
+                                                         K=K,
+                                                         tag_size=tag_size)
+    return tag_ids, transforms, report
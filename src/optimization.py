@@ -0,0 +1,297 @@
+# src/optimization.py
+
+import time
+
+import numpy as np
+from scipy.sparse import bsr_matrix, coo_matrix, diags
+from scipy.sparse.linalg import spsolve
+from scipy.spatial.transform import Rotation
+
+from src.geometry import get_local_corners, make_transforms, invert_transforms
+from src.instrumentation import timed
+
+# Step of the forward differences of the Jacobian, in radians and meters
+JACOBIAN_STEP = 1e-6
+
+def transforms_to_params(transforms):
+    """Turns Nx4x4 transforms into Nx6 parameters: rotation vector and translation."""
+    return np.hstack([Rotation.from_matrix(transforms[:, :3, :3]).as_rotvec(), transforms[:, :3, 3]])
+
+def params_to_transforms(params):
+    """Turns Nx6 parameters (rotation vector and translation) into Nx4x4 transforms."""
+    return make_transforms(Rotation.from_rotvec(params[:, :3]).as_matrix(), params[:, 3:])
+
+class PoseGraphProblem:
+    """
+    Sparse least squares problem over the poses of the nodes of a graph.
+
+    Every observation i relates two nodes, a[i] and b[i], and has residuals that only depend on
+    the poses of these two nodes. That fixes the sparsity pattern of the Jacobian: every residual
+    row has 6 non-zero columns per node. It also means all Jacobian blocks can be computed with
+    12 vectorized evaluations of the residuals, by perturbing one pose parameter of all a nodes
+    (or all b nodes) at the same time. Node 0 is held fixed.
+
+    Nodes from eliminate_from on (e.g. cameras) must only be connected to nodes before it (e.g.
+    tags). Their block of the normal equations is then block diagonal and is eliminated with the
+    Schur complement, so the sparse solve only involves the remaining nodes.
+
+    Args:
+    - initial_params (numpy array): Nx6 initial node poses, see transforms_to_params.
+    - nodes_a (numpy array): The first node of every observation.
+    - nodes_b (numpy array): The second node of every observation.
+    - residuals (callable): residuals(poses_a, poses_b) -> MxR residuals, with poses given as
+        Mx4x4 transforms of the nodes of the M observations.
+    - eliminate_from (int): First node that is eliminated with the Schur complement. Default is None.
+    """
+    def __init__(self, initial_params, nodes_a, nodes_b, residuals, eliminate_from=None):
+        self.eliminate_from = eliminate_from
+        self.fixed_params = initial_params[:1]
+        self.x0 = initial_params[1:].ravel()
+        self.nodes_a = np.asarray(nodes_a)
+        self.nodes_b = np.asarray(nodes_b)
+        self.residuals = residuals
+        self.n_observations = len(self.nodes_a)
+        self.n_residuals = self._residuals(initial_params[self.nodes_a], initial_params[self.nodes_b]).shape[1]
+
+        # Sparsity pattern: residual k of observation i depends on the 6 parameters of a[i] and b[i]
+        rows = np.arange(self.n_observations * self.n_residuals).reshape(self.n_observations, self.n_residuals)
+        rows = np.broadcast_to(rows[:, :, None], (self.n_observations, self.n_residuals, 12))
+        columns_a = (self.nodes_a[:, None] - 1) * 6 + np.arange(6)
+        columns_b = (self.nodes_b[:, None] - 1) * 6 + np.arange(6)
+        columns = np.concatenate([columns_a, columns_b], axis=1)
+        columns = np.broadcast_to(columns[:, None, :], rows.shape)
+        # Columns of the fixed node don't exist
+        self._pattern_mask = columns >= 0
+        self._pattern_rows = rows[self._pattern_mask]
+        self._pattern_columns = columns[self._pattern_mask]
+
+    def _node_params(self, x):
+        return np.vstack([self.fixed_params, x.reshape(-1, 6)])
+
+    def _residuals(self, params_a, params_b):
+        return self.residuals(params_to_transforms(params_a), params_to_transforms(params_b))
+
+    def fun(self, x):
+        params = self._node_params(x)
+        return self._residuals(params[self.nodes_a], params[self.nodes_b]).ravel()
+
+    def jac(self, x):
+        params = self._node_params(x)
+        params_a, params_b = params[self.nodes_a], params[self.nodes_b]
+        base = self._residuals(params_a, params_b)
+
+        values = np.empty((self.n_observations, self.n_residuals, 12))
+        for j in range(6):
+            perturbed = params_a.copy()
+            perturbed[:, j] += JACOBIAN_STEP
+            values[:, :, j] = (self._residuals(perturbed, params_b) - base) / JACOBIAN_STEP
+            perturbed = params_b.copy()
+            perturbed[:, j] += JACOBIAN_STEP
+            values[:, :, 6 + j] = (self._residuals(params_a, perturbed) - base) / JACOBIAN_STEP
+
+        return coo_matrix((values[self._pattern_mask], (self._pattern_rows, self._pattern_columns)),
+                          shape=(self.n_observations * self.n_residuals, len(self.x0))).tocsr()
+
+    def _solve_step(self, normal_matrix, rhs):
+        if self.eliminate_from is None:
+            return spsolve(normal_matrix, rhs)
+
+        # [[A, B], [B^T, C]] with C block diagonal: solve (A - B C^-1 B^T) x_a = rhs_a - B C^-1 rhs_c
+        split = (self.eliminate_from - 1) * 6
+        a_block = normal_matrix[:split, :split]
+        b_block = normal_matrix[:split, split:]
+        c_blocks = bsr_matrix(normal_matrix[split:, split:], blocksize=(6, 6))
+        c_blocks.sort_indices()
+        n_blocks = c_blocks.shape[0] // 6
+        c_inverse = bsr_matrix((np.linalg.inv(c_blocks.data), np.arange(n_blocks), np.arange(n_blocks + 1)),
+                               shape=c_blocks.shape).tocsc()
+        b_c_inverse = b_block @ c_inverse
+        schur = (a_block - b_c_inverse @ b_block.T).tocsc()
+        step_a = spsolve(schur, rhs[:split] - b_c_inverse @ rhs[split:])
+        step_c = c_inverse @ (rhs[split:] - b_block.T @ step_a)
+        return np.concatenate([step_a, step_c])
+
+    def robust_cost(self, residuals, f_scale):
+        """Huber cost of the residuals: quadratic up to f_scale, linear beyond."""
+        absolute = np.abs(residuals)
+        return float(np.sum(np.where(absolute <= f_scale,
+                                     0.5 * residuals ** 2,
+                                     f_scale * (absolute - 0.5 * f_scale))))
+
+    def solve(self, f_scale=1.0, max_iterations=50, tolerance=1e-6, damping=1e-4):
+        """
+        Solves the problem with Levenberg-Marquardt and iteratively reweighted least squares for
+        the Huber loss. Every step solves the sparse normal equations with a sparse direct solver,
+        whose cost grows about linearly with the number of observations for video sequences,
+        where every camera only sees a few neighboring tags.
+
+        Args:
+        - f_scale (float): Residual size where the Huber loss turns linear. Default is 1.0.
+        - max_iterations (int): Maximum number of Jacobian evaluations. Default is 50.
+        - tolerance (float): Stop when a step reduces the cost by less than this fraction. Default is 1e-6.
+        - damping (float): Initial Levenberg-Marquardt damping. Default is 1e-4.
+
+        Returns:
+        - params (numpy array): Nx6 optimized node poses, node 0 unchanged.
+        - report (dict): Cost, iteration counts and timing of the solve.
+        """
+        start = time.perf_counter()
+        x = self.x0
+        residuals = self.fun(x)
+        cost = initial_cost = self.robust_cost(residuals, f_scale)
+        iterations = 0
+        function_evaluations = 1
+        converged = False
+
+        while iterations < max_iterations and not converged:
+            jacobian = self.jac(x)
+            iterations += 1
+            # Huber weights, observations far off count less
+            weights = np.minimum(1.0, f_scale / np.maximum(np.abs(residuals), 1e-12))
+            weighted_jacobian = jacobian.multiply(weights[:, None]).tocsr()
+            gradient = weighted_jacobian.T @ residuals
+            normal_matrix = (jacobian.T @ weighted_jacobian).tocsc()
+            diagonal = normal_matrix.diagonal() + 1e-12
+
+            while True:
+                step = self._solve_step(normal_matrix + diags(damping * diagonal, format="csc"), -gradient)
+                new_x = x + step
+                new_residuals = self.fun(new_x)
+                function_evaluations += 1
+                new_cost = self.robust_cost(new_residuals, f_scale)
+                if new_cost < cost:
+                    converged = (cost - new_cost) < tolerance * cost
+                    x, residuals, cost = new_x, new_residuals, new_cost
+                    damping = max(damping / 10, 1e-12)
+                    break
+                damping *= 10
+                if damping > 1e12:
+                    # No step reduces the cost anymore
+                    converged = True
+                    break
+
+        report = {
+            "observations": self.n_observations,
+            "residuals": int(residuals.size),
+            "parameters": int(len(self.x0)),
+            "initial_cost": initial_cost,
+            "final_cost": cost,
+            "final_rms": float(np.sqrt(np.mean(residuals ** 2))),
+            "iterations": iterations,
+            "function_evaluations": function_evaluations,
+            "converged": converged,
+            "time_s": time.perf_counter() - start,
+        }
+        return self._node_params(x), report
+
+@timed("optimization")
+def optimize_tag_poses(detection_store, tag_ids, transforms, K, tag_size, refine_cameras=True,
+                       f_scale=None, max_iterations=50):
+    """
+    Jointly refines the poses of all tags of a map from every detection.
+
+    Starts from an initial map, e.g. the shortest path solution of calculate_tag_transforms, whose
+    first tag is the origin and stays fixed. Two formulations are available:
+    - refine_cameras=True: bundle adjustment, the camera pose of every frame is estimated as well
+        and the reprojection error of every detected corner (in pixels) is minimized.
+    - refine_cameras=False: pose graph, for every pair of tags seen in the same frame the corners
+        of one tag predicted by the map are compared to their position measured in that frame
+        (in millimeters). No camera poses are estimated.
+
+    Args:
+    - detection_store (DetectionStore): The detections of every frame.
+    - tag_ids (numpy array): The tags of the initial map, starting with the origin tag.
+    - transforms (numpy array): Nx4x4 initial transforms from tag to origin tag coordinates, in meters.
+    - K (numpy array): The 3x3 camera matrix of the (undistorted) detected corners.
+    - tag_size (float): The size of the tag (length of a side) in meters.
+    - refine_cameras (bool): Estimate camera poses and minimize the reprojection error. Default is True.
+    - f_scale (float): Residual size where the Huber loss turns linear. Default is 3 pixels or 3 mm.
+    - max_iterations (int): Maximum number of solver iterations. Default is 50.
+
+    Returns:
+    - tag_ids (numpy array): The same tag IDs.
+    - transforms (numpy array): Nx4x4 optimized transforms from tag to origin tag coordinates.
+    - report (dict): Cost, iteration counts and timing of the solve. With refine_cameras, also
+        "camera_frame_indexes" and "camera_transforms" (Mx4x4, from origin tag to camera coordinates).
+        Without observations the map is returned unchanged and "final_rms" is None.
+    """
+    tag_ids = np.asarray(tag_ids, dtype=np.int64)
+    records = detection_store.records
+
+    # Only detections of tags in the map take part, sorted by (frame, tag) like the store
+    order = np.argsort(tag_ids)
+    positions = np.searchsorted(tag_ids[order], records["tag_id"])
+    positions = np.minimum(positions, len(tag_ids) - 1)
+    in_map = tag_ids[order][positions] == records["tag_id"] if len(tag_ids) else np.zeros(len(records), dtype=bool)
+    records = records[in_map]
+    tag_nodes = order[positions[in_map]]
+    observed_poses = make_transforms(records["pose_R"], records["pose_t"])
+
+    if refine_cameras:
+        # Nodes: the tags, then one camera per frame
+        frame_indexes, first_rows, camera_numbers = np.unique(records["frame_index"],
+                                                              return_index=True, return_inverse=True)
+        # Warm start every camera from the first mapped tag it saw: T_camera_world = T_camera_tag @ inv(T_world_tag)
+        camera_transforms = observed_poses[first_rows] @ invert_transforms(transforms[tag_nodes[first_rows]])
+        initial_params = transforms_to_params(np.concatenate([transforms, camera_transforms]))
+        nodes_a = tag_nodes
+        nodes_b = len(tag_ids) + camera_numbers
+        # Corners of a tag in detector order, the order of the detected pixel corners
+        local_corners = get_local_corners(tag_size)[::-1]
+        observed_corners = records["corners"].astype(np.float64)
+        fx, fy, cx, cy = K[0, 0], K[1, 1], K[0, 2], K[1, 2]
+
+        def residuals(tag_poses, camera_poses):
+            # Tag corners in world, then in camera coordinates, then projected into the image
+            world_corners = local_corners @ np.swapaxes(tag_poses[:, :3, :3], 1, 2) + tag_poses[:, None, :3, 3]
+            camera_corners = world_corners @ np.swapaxes(camera_poses[:, :3, :3], 1, 2) + camera_poses[:, None, :3, 3]
+            depth = np.maximum(camera_corners[:, :, 2], 1e-6)
+            pixels = np.stack([fx * camera_corners[:, :, 0] / depth + cx,
+                               fy * camera_corners[:, :, 1] / depth + cy], axis=2)
+            return (pixels - observed_corners).reshape(len(tag_poses), 8)
+    else:
+        # Observations: every pair of mapped tags detected in the same frame
+        frame_starts = np.flatnonzero(np.diff(records["frame_index"], prepend=-1))
+        frame_sizes = np.diff(np.append(frame_starts, len(records)))
+        firsts, seconds = [], []
+        for start, size in zip(frame_starts, frame_sizes):
+            first, second = np.triu_indices(size, k=1)
+            firsts.append(start + first)
+            seconds.append(start + second)
+        firsts = np.concatenate(firsts) if firsts else np.zeros(0, dtype=np.int64)
+        seconds = np.concatenate(seconds) if seconds else np.zeros(0, dtype=np.int64)
+        # Measured T_a_b = inv(T_camera_a) @ T_camera_b
+        measured = invert_transforms(observed_poses[firsts]) @ observed_poses[seconds]
+        initial_params = transforms_to_params(transforms)
+        nodes_a = tag_nodes[firsts]
+        nodes_b = tag_nodes[seconds]
+        local_corners = get_local_corners(tag_size)
+        measured_corners = np.einsum("nij,cj->nci", measured[:, :3, :3], local_corners) + measured[:, None, :3, 3]
+
+        def residuals(poses_a, poses_b):
+            relative = invert_transforms(poses_a) @ poses_b
+            corners = local_corners @ np.swapaxes(relative[:, :3, :3], 1, 2) + relative[:, None, :3, 3]
+            return (corners - measured_corners).reshape(len(poses_a), 12) * 1000  # Convert to millimeters
+
+    f_scale = 3.0 if f_scale is None else f_scale
+    if len(nodes_a) == 0:
+        # Nothing to refine, the report has the keys of a solve
+        report = {"observations": 0, "residuals": 0, "parameters": 0, "initial_cost": 0.0, "final_cost": 0.0,
+                  "final_rms": None, "iterations": 0, "function_evaluations": 0, "converged": True, "time_s": 0.0}
+        if refine_cameras:
+            report["camera_frame_indexes"] = frame_indexes
+            report["camera_transforms"] = np.zeros((0, 4, 4))
+        return tag_ids, transforms, report
+
+    problem = PoseGraphProblem(initial_params=initial_params,
+                               nodes_a=nodes_a,
+                               nodes_b=nodes_b,
+                               residuals=residuals,
+                               eliminate_from=len(tag_ids) if refine_cameras else None)
+    params, report = problem.solve(f_scale=f_scale, max_iterations=max_iterations)
+    node_transforms = params_to_transforms(params)
+
+    if refine_cameras:
+        report["camera_frame_indexes"] = frame_indexes
+        report["camera_transforms"] = node_transforms[len(tag_ids):]
+    return tag_ids, node_transforms[:len(tag_ids)], report
@@ -0,0 +1,162 @@
+# src/pipeline.py
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from src.utils import load_video, get_frame_range, iter_frames
+from src.april_tag import AprilTagDetector, compact_detection
+from src.tracking import TagTracker
+from src.frame_selection import select_frames
+from src.shared_frames import detect_tags_shared
+from src import instrumentation
+
+# Detector of the current worker process, built once by the pool initializer
+_worker_detector = None
+
+def _init_worker(detector_settings=None, instrument=False, trace=True):
+    global _worker_detector
+    if detector_settings is not None:
+        _worker_detector = AprilTagDetector(**detector_settings)
+    if instrument:
+        # Records of the worker are sent back with the results of every chunk
+        instrumentation.enable(trace=trace)
+
+def _iter_detections(detector, video_path, start_frame, stop_frame, stride, prefetch=0, tracking=None,
+                     selection=None):
+    # Decode, grayscale, undistort and detect a range of the video in this process
+    if tracking is not None:
+        # Every range starts with a full-frame detection
+        detector = TagTracker(detector, **tracking)
+    frames = iter_frames(video_path=video_path,
+                         start_frame=start_frame,
+                         stop_frame=stop_frame,
+                         stride=stride,
+                         prefetch=prefetch)
+    if selection is not None:
+        # Drop near-duplicate and blurred frames before they reach the detector
+        frames = select_frames(frames, **selection)
+    for frame_index, frame in frames:
+        start_ns = time.perf_counter_ns()
+        detected_tags = [compact_detection(tag) for tag in detector.detect(frame)]
+        recorder = instrumentation.get_recorder()
+        if recorder is not None:
+            # Latency from the decoded frame to its detections
+            recorder.add_duration("frame", start_ns, time.perf_counter_ns())
+            recorder.observe("tags per frame", len(detected_tags))
+        yield frame_index, detected_tags
+
+def _detect_frame_range(video_path, start_frame, stop_frame, stride, tracking=None, selection=None):
+    results = list(_iter_detections(_worker_detector, video_path, start_frame, stop_frame, stride,
+                                    tracking=tracking, selection=selection))
+    recorder = instrumentation.get_recorder()
+    return results, None if recorder is None else recorder.drain()
+
+def _detect_chunk(detector_settings, video_path, start_frame, stop_frame, stride, tracking=None, selection=None):
+    # A chunk of any video, the detector settings come with the task (see src/batch.py)
+    start = time.perf_counter()
+    detector = AprilTagDetector(**detector_settings)
+    results = list(_iter_detections(detector, video_path, start_frame, stop_frame, stride,
+                                    tracking=tracking, selection=selection))
+    recorder = instrumentation.get_recorder()
+    return results, None if recorder is None else recorder.drain(), time.perf_counter() - start
+
+def split_frame_range(start_frame, stop_frame, chunk_size, stride=1):
+    """
+    Splits a frame window into consecutive chunks.
+
+    Every chunk starts on a frame that is selected by the stride, so decoding the chunks
+    separately yields exactly the frames a single pass over the window would.
+
+    Args:
+    - start_frame (int): First frame of the window.
+    - stop_frame (int): End of the window (exclusive).
+    - chunk_size (int): Approximate number of frames per chunk.
+    - stride (int): Use every n-th frame of the window.
+
+    Returns:
+    - chunks (list of tuples): (start_frame, stop_frame) of every chunk, in order.
+    """
+    chunk_size = max(stride, chunk_size - chunk_size % stride)
+    return [(start, min(start + chunk_size, stop_frame))
+            for start in range(start_frame, stop_frame, chunk_size)]
+
+# How frames get to the worker processes:
+# - "chunks": every worker decodes its own range of frames, needs the length of the video
+# - "shared_memory": one decoder writes gray frames into shared memory, the workers detect on views of it
+TRANSPORTS = ("chunks", "shared_memory")
+
+def detect_tags_in_video(video_path, detector_settings, workers=1, chunk_size=256, stride=1,
+                         start_frame=0, stop_frame=None, prefetch=8, tracking=None,
+                         selection=None, transport="chunks"):
+    """
+    Detects the tags in every selected frame of a video, optionally in parallel.
+
+    The video is split into frame ranges which are decoded and detected in worker processes,
+    each with its own long-lived detector. The results are yielded in frame order, so they can
+    be merged directly into TagGraph.add_frame. With workers=1 everything runs in this process.
+    With transport="shared_memory" the video is decoded once in this process and the gray frames
+    are passed to the workers through shared memory (see detect_tags_shared), which also
+    parallelizes videos of unknown length.
+
+    Args:
+    - video_path (str): Path to the video file.
+    - detector_settings (dict): Keyword arguments for AprilTagDetector.
+    - workers (int): Number of worker processes. Default is 1.
+    - chunk_size (int): Number of frames per task. Default is 256.
+    - stride (int): Use every n-th frame. Default is 1.
+    - start_frame (int): First frame to process. Default is 0.
+    - stop_frame (int): Frame to stop at (exclusive). Default is the end of the video.
+    - prefetch (int): Frames decoded ahead in the background when running in this process. Default is 8.
+    - tracking (dict): Keyword arguments for TagTracker to search only around the tags of the previous
+        frames, or None to search every full frame. Default is None.
+    - selection (dict): Keyword arguments for FrameSelector to skip near-duplicate and blurred frames,
+        or None to detect every frame. Default is None.
+    - transport (str): How the workers get their frames, one of TRANSPORTS. Default is "chunks".
+
+    Returns:
+    - results (generator): (frame_index, list of TagDetection) tuples in frame order, only for
+        the selected frames if selection is used.
+    """
+    if transport not in TRANSPORTS:
+        raise ValueError(f"Unknown transport {transport}, use one of {TRANSPORTS}")
+    if transport == "shared_memory" and tracking is not None and workers > 1:
+        raise ValueError("Tracking needs consecutive frames in one detector, use the chunks transport")
+    video = load_video(video_path)
+    start_frame, stop_frame = get_frame_range(video, start_frame, stop_frame)
+    video.release()
+
+    if workers <= 1 or (stop_frame is None and transport == "chunks"):
+        # Length unknown or nothing to parallelize, decode in a single pass
+        detector = AprilTagDetector(**detector_settings)
+        yield from _iter_detections(detector, video_path, start_frame, stop_frame, stride,
+                                    prefetch=prefetch, tracking=tracking, selection=selection)
+        return
+
+    if detector_settings.get("nthreads") is None:
+        # Share the cores between the worker processes
+        detector_settings = dict(detector_settings, nthreads=max(1, (os.cpu_count() or 1) // workers))
+
+    if transport == "shared_memory":
+        yield from detect_tags_shared(video_path, detector_settings, workers=workers, stride=stride,
+                                      start_frame=start_frame, stop_frame=stop_frame, selection=selection)
+        return
+
+    chunks = split_frame_range(start_frame, stop_frame, chunk_size, stride)
+    recorder = instrumentation.get_recorder()
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(detector_settings,
+                                       recorder is not None,
+                                       recorder is None or recorder.trace)) as executor:
+        # map keeps the order of the chunks
+        for results, worker_records in executor.map(_detect_frame_range,
+                                                    [video_path] * len(chunks),
+                                                    [start for start, _ in chunks],
+                                                    [stop for _, stop in chunks],
+                                                    [stride] * len(chunks),
+                                                    [tracking] * len(chunks),
+                                                    [selection] * len(chunks)):
+            if worker_records is not None and recorder is not None:
+                recorder.merge(worker_records)
+            yield from results
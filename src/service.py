@@ -0,0 +1,310 @@
+# src/service.py
+#
+# Long-running local service that keeps the imports, calibrations and detectors loaded, so short
+# jobs don't pay the startup of python main.py every time.
+#
+# Usage: python -m src.service --port 8765
+# Client: python -m src.client map data/plantage_shed.mp4 --origin-tag 3
+#
+# Endpoints (JSON, local HTTP):
+# - GET  /status  settings, uptime and number of served jobs
+# - POST /map     body: a job like a manifest entry of src/batch.py. Streams newline separated
+#                 JSON: {"frame": ..., "tags": [...]} per frame if "stream_detections" is true,
+#                 then {"tag_positions": [...], ...} or {"error": ...}
+# - POST /detect  body: an encoded image (PNG, JPEG) or raw 8-bit pixels with ?width=&height=,
+#                 settings as query parameters (calibration_path, tag_size, tag_standard, ...).
+#                 Returns {"tags": [...]}
+
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import numpy as np
+
+from src.utils import load_calibration_data
+from src.april_tag import AprilTagDetector
+from src.pipeline import detect_tags_in_video
+from src.detection_store import DetectionStore, get_detection_cache_path
+from src.geometry import make_tag_data
+from src.mapping import map_tags
+from src.batch import DEFAULT_JOB_SETTINGS, get_job_settings
+
+def tag_to_dict(tag):
+    """Converts a Detection or TagDetection to plain JSON types."""
+    pose_R = getattr(tag, "pose_R", None)
+    pose_t = getattr(tag, "pose_t", None)
+    return {"id": int(tag.tag_id),
+            "corners": np.asarray(tag.corners).tolist(),
+            "center": np.asarray(tag.center).tolist(),
+            "decision_margin": float(tag.decision_margin),
+            "pose_R": None if pose_R is None else np.asarray(pose_R).tolist(),
+            "pose_t": None if pose_t is None else np.asarray(pose_t).ravel().tolist()}
+
+class DetectionService:
+    """
+    State of the service: the loaded calibrations and the settings of every request.
+
+    Detectors are cached per settings by get_detector, so only the first job of a tag family pays
+    for its lookup tables. Jobs run one at a time, a detector must not be used by several
+    threads at once.
+
+    Args:
+    - defaults (dict): Settings of jobs that don't give them, on top of DEFAULT_JOB_SETTINGS.
+    - cache_dir (str): Folder of the detection cache, None to always detect. Default is None.
+    - workers (int): Worker processes per video. Default is 1, short clips are faster without
+        starting a pool.
+    - nthreads (int): Threads of the detector, None for all cores. Default is None.
+    """
+    def __init__(self, defaults=None, cache_dir=None, workers=1, nthreads=None):
+        self.defaults = {**DEFAULT_JOB_SETTINGS, **(defaults or {})}
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.nthreads = nthreads
+        self.lock = threading.Lock()
+        self.calibrations = {}
+        self.start_time = time.time()
+        self.jobs_served = 0
+
+    def get_job(self, job):
+        """Fills in the default settings of a job and loads its calibration."""
+        job = {**self.defaults, **job}
+        path = job["calibration_path"]
+        if path not in self.calibrations:
+            self.calibrations[path] = load_calibration_data(path)
+        return job, self.calibrations[path]
+
+    def warm_up(self):
+        """Loads the default calibration and builds the default detector, before the first job."""
+        job, calibration_data = self.get_job({})
+        detector_settings, _, _ = get_job_settings(job, calibration_data, nthreads=self.nthreads)
+        detector = AprilTagDetector(**detector_settings)
+        detector.detect(np.zeros((64, 64), dtype=np.uint8))
+        print(f".. detector {job['tag_standard']} and calibration {job['calibration_path']} loaded")
+
+    def status(self):
+        return {"uptime_s": time.time() - self.start_time,
+                "jobs_served": self.jobs_served,
+                "busy": self.lock.locked(),
+                "calibrations": list(self.calibrations),
+                "defaults": self.defaults}
+
+    def map_video(self, job):
+        """
+        Detects and maps the tags of a video.
+
+        Args:
+        - job (dict): The settings of the job, video_path and origin_tag are required.
+
+        Returns:
+        - messages (generator): A {"frame", "tags"} dict per frame if job["stream_detections"], then
+            a dict with the tag positions and the timings.
+        """
+        start = time.perf_counter()
+        job, calibration_data = self.get_job(job)
+        for key in ("video_path", "origin_tag"):
+            if job.get(key) is None:
+                raise ValueError(f"The job has no {key}")
+        detector_settings, tracking, selection = get_job_settings(job, calibration_data, nthreads=self.nthreads)
+
+        with self.lock:
+            cache_path = None
+            if self.cache_dir is not None:
+                cache_path = get_detection_cache_path(cache_dir=self.cache_dir,
+                                                      video_path=job["video_path"],
+                                                      calibration_data=calibration_data,
+                                                      detector_settings=detector_settings,
+                                                      stride=job["frame_stride"],
+                                                      tracking=tracking,
+                                                      selection=selection)
+            cached = cache_path is not None and os.path.exists(cache_path)
+            if cached:
+                detected_tags = DetectionStore.load(cache_path)
+                if job.get("stream_detections"):
+                    for frame_index, tag_collection in detected_tags.frames():
+                        yield {"frame": int(frame_index), "tags": [tag_to_dict(tag) for tag in tag_collection]}
+            else:
+                detected_tags = DetectionStore()
+                for frame_index, tag_collection in detect_tags_in_video(video_path=job["video_path"],
+                                                                        detector_settings=detector_settings,
+                                                                        workers=job.get("workers", self.workers),
+                                                                        stride=job["frame_stride"],
+                                                                        tracking=tracking,
+                                                                        selection=selection):
+                    detected_tags.add_frame(frame_index=frame_index, detected_tags=tag_collection)
+                    if job.get("stream_detections"):
+                        yield {"frame": int(frame_index), "tags": [tag_to_dict(tag) for tag in tag_collection]}
+                if cache_path is not None:
+                    detected_tags.save(cache_path)
+            detection_seconds = time.perf_counter() - start
+
+            tag_ids, transforms, _ = map_tags(detected_tags=detected_tags,
+                                              origin_tag=job["origin_tag"],
+                                              fuse_edges=job["fuse_edges"],
+                                              optimize_map=job["optimize_map"],
+                                              K=detector_settings["K"],
+                                              tag_size=job["tag_size"])
+            self.jobs_served += 1
+        yield {"tag_positions": make_tag_data(tag_ids=tag_ids,
+                                              transforms=transforms,
+                                              tag_size_mm=job["tag_size"] * 1000),
+               "detections": len(detected_tags),
+               "cached": cached,
+               "detection_s": detection_seconds,
+               "total_s": time.perf_counter() - start}
+
+    def detect_frame(self, frame, settings):
+        """
+        Detects the tags in a single frame.
+
+        Args:
+        - frame (numpy array): The BGR or grayscale frame.
+        - settings (dict): Settings of the job, see DEFAULT_JOB_SETTINGS.
+
+        Returns:
+        - tags (list of dicts): The detected tags, see tag_to_dict.
+        """
+        job, calibration_data = self.get_job(settings)
+        detector_settings, _, _ = get_job_settings(job, calibration_data, nthreads=self.nthreads)
+        with self.lock:
+            detected_tags = AprilTagDetector(**detector_settings).detect(frame)
+            self.jobs_served += 1
+        return [tag_to_dict(tag) for tag in detected_tags]
+
+def _parse_setting(value):
+    # Query parameters are strings, settings are JSON values
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def decode_frame(body, query):
+    """
+    Decodes the frame of a /detect request.
+
+    Args:
+    - body (bytes): An encoded image, or raw 8-bit gray or BGR pixels.
+    - query (dict): The query parameters, width and height are required for raw pixels.
+
+    Returns:
+    - frame (numpy array): The grayscale (or raw BGR) frame.
+    """
+    if "width" in query and "height" in query:
+        width, height = int(query["width"]), int(query["height"])
+        channels = len(body) // (width * height)
+        if channels not in (1, 3) or len(body) != width * height * channels:
+            raise ValueError(f"{len(body)} bytes is not a {width}x{height} gray or BGR frame")
+        shape = (height, width) if channels == 1 else (height, width, 3)
+        return np.frombuffer(body, dtype=np.uint8).reshape(shape)
+    # Decoded straight to gray, the detector needs nothing else
+    frame = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if frame is None:
+        raise ValueError("The body is not an image")
+    return frame
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    # The DetectionService is set on the server, see serve
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/status":
+            self._send_json(self.server.service.status())
+        else:
+            self._send_json({"error": f"Unknown path {self.path}"}, status=404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            if url.path == "/map":
+                self._map(json.loads(self._read_body() or b"{}"))
+            elif url.path == "/detect":
+                frame = decode_frame(self._read_body(), query)
+                settings = {key: _parse_setting(value) for key, value in query.items()
+                            if key not in ("width", "height")}
+                self._send_json({"tags": self.server.service.detect_frame(frame, settings)})
+            else:
+                self._send_json({"error": f"Unknown path {url.path}"}, status=404)
+        except Exception as error:
+            traceback.print_exc()
+            self._send_json({"error": f"{type(error).__name__}: {error}"}, status=400)
+
+    def _map(self, job):
+        messages = self.server.service.map_video(job)
+        # Errors up to the first message (bad settings, missing video) still get a 400
+        first = next(messages)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        # Streamed as lines, the end of the response is the closed connection (HTTP/1.0)
+        try:
+            self.wfile.write(json.dumps(first).encode() + b"\n")
+            self.wfile.flush()
+            for message in messages:
+                self.wfile.write(json.dumps(message).encode() + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away, stop the job
+            messages.close()
+        except Exception as error:
+            traceback.print_exc()
+            self.wfile.write(json.dumps({"error": f"{type(error).__name__}: {error}"}).encode() + b"\n")
+
+    def log_message(self, format, *args):
+        print(f".. {self.address_string()} {format % args}")
+
+def serve(host="127.0.0.1", port=8765, service=None):
+    """
+    Runs the service until interrupted.
+
+    Args:
+    - host (str): Address to listen on, keep it local. Default is "127.0.0.1".
+    - port (int): Port to listen on. Default is 8765.
+    - service (DetectionService): The service state. Default is a DetectionService with the defaults.
+    """
+    service = service or DetectionService()
+    service.warm_up()
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    server.service = service
+    print(f".. serving on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the detector loaded and map videos on request.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--defaults", default=None, help="JSON file with default job settings, see src/batch.py")
+    parser.add_argument("--cache-dir", default=".detection_cache")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes per video")
+    args = parser.parse_args()
+
+    defaults = None
+    if args.defaults:
+        with open(args.defaults) as file:
+            defaults = json.load(file)
+    serve(host=args.host,
+          port=args.port,
+          service=DetectionService(defaults=defaults, cache_dir=args.cache_dir, workers=args.workers))
+
+if __name__ == "__main__":
+    main()
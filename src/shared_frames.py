@@ -0,0 +1,210 @@
+# src/shared_frames.py
+#
+# Frame transport between one decoder and many detection worker processes through a ring of
+# grayscale frame slots in shared memory. The decoder converts every frame to gray straight into
+# a free slot, the workers detect on a NumPy view of the slot, so a frame is never pickled or
+# copied between processes. The number of slots bounds the memory, and the decoder waits for a
+# free slot when the workers fall behind (backpressure).
+
+import itertools
+import multiprocessing
+import queue
+import threading
+import traceback
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from src.utils import iter_frames
+from src.april_tag import AprilTagDetector, compact_detection
+from src.frame_selection import FrameSelector
+from src import instrumentation
+
+# How long the parent waits for a result before it checks that the workers are still alive, in seconds
+WORKER_POLL_SECONDS = 0.5
+
+class SharedFrameRing:
+    """
+    Ring of grayscale frame slots in a shared memory block.
+
+    Args:
+    - n_slots (int): Number of frames the ring holds.
+    - frame_shape (tuple): (height, width) of the frames.
+    - name (str): Name of an existing block to attach to, None to create a new one. Default is None.
+    """
+    def __init__(self, n_slots, frame_shape, name=None):
+        self.n_slots = n_slots
+        self.frame_shape = tuple(frame_shape)
+        size = n_slots * self.frame_shape[0] * self.frame_shape[1]
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size)
+        self.frames = np.ndarray((n_slots,) + self.frame_shape, dtype=np.uint8, buffer=self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def slot(self, index):
+        """Returns the frame of a slot as a view into the shared memory, no copy."""
+        return self.frames[index]
+
+    def close(self):
+        """Detaches from the block, the creator also frees it."""
+        # The views keep the buffer alive, drop them first
+        self.frames = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+def _ring_worker(ring_name, n_slots, frame_shape, detector_settings, ready_slots, free_slots, results,
+                 instrument=False, trace=True):
+    # Detects the frames of the ring until the decoder sends None
+    ring = SharedFrameRing(n_slots, frame_shape, name=ring_name)
+    if instrument:
+        instrumentation.enable(trace=trace)
+    try:
+        detector = AprilTagDetector(**detector_settings)
+        while True:
+            item = ready_slots.get()
+            if item is None:
+                break
+            slot, frame_index = item
+            try:
+                detected_tags = [compact_detection(tag) for tag in detector.detect(ring.slot(slot))]
+            finally:
+                # The tags don't reference the frame, the slot can be reused
+                free_slots.put(slot)
+            results.put(("frame", (frame_index, detected_tags)))
+        recorder = instrumentation.get_recorder()
+        results.put(("done", None if recorder is None else recorder.drain()))
+    except Exception:
+        results.put(("error", traceback.format_exc()))
+    finally:
+        ring.close()
+
+def detect_tags_shared(video_path, detector_settings, workers=2, n_slots=None, stride=1, start_frame=0,
+                       stop_frame=None, selection=None):
+    """
+    Detects the tags of a video with one decoder thread and worker processes fed through a
+    SharedFrameRing.
+
+    Unlike the frame ranges of detect_tags_in_video the video is decoded in a single pass, so this
+    also works for videos of unknown length. Tracking needs consecutive frames in one detector and
+    is not supported; selection runs in the decoder, dropped frames never reach the ring.
+
+    Args:
+    - video_path (str): Path to the video file.
+    - detector_settings (dict): Keyword arguments for AprilTagDetector.
+    - workers (int): Number of worker processes. Default is 2.
+    - n_slots (int): Number of frame slots. Default is 2 per worker.
+    - stride (int): Use every n-th frame. Default is 1.
+    - start_frame (int): First frame to process. Default is 0.
+    - stop_frame (int): Frame to stop at (exclusive). Default is the end of the video.
+    - selection (dict): Keyword arguments for FrameSelector, or None to detect every frame.
+
+    Returns:
+    - results (generator): (frame_index, list of TagDetection) tuples in frame order.
+    """
+    frames = iter_frames(video_path=video_path, start_frame=start_frame, stop_frame=stop_frame, stride=stride)
+    first = next(frames, None)
+    if first is None:
+        return
+    n_slots = n_slots or 2 * workers
+    ring = SharedFrameRing(n_slots, first[1].shape[:2])
+    ready_slots = multiprocessing.Queue()
+    free_slots = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for slot in range(n_slots):
+        free_slots.put(slot)
+
+    recorder = instrumentation.get_recorder()
+    # Started before the decoder thread, forking a process with running threads is unsafe
+    processes = [multiprocessing.Process(target=_ring_worker,
+                                         args=(ring.name, n_slots, ring.frame_shape, detector_settings,
+                                               ready_slots, free_slots, results,
+                                               recorder is not None, recorder is None or recorder.trace),
+                                         daemon=True)
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+
+    submitted = []  # frame indexes in decoding order, appended by the decoder thread
+    stop = threading.Event()
+    decoder_error = []
+
+    def decode():
+        selector = None if selection is None else FrameSelector(**selection)
+        try:
+            for frame_index, frame in itertools.chain([first], frames):
+                if stop.is_set():
+                    break
+                if selector is not None:
+                    with instrumentation.stage("frame selection"):
+                        selected = selector.select(frame)
+                    if not selected:
+                        instrumentation.count("frames skipped")
+                        continue
+                # Backpressure: wait until a worker hands a slot back
+                slot = None
+                while slot is None and not stop.is_set():
+                    try:
+                        slot = free_slots.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                if slot is None:
+                    break
+                with instrumentation.stage("grayscale"):
+                    cv2.cvtColor(src=frame, code=cv2.COLOR_BGR2GRAY, dst=ring.slot(slot))
+                submitted.append(frame_index)
+                ready_slots.put((slot, frame_index))
+        except Exception as error:
+            decoder_error.append(error)
+        finally:
+            frames.close()
+            for _ in processes:
+                ready_slots.put(None)
+
+    thread = threading.Thread(target=decode, name="shared-frame-decoder", daemon=True)
+    thread.start()
+
+    pending = {}
+    next_position = 0
+    running = len(processes)
+    try:
+        while running:
+            try:
+                kind, payload = results.get(timeout=WORKER_POLL_SECONDS)
+            except queue.Empty:
+                # A worker killed by a native crash, the OOM killer or a signal never reports back
+                exitcodes = [process.exitcode for process in processes if process.exitcode not in (None, 0)]
+                if exitcodes:
+                    raise RuntimeError(f"Detection worker died with exit code {exitcodes[0]}")
+                continue
+            if kind == "error":
+                raise RuntimeError(f"Detection worker failed:\n{payload}")
+            if kind == "done":
+                running -= 1
+                if payload is not None and recorder is not None:
+                    recorder.merge(payload)
+                continue
+            frame_index, detected_tags = payload
+            pending[frame_index] = detected_tags
+            # Yield in frame order, the workers finish out of order
+            while next_position < len(submitted) and submitted[next_position] in pending:
+                frame_index = submitted[next_position]
+                yield frame_index, pending.pop(frame_index)
+                next_position += 1
+        if decoder_error:
+            raise decoder_error[0]
+    finally:
+        stop.set()
+        thread.join()
+        try:
+            for process in processes:
+                process.join(timeout=1)
+                if process.is_alive():
+                    process.terminate()
+        finally:
+            # Frees the shared memory even if a worker died while attached to it
+            ring.close()
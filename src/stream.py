@@ -0,0 +1,211 @@
+# src/stream.py
+#
+# Live frame sources: a camera device, a network stream, or a video file played back at real
+# time as a stand-in for a camera. Frames are captured in a background thread into a small
+# bounded buffer, so the pipeline always works on recent frames instead of falling behind.
+
+import threading
+import time
+from collections import deque
+
+import cv2
+
+from src.april_tag import compact_detection
+from src.instrumentation import stage, count, observe
+
+# What the capture thread does with a new frame when the buffer is full:
+# - "drop_oldest": discard the oldest waiting frame, the pipeline always gets the newest frames
+# - "drop_newest": discard the new frame, the waiting frames are processed first
+# - "block": wait for room, no frame is lost but the latency grows while the pipeline is slower
+#   than the camera (a camera keeps capturing, so its driver drops frames instead)
+DROP_POLICIES = ("drop_oldest", "drop_newest", "block")
+
+def open_stream(source):
+    """
+    Opens a live source.
+
+    Args:
+    - source (int or str): A camera index (also as string, "0"), a stream URL (rtsp://, http://)
+        or the path to a video file.
+
+    Returns:
+    - stream (cv2.VideoCapture): The opened source.
+    """
+    if isinstance(source, str) and source.isdigit():
+        source = int(source)
+    stream = cv2.VideoCapture(source)
+    if not stream.isOpened():
+        raise ValueError(f"Error opening stream: {source}")
+    return stream
+
+def iter_stream(source, realtime=None):
+    """
+    Reads the frames of a live source as they are captured.
+
+    Args:
+    - source (int or str): The source, see open_stream.
+    - realtime (bool): Release the frames of a file at its frame rate, like a camera would. Default
+        is True for files and False for cameras and streams, which are paced by the device.
+
+    Returns:
+    - frames (generator): (frame_index, frame, capture_time) tuples, capture_time in
+        time.perf_counter seconds. For files played at real time it is the time the frame was due.
+    """
+    stream = open_stream(source)
+    is_file = isinstance(source, str) and not source.isdigit() and "://" not in source
+    if realtime is None:
+        realtime = is_file
+    fps = stream.get(cv2.CAP_PROP_FPS)
+    if realtime and fps <= 0:
+        raise ValueError(f"Error: {source} has no frame rate, can't play it at real time.")
+    try:
+        start = time.perf_counter()
+        frame_index = 0
+        while True:
+            if realtime:
+                # Wait until the frame is due, if we are late it is released right away
+                due = start + frame_index / fps
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            with stage("decode"):
+                ret, frame = stream.read()
+            if not ret:
+                break
+            yield frame_index, frame, due if realtime else time.perf_counter()
+            frame_index += 1
+    finally:
+        stream.release()
+
+class FrameBuffer:
+    """
+    Bounded, thread-safe buffer between a capture thread and the pipeline.
+
+    Args:
+    - max_size (int): Number of frames the buffer holds. Default is 2, small keeps the latency low.
+    - policy (str): What to do with a new frame when the buffer is full, one of DROP_POLICIES.
+        Default is "drop_oldest".
+    """
+    def __init__(self, max_size=2, policy="drop_oldest"):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy {policy}, use one of {DROP_POLICIES}")
+        self.max_size = max(1, max_size)
+        self.policy = policy
+        self.items = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        """
+        Adds an item, the policy decides what happens when the buffer is full.
+
+        Returns:
+        - added (bool): False if the item was dropped, or the buffer was closed.
+        """
+        with self.condition:
+            if self.policy == "block":
+                while len(self.items) >= self.max_size and not self.closed:
+                    self.condition.wait()
+            if self.closed:
+                return False
+            if len(self.items) >= self.max_size:
+                self.dropped += 1
+                count("frames dropped")
+                if self.policy == "drop_newest":
+                    return False
+                self.items.popleft()
+            self.items.append(item)
+            self.condition.notify_all()
+            return True
+
+    def get(self):
+        """
+        Takes the oldest item, waits while the buffer is empty.
+
+        Returns:
+        - item: The item, None once the buffer is closed and empty.
+        """
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            observe("stream buffer depth", len(self.items))
+            self.condition.notify_all()
+            return item
+
+    def close(self):
+        """Ends the stream, get returns the remaining items and then None."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+def live_frames(source, buffer_size=2, policy="drop_oldest", realtime=None):
+    """
+    Captures a live source in a background thread and yields its frames through a FrameBuffer.
+
+    Args:
+    - source (int or str): The source, see open_stream.
+    - buffer_size (int): Number of frames the buffer holds. Default is 2.
+    - policy (str): What to do with new frames while the buffer is full, one of DROP_POLICIES.
+        Default is "drop_oldest".
+    - realtime (bool): Play files at their frame rate, see iter_stream.
+
+    Returns:
+    - frames (generator): (frame_index, frame, capture_time) tuples, frame indexes have gaps
+        where frames were dropped.
+    """
+    buffer = FrameBuffer(max_size=buffer_size, policy=policy)
+    # Open in the caller, so a bad source raises here and not in the thread
+    frames = iter_stream(source, realtime=realtime)
+    first = next(frames, None)
+    error = []
+
+    def capture():
+        try:
+            if first is not None:
+                buffer.put(first)
+            for item in frames:
+                buffer.put(item)
+                if buffer.closed:
+                    break
+        except Exception as exception:
+            error.append(exception)
+        finally:
+            frames.close()
+            buffer.close()
+
+    thread = threading.Thread(target=capture, name="frame-capture", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is None:
+                break
+            yield item
+        if error:
+            raise error[0]
+    finally:
+        buffer.close()
+        thread.join()
+
+def detect_live(source, detector, buffer_size=2, policy="drop_oldest", realtime=None):
+    """
+    Detects the tags of a live source as fast as the detector allows.
+
+    Args:
+    - source (int or str): The source, see open_stream.
+    - detector (AprilTagDetector or TagTracker): The detector of the frames.
+    - buffer_size, policy, realtime: See live_frames.
+
+    Returns:
+    - detections (generator): (frame_index, detected_tags, latency) tuples, latency in seconds from
+        the capture of the frame to its tag poses.
+    """
+    for frame_index, frame, capture_time in live_frames(source, buffer_size, policy, realtime):
+        detected_tags = [compact_detection(tag) for tag in detector.detect(frame)]
+        latency = time.perf_counter() - capture_time
+        observe("capture to pose latency ms", latency * 1000)
+        yield frame_index, detected_tags, latency
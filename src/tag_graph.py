@@ -1,44 +1,352 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 import heapq
+import time
+
+import numpy as np
+
+from src.geometry import make_transforms, invert_transforms
+from src.instrumentation import timed, observe
+
+# Scales of the detection quality terms, a term doubles the cost when its value reaches the scale
+POSE_ERR_SCALE = 1e-6 # object-space pose error in m^2
+DECISION_MARGIN_SCALE = 50.0 # a high decision margin means a confident decode
+TAG_SIZE_SCALE_PX = 50.0 # small tags in the image give noisy poses
+MIN_VIEWING_COS = 0.1 # cosine of the viewing angle at which the cost stops growing
+
+def get_detection_cost(tag):
+    """
+    Estimates how unreliable the pose of a detection is, lower is better.
+
+    Combines the pose error, the decision margin, the apparent size of the tag in pixels and the
+    viewing angle, the angle between the tag normal and the line of sight. A perfect detection
+    costs 1, each term multiplies the cost.
+
+    Args:
+    - tag (Detection): A detection with pose_err, decision_margin, corners, pose_R and pose_t.
+
+    Returns:
+    - cost (float): The cost of the detection.
+    """
+    corners = np.asarray(tag.corners, dtype=np.float64)
+    size_px = np.mean(np.linalg.norm(corners - np.roll(corners, 1, axis=0), axis=1))
+
+    pose_t = np.asarray(tag.pose_t, dtype=np.float64).reshape(3)
+    normal = np.asarray(tag.pose_R, dtype=np.float64)[:, 2]
+    viewing_cos = abs(normal @ pose_t) / max(np.linalg.norm(pose_t), 1e-12)
+
+    return float((1 + tag.pose_err / POSE_ERR_SCALE)
+                 * (1 + DECISION_MARGIN_SCALE / max(tag.decision_margin, 1e-3))
+                 * (1 + TAG_SIZE_SCALE_PX / max(size_px, 1e-3))
+                 / max(viewing_cos, MIN_VIEWING_COS))
 
 class TagGraph:
-    def __init__(self):
-        # Graph representation: each tag ID points to a list of tuples (connected_tag_id, frame_index)
-        self.graph = defaultdict(list)
-    
+    """
+    Graph of the tags, two tags are connected when they were detected in the same frame.
+
+    With an origin tag the graph maps incrementally: every add_frame updates the shortest path
+    tree and the poses of the tags in place, only the subtrees below a changed tree edge are
+    recomputed. The current map is available after every frame with get_tag_transforms.
+
+    Args:
+    - use_quality_weights (bool): Weight the edges by the detection quality of their best frame,
+        see get_detection_cost. Otherwise every edge has weight 1. Default is True.
+    - origin_tag (int): Tag ID of the origin for incremental mapping. Default is None (batch only).
+    - max_pose_updates (int): In incremental mode, the maximum number of tag poses recomputed per
+        frame, the rest is deferred to later frames to bound the latency. Default is None (no limit).
+    """
+    def __init__(self, use_quality_weights=True, origin_tag=None, max_pose_updates=None):
+        self.use_quality_weights = use_quality_weights
+        # Each pair of tags seen together is a single edge: (smaller tag ID, larger tag ID) -> frame indexes
+        self.edges = defaultdict(list)
+        # The best frame of every edge: (smaller tag ID, larger tag ID) -> (weight, frame index)
+        self.best_edges = {}
+        # Compact adjacency, built from the edges when needed
+        self._adjacency = None
+
+        # Incremental mapping state
+        self.origin_tag = origin_tag
+        self.max_pose_updates = max_pose_updates
+        self.neighbors = defaultdict(set)
+        self.parents = {} # tag ID -> (parent tag ID, frame index), like shortest_path_tree
+        self.distances = {}
+        self.children = defaultdict(set)
+        self.edge_transforms = {} # (tag ID a, tag ID b) -> transform from b to a of the best frame
+        self.tag_transforms = {} # tag ID -> transform from tag to origin tag coordinates, in meters
+        self._pending_poses = deque()
+        self.update_latencies = []
+
+    @timed("graph build")
     def add_frame(self, detected_tags, frame_index):
-        # Add edges between all tags detected in the same frame
-        tag_ids = [tag.tag_id for tag in detected_tags]
-        
+        start = time.perf_counter()
+        # Add or extend the edges between all tags detected in the same frame
+        tags = {int(tag.tag_id): tag for tag in detected_tags}
+        tag_ids = sorted(tags)
+        if self.use_quality_weights:
+            costs = {tag_id: get_detection_cost(tag) for tag_id, tag in tags.items()}
+        improved_edges = []
+
         for i in range(len(tag_ids)):
             for j in range(i + 1, len(tag_ids)):
                 tag1, tag2 = tag_ids[i], tag_ids[j]
-                self.graph[tag1].append((tag2, frame_index))
-                self.graph[tag2].append((tag1, frame_index))
-                
+                pair = (tag1, tag2)
+                if pair not in self.edges:
+                    self._adjacency = None
+                self.edges[pair].append(frame_index)
+
+                # The relative pose is as uncertain as both detections together
+                weight = costs[tag1] + costs[tag2] if self.use_quality_weights else 1
+                if pair not in self.best_edges or weight < self.best_edges[pair][0]:
+                    self.best_edges[pair] = (weight, frame_index)
+                    improved_edges.append(pair)
+
+        if self.origin_tag is not None:
+            self._update_map(tags, improved_edges)
+            self.update_latencies.append(time.perf_counter() - start)
+            observe("pending poses", len(self._pending_poses))
+
+    @timed("map update")
+    def _update_map(self, tags, improved_edges):
+        if improved_edges:
+            # Relative transforms of the new best frames: T_a_b = inv(T_camera_a) @ T_camera_b
+            firsts = [tag1 for tag1, _ in improved_edges]
+            seconds = [tag2 for _, tag2 in improved_edges]
+            poses = make_transforms([tags[tag_id].pose_R for tag_id in firsts + seconds],
+                                    [tags[tag_id].pose_t for tag_id in firsts + seconds])
+            relative = invert_transforms(poses[:len(firsts)]) @ poses[len(firsts):]
+            inverse = invert_transforms(relative)
+            for k, (tag1, tag2) in enumerate(improved_edges):
+                self.neighbors[tag1].add(tag2)
+                self.neighbors[tag2].add(tag1)
+                self.edge_transforms[(tag1, tag2)] = relative[k]
+                self.edge_transforms[(tag2, tag1)] = inverse[k]
+
+        pq = []
+        if self.origin_tag in tags and self.origin_tag not in self.distances:
+            # The origin shows up for the first time
+            self.distances[self.origin_tag] = 0
+            self.parents[self.origin_tag] = (None, None)
+            self.tag_transforms[self.origin_tag] = np.eye(4)
+            pq.append((0, self.origin_tag))
+
+        # Weights only ever decrease, so only tags reached through an improved edge can get shorter paths
+        for tag1, tag2 in improved_edges:
+            weight, frame_index = self.best_edges[(tag1, tag2)]
+            for tag, neighbor in ((tag1, tag2), (tag2, tag1)):
+                if tag in self.distances and self.distances[tag] + weight < self.distances.get(neighbor, float("inf")):
+                    self._set_parent(neighbor, tag, frame_index, self.distances[tag] + weight)
+                    heapq.heappush(pq, (self.distances[neighbor], neighbor))
+
+        # Dijkstra restricted to the tags whose distance dropped
+        while pq:
+            distance, tag = heapq.heappop(pq)
+            if distance > self.distances[tag]:
+                continue
+            for neighbor in self.neighbors[tag]:
+                weight, frame_index = self.best_edges[(min(tag, neighbor), max(tag, neighbor))]
+                if distance + weight < self.distances.get(neighbor, float("inf")):
+                    self._set_parent(neighbor, tag, frame_index, distance + weight)
+                    heapq.heappush(pq, (distance + weight, neighbor))
+
+        self._update_poses(self.max_pose_updates)
+
+    def _set_parent(self, tag, parent, frame_index, distance):
+        old_parent, old_frame_index = self.parents.get(tag, (None, None))
+        self.distances[tag] = distance
+        if (old_parent, old_frame_index) != (parent, frame_index):
+            if old_parent is not None:
+                self.children[old_parent].discard(tag)
+            self.children[parent].add(tag)
+            self.parents[tag] = (parent, frame_index)
+            # The subtree below this tag has to be recomputed
+            self._pending_poses.append(tag)
+
+    def _update_poses(self, max_updates=None):
+        # Recompute queued tags breadth-first, a tag queued again later is simply recomputed again
+        updates = 0
+        while self._pending_poses and (max_updates is None or updates < max_updates):
+            tag = self._pending_poses.popleft()
+            parent, _ = self.parents[tag]
+            if parent not in self.tag_transforms:
+                # The parent is still queued, this tag will be reached from it
+                continue
+            self.tag_transforms[tag] = self.tag_transforms[parent] @ self.edge_transforms[(parent, tag)]
+            self._pending_poses.extend(self.children[tag])
+            updates += 1
+
+    def get_tag_transforms(self, flush=True):
+        """
+        Returns the current map of the incremental mode.
+
+        Args:
+        - flush (bool): First recompute the poses deferred by max_pose_updates. Default is True.
+
+        Returns:
+        - tag_ids (numpy array): The tag IDs connected to the origin, starting with the origin tag.
+        - transforms (numpy array): Nx4x4 transforms from tag to origin tag coordinates, in meters.
+        """
+        if flush:
+            self._update_poses()
+        if self.origin_tag not in self.tag_transforms:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 4, 4))
+        tag_ids = [self.origin_tag] + [tag for tag in self.tag_transforms if tag != self.origin_tag]
+        return np.array(tag_ids, dtype=np.int64), np.array([self.tag_transforms[tag] for tag in tag_ids])
+
+    def get_latency_report(self):
+        """
+        Summarizes the time add_frame took per frame in incremental mode.
+
+        Returns:
+        - report (dict): Number of frames, mean, 95th percentile, maximum and last latency in
+            milliseconds, and the number of tag poses still waiting to be recomputed.
+        """
+        latencies = np.array(self.update_latencies) * 1000
+        if len(latencies) == 0:
+            return {"frames": 0}
+        return {
+            "frames": len(latencies),
+            "mean_ms": float(np.mean(latencies)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "max_ms": float(np.max(latencies)),
+            "last_ms": float(latencies[-1]),
+            "pending_poses": len(self._pending_poses),
+        }
+
+    def get_edge_frames(self, tag1, tag2):
+        """Returns the indexes of the frames in which both tags were detected."""
+        return self.edges.get((min(tag1, tag2), max(tag1, tag2)), [])
+
+    def get_adjacency(self):
+        """
+        Returns the graph in compressed sparse row (CSR) form.
+
+        Returns:
+        - tag_ids (numpy array): The sorted tag IDs, node n is tag_ids[n].
+        - indptr (numpy array): The neighbors of node n are indices[indptr[n]:indptr[n + 1]].
+        - indices (numpy array): Neighbor node numbers.
+        - edge_ids (numpy array): For every neighbor entry, the position of its edge in self.edges.
+        """
+        if self._adjacency is None:
+            pairs = np.array(list(self.edges.keys()), dtype=np.int64).reshape(-1, 2)
+            tag_ids = np.unique(pairs)
+            nodes = np.searchsorted(tag_ids, pairs)
+            edge_ids = np.arange(len(pairs))
+
+            # Every edge is stored in both directions
+            sources = np.concatenate([nodes[:, 0], nodes[:, 1]])
+            targets = np.concatenate([nodes[:, 1], nodes[:, 0]])
+            edge_ids = np.concatenate([edge_ids, edge_ids])
+            order = np.argsort(sources, kind="stable")
+
+            indptr = np.zeros(len(tag_ids) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(sources, minlength=len(tag_ids)), out=indptr[1:])
+            self._adjacency = (tag_ids, indptr, targets[order], edge_ids[order])
+        return self._adjacency
+
+    def get_edge_weights(self):
+        """Returns the weight of every edge, in the order of self.edges."""
+        return np.array([self.best_edges[pair][0] for pair in self.edges], dtype=np.float64)
+
+    def get_edge_best_frames(self):
+        """Returns the best frame of every edge, in the order of self.edges."""
+        return [self.best_edges[pair][1] for pair in self.edges]
+
+    @timed("path search")
+    def shortest_path_tree(self, origin_tag):
+        """
+        Runs Dijkstra's algorithm once from the origin tag and returns the tree of shortest paths.
+
+        Args:
+        - origin_tag (int): The tag ID of the root.
+
+        Returns:
+        - parents (dict): For every tag reachable from the origin, a tuple (parent tag ID, frame index)
+            of the edge towards the origin. The origin maps to (None, None).
+        - distances (dict): The total distance of every reachable tag to the origin.
+        """
+        tag_ids, indptr, indices, edge_ids = self.get_adjacency()
+        position = np.searchsorted(tag_ids, origin_tag)
+        if position == len(tag_ids) or tag_ids[position] != origin_tag:
+            return {}, {}
+
+        # Python lists are faster than NumPy arrays for element-wise access in the loop
+        indptr, indices, edge_ids = indptr.tolist(), indices.tolist(), edge_ids.tolist()
+        weights = self.get_edge_weights().tolist()
+
+        distances = [float("inf")] * len(tag_ids)
+        previous_nodes = [-1] * len(tag_ids)
+        previous_edges = [-1] * len(tag_ids)
+        visited = [False] * len(tag_ids)
+
+        origin = int(position)
+        distances[origin] = 0
+        pq = [(0, origin)]  # Priority queue to store (cost, node)
+        while pq:
+            current_distance, node = heapq.heappop(pq)
+            if visited[node]:
+                continue
+            visited[node] = True
+
+            for k in range(indptr[node], indptr[node + 1]):
+                neighbor = indices[k]
+                distance = current_distance + weights[edge_ids[k]]
+                if distance < distances[neighbor]:
+                    distances[neighbor] = distance
+                    previous_nodes[neighbor] = node
+                    previous_edges[neighbor] = edge_ids[k]
+                    heapq.heappush(pq, (distance, neighbor))
+
+        # Every edge is represented by its best frame
+        edge_frames = self.get_edge_best_frames()
+        parents = {}
+        tree_distances = {}
+        for node, tag in enumerate(tag_ids.tolist()):
+            if not visited[node]:
+                continue
+            if node == origin:
+                parents[tag] = (None, None)
+            else:
+                parents[tag] = (int(tag_ids[previous_nodes[node]]), edge_frames[previous_edges[node]])
+            tree_distances[tag] = distances[node]
+        return parents, tree_distances
+
     def get_paths_to_origin(self, origin_tag):
-        # Use Dijkstra's algorithm to find the shortest path from every tag to the origin tag
+        """
+        Finds the shortest path from every tag to the origin tag.
+
+        Returns:
+        - paths (dict): tag ID -> list of (tag ID, next tag ID, frame index) tuples leading to the origin.
+            The origin tag maps to [origin_tag]. Tags that aren't connected to the origin are left out.
+        """
+        parents, _ = self.shortest_path_tree(origin_tag)
         paths = {}
-        
-        for tag in self.graph:
+        for tag in parents:
             if tag == origin_tag:
                 paths[origin_tag] = [origin_tag]
             else:
-                shortest_path, path_distance = self.dijkstra_shortest_path(tag, origin_tag)
-                paths[tag] = shortest_path
+                paths[tag] = self._path_from_tree(parents, tag)
         return paths
-    
+
+    @staticmethod
+    def _path_from_tree(parents, tag):
+        path = []
+        current_node = tag
+        parent, frame_index = parents[current_node]
+        while parent is not None:
+            path.append((current_node, parent, frame_index))
+            current_node = parent
+            parent, frame_index = parents[current_node]
+        return path
 
     def dijkstra_shortest_path(self, start_tag, end_tag):
         """
         Finds the shortest path between two tags (start_tag and end_tag)
-        
+
         The function returns a list of tuples, where each tuple contains:
         - The start node (tag ID) of the edge.
         - The end node (tag ID) of the edge.
         - The frame index where the edge (connection between the two nodes) was detected.
-        
-        It also returns the total distance (in terms of the number of edges) between the start and end tags.
+
+        It also returns the total distance (in terms of the edge weights) between the start and end tags.
 
         Args:
         - start_tag (int): The tag ID of the starting node.
@@ -46,41 +354,9 @@ class TagGraph:
 
         Returns:
         - path (list of tuples): The shortest path from start_tag to end_tag, including frame indexes.
-        - path_distance (int): The total distance of the path.
+        - path_distance (float): The total distance of the path.
         """
-        pq = []  # Priority queue to store (cost, node)
-        weight = 1
-        
-        heapq.heappush(pq, (0, start_tag))
-        distances = {start_tag: 0}
-        previous_nodes = {start_tag: None}
-        edge_indexes = {}  # Track the frame index for each edge
-        
-        while pq:
-            current_distance, current_tag = heapq.heappop(pq)
-            
-            if current_tag == end_tag:
-                break  # Found the shortest path
-            
-            for neighbor, frame_index in self.graph[current_tag]:
-                distance = current_distance + weight
-                if neighbor not in distances or distance < distances[neighbor]:
-                    distances[neighbor] = distance
-                    heapq.heappush(pq, (distance, neighbor))
-                    previous_nodes[neighbor] = current_tag
-                    edge_indexes[(current_tag, neighbor)] = frame_index
-        
-        # Reconstruct the path from start_tag to end_tag, including the frame indexes
-        # So we can find it back to calculate the transformation matrices
-        path = []
-        current_node = end_tag
-        while current_node is not None:
-            prev_node = previous_nodes[current_node]
-            if prev_node is not None:
-                frame_index = edge_indexes[(prev_node, current_node)]
-                path.append((prev_node, current_node, frame_index))
-            current_node = prev_node
-        
-        path.reverse() #TODO: fix also down in the code
-        
-        return path, distances.get(end_tag, float('inf'))
\ No newline at end of file
+        parents, distances = self.shortest_path_tree(end_tag)
+        if start_tag not in parents:
+            return [], float('inf')
+        return self._path_from_tree(parents, start_tag), distances[start_tag]
@@ -0,0 +1,191 @@
+# src/tracking.py
+
+import numpy as np
+
+from src.april_tag import preprocess_frame, get_undistort_maps, detect_tags_in_region, undistort_tag_detections
+from src.instrumentation import count, observe
+
+class TagTracker:
+    """
+    Detects tags only around where they were in the previous frames.
+
+    Consecutive frames move very little, so after a full-frame detection the tags are searched
+    in padded regions around their predicted corners. A full-frame detection runs every
+    redetect_interval frames, so new tags are still found, and right away whenever a tracked
+    tag is lost, unless it is expected to leave the view. Only the searched regions are
+    undistorted, with the cached maps of "remap" mode. A tracker holds the state of one
+    sequence of frames, create one per video (or chunk of a video) and feed it the frames in
+    order.
+
+    Args:
+    - detector (AprilTagDetector): The long-lived detector, its settings are used for every frame.
+    - redetect_interval (int): Search the full frame every n-th frame. Default is 10.
+    - padding (float): Margin around a tag, relative to its size in pixels. Default is 0.5.
+    - min_padding (int): Margin around a tag in pixels at least. Default is 16.
+    - predict_motion (bool): Move the regions with the velocity of the corners between the last
+        two frames (constant velocity). Default is True.
+    - search_entering (bool): Also search a narrow band along the image border where new tags enter
+        the view, on the side the camera moves to. Needs predict_motion. Default is True.
+    """
+    def __init__(self, detector, redetect_interval=10, padding=0.5, min_padding=16, predict_motion=True,
+                 search_entering=True):
+        self.detector = detector
+        self.redetect_interval = max(1, redetect_interval)
+        self.padding = padding
+        self.min_padding = min_padding
+        self.predict_motion = predict_motion
+        self.search_entering = search_entering
+        self.reset()
+
+    def reset(self):
+        """Forgets all tracked tags, the next frame is searched completely."""
+        # tag ID -> corners in detection image coordinates, of the last and the previous frame
+        self.tracks = {}
+        self.previous_tracks = {}
+        self.frames_since_detection = 0
+        self.full_detections = 0
+        self.region_detections = 0
+
+    def predict_corners(self):
+        """
+        Returns the expected corners of every tracked tag in the next frame.
+
+        Returns:
+        - corners (dict): tag ID -> 4x2 corners in detection image coordinates.
+        """
+        if not self.predict_motion:
+            return dict(self.tracks)
+        velocities = self._get_velocities()
+        # Tags seen for the first time move with the camera, like the others
+        default_velocity = np.median(np.stack(list(velocities.values())), axis=0) if velocities else 0
+        return {tag_id: corners + velocities.get(tag_id, default_velocity)
+                for tag_id, corners in self.tracks.items()}
+
+    def _get_velocities(self):
+        # Motion of the corners of the tags seen in the last two frames, in pixels per frame
+        return {tag_id: corners - self.previous_tracks[tag_id]
+                for tag_id, corners in self.tracks.items() if tag_id in self.previous_tracks}
+
+    def get_regions(self, image_size):
+        """
+        Returns the regions to search in the next frame.
+
+        Args:
+        - image_size (tuple): (width, height) of the detection image.
+
+        Returns:
+        - regions (list of tuples): (x0, y0, x1, y1) pixel bounds, one per tag and one per entering band.
+            Overlapping regions are kept apart, their bounding box would mostly be empty image.
+        """
+        width, height = image_size
+        boxes = []
+        for corners in self.predict_corners().values():
+            low = corners.min(axis=0)
+            high = corners.max(axis=0)
+            margin = max(self.padding * float(np.max(high - low)), self.min_padding)
+            boxes.append([max(int(low[0] - margin), 0), max(int(low[1] - margin), 0),
+                          min(int(np.ceil(high[0] + margin)), width), min(int(np.ceil(high[1] + margin)), height)])
+
+        velocities = self._get_velocities()
+        if self.predict_motion and self.search_entering and velocities:
+            # The image content moves opposite to the camera, new tags enter on the far side. A tag is
+            # found once it is completely in view, by then it is at most its size and one frame of
+            # motion away from the border, so the band only has to hold that and the margin
+            motion = np.median(np.stack([velocity.mean(axis=0) for velocity in velocities.values()]), axis=0)
+            size = max(float(np.max(corners.max(axis=0) - corners.min(axis=0))) for corners in self.tracks.values())
+            margin = max(self.padding * size, self.min_padding)
+            band_x = int(np.ceil(size + margin + abs(motion[0])))
+            band_y = int(np.ceil(size + margin + abs(motion[1])))
+            # Slower than a tag size per redetect interval, the full-frame detections find the
+            # entering tags soon enough (e.g. the camera shaking across the direction it moves)
+            min_motion = size / self.redetect_interval
+            if motion[0] < -min_motion:
+                boxes.append([max(width - band_x, 0), 0, width, height])
+            elif motion[0] > min_motion:
+                boxes.append([0, 0, min(band_x, width), height])
+            if motion[1] < -min_motion:
+                boxes.append([0, max(height - band_y, 0), width, height])
+            elif motion[1] > min_motion:
+                boxes.append([0, 0, width, min(band_y, height)])
+
+        # Start the regions on the grid of the decimated image, so the quads are found at the same
+        # corners as on the full frame
+        step = max(int(self.detector.quad_decimate), 1)
+        return [(x0 - x0 % step, y0 - y0 % step, x1, y1) for x0, y0, x1, y1 in boxes if x1 > x0 and y1 > y0]
+
+    @staticmethod
+    def _is_leaving(corners, image_shape):
+        # Tags expected within their size of the image border may be lost because they leave the view
+        height, width = image_shape[:2]
+        low, high = corners.min(axis=0), corners.max(axis=0)
+        size = np.max(high - low)
+        return bool(np.any(low < size) or high[0] >= width - size or high[1] >= height - size)
+
+    def _detect(self, image, regions):
+        detector = self.detector
+        undistort_maps = None
+        if detector.undistort_mode != "points":
+            # "image" and "remap" give the same pixels, undistorting the regions with the maps is cheapest
+            undistort_maps = get_undistort_maps(K=detector.K, D=detector.D, image_size=(image.shape[1], image.shape[0]))
+        detected_tags = {}
+        for region in regions:
+            for tag in detect_tags_in_region(detector=detector.detector,
+                                             image=image,
+                                             region=region,
+                                             fx=detector.fx, fy=detector.fy, cx=detector.cx, cy=detector.cy,
+                                             tag_size=detector.tag_size,
+                                             estimate_tag_pose=False,
+                                             undistort_maps=undistort_maps,
+                                             refine_radius=detector.refine_radius if detector.refine_corners else None):
+                # A tag on the edge of two regions is kept once, with its best detection
+                if tag.tag_id not in detected_tags or tag.decision_margin > detected_tags[tag.tag_id].decision_margin:
+                    detected_tags[tag.tag_id] = tag
+        return [detected_tags[tag_id] for tag_id in sorted(detected_tags)]
+
+    def detect(self, frame):
+        """
+        Detects the tags in the next frame of the sequence.
+
+        Args:
+        - frame (numpy array): The BGR or grayscale frame.
+
+        Returns:
+        - detected_tags (list of TagDetection): The tags, like AprilTagDetector.detect returns them.
+        """
+        detector = self.detector
+        # Grayscale only, the regions are undistorted when they are searched (see _detect)
+        image = preprocess_frame(frame=frame, K=detector.K, D=detector.D, undistort_mode="points")
+        full_frame = (0, 0, image.shape[1], image.shape[0])
+
+        if not self.tracks or self.frames_since_detection + 1 >= self.redetect_interval:
+            detected_tags = self._detect(image, [full_frame])
+            self.full_detections += 1
+            count("full-frame detections")
+            self.frames_since_detection = 0
+        else:
+            regions = self.get_regions((image.shape[1], image.shape[0]))
+            observe("regions per frame", len(regions))
+            detected_tags = self._detect(image, regions)
+            self.region_detections += 1
+            count("region detections")
+            self.frames_since_detection += 1
+            lost_tags = set(self.tracks).difference(tag.tag_id for tag in detected_tags)
+            if any(not self._is_leaving(corners, image.shape) for tag_id, corners in self.predict_corners().items()
+                   if tag_id in lost_tags):
+                # A tag was lost, it may have moved out of its region, search the full frame
+                detected_tags = self._detect(image, [full_frame])
+                self.full_detections += 1
+                count("full-frame detections")
+                count("lost tag redetections")
+                self.frames_since_detection = 0
+
+        # Track in detection image coordinates, those are distorted in "points" mode
+        self.previous_tracks = self.tracks
+        self.tracks = {tag.tag_id: tag.corners.astype(np.float64) for tag in detected_tags}
+
+        # Neighboring regions overlap and find the same tags, so the poses are only solved for the
+        # kept detections, with the PnP solve of "points" mode
+        return undistort_tag_detections(detected_tags=detected_tags,
+                                        K=detector.K,
+                                        D=detector.D if detector.undistort_mode == "points" else None,
+                                        tag_size=detector.tag_size)
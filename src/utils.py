@@ -2,8 +2,12 @@
 
 import cv2
 import json
+import queue
+import threading
 import numpy as np
 
+from src.instrumentation import stage, observe
+
 def load_video(video_path: str):
     """
     Loads the video from the given path.
@@ -37,54 +41,127 @@ def get_D_and_K_from_calibration(calibration_data):
     D = np.array(calibration_data['dist_coeffs'])
     return K, D, fx, fy, cx, cy
 
-def get_last_frame(video_path):
-    # Open the video file
-    video = cv2.VideoCapture(video_path)
-    
-    if not video.isOpened():
-        raise ValueError(f"Error: Could not open video file at {video_path}")
+def get_frame_range(video, start_frame=0, stop_frame=None, start_time=None, end_time=None):
+    """
+    Resolves a frame window of an opened video, optionally given in seconds.
 
-    # Get the total number of frames
-    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    
-    # Set the video position to the last frame
-    video.set(cv2.CAP_PROP_POS_FRAMES, total_frames - 3)
-    
-    # Read the last frame
-    ret, last_frame = video.read()
-    
-    if not ret:
-        raise ValueError("Error: Could not read the last frame from the video.")
-
-    # Release the video capture object
-    video.release()
-    
-    return last_frame
-
-def get_X_frames(video_path, number_of_frames):
-    frames = []
-    # Open the video file
-    video = cv2.VideoCapture(video_path)
-    
-    if not video.isOpened():
-        raise ValueError(f"Error: Could not open video file at {video_path}")
-
-    # Get the total number of frames
+    :param video: Video capture object (cv2.VideoCapture).
+    :param start_frame: First frame index to include.
+    :param stop_frame: Frame index to stop at (exclusive), None for the end of the video.
+    :param start_time: Start of the window in seconds, overrides start_frame.
+    :param end_time: End of the window in seconds (exclusive), overrides stop_frame.
+    :return: Tuple (start_frame, stop_frame), stop_frame is None if the length is unknown.
+    """
     total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-    for x in range(number_of_frames):
-
-    
-        # Set the video position to the last frame
-        video.set(cv2.CAP_PROP_POS_FRAMES, round(total_frames * (x/number_of_frames)))
-        
-        # Read the last frame
-        ret, frame = video.read()
-        frames.append(frame)
-        
-        if not ret:
-            raise ValueError("Error: Could not read frame from the video.")
-
-    # Release the video capture object
-    video.release()
-    
-    return frames
\ No newline at end of file
+    fps = video.get(cv2.CAP_PROP_FPS)
+    if start_time is not None or end_time is not None:
+        if fps <= 0:
+            raise ValueError("Error: Video has no frame rate, can't select frames by time.")
+        if start_time is not None:
+            start_frame = int(round(start_time * fps))
+        if end_time is not None:
+            stop_frame = int(round(end_time * fps))
+    if total_frames > 0:
+        stop_frame = total_frames if stop_frame is None else min(stop_frame, total_frames)
+    return max(start_frame, 0), stop_frame
+
+def iter_frames(video_path, start_frame=0, stop_frame=None, stride=1, start_time=None, end_time=None, prefetch=0):
+    """
+    Decodes the video once, front to back, and yields the selected frames.
+
+    It never seeks per frame: at most one seek is done to reach the start of the window,
+    skipped frames are only grabbed and not converted.
+
+    :param video_path: Path to the video file.
+    :param start_frame: First frame index to yield.
+    :param stop_frame: Frame index to stop at (exclusive), None for the end of the video.
+    :param stride: Yield every n-th frame of the window.
+    :param start_time: Start of the window in seconds, overrides start_frame.
+    :param end_time: End of the window in seconds (exclusive), overrides stop_frame.
+    :param prefetch: If > 0, decode in a background thread into a queue of this size.
+    :return: Generator of (frame_index, frame) tuples.
+    """
+    if stride < 1:
+        raise ValueError(f"Error: stride must be at least 1, got {stride}")
+    frames = _iter_frames(video_path, start_frame, stop_frame, stride, start_time, end_time)
+    if prefetch > 0:
+        frames = prefetch_frames(frames, max_queue_size=prefetch)
+    return frames
+
+def _iter_frames(video_path, start_frame, stop_frame, stride, start_time, end_time):
+    video = load_video(video_path)
+    try:
+        start_frame, stop_frame = get_frame_range(video, start_frame, stop_frame, start_time, end_time)
+        if start_frame > 0:
+            # A single seek to the start of the window, decoding is sequential from here
+            video.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+        frame_index = start_frame
+        while stop_frame is None or frame_index < stop_frame:
+            if (frame_index - start_frame) % stride == 0:
+                with stage("decode"):
+                    ret, frame = video.read()
+                if not ret:
+                    break
+                yield frame_index, frame
+            else:
+                with stage("grab"):
+                    ret = video.grab()
+                if not ret:
+                    break
+            frame_index += 1
+    finally:
+        video.release()
+
+_END_OF_STREAM = object()
+
+def prefetch_frames(frames, max_queue_size=8):
+    """
+    Runs a frame generator in a background thread and yields its items through a bounded queue.
+
+    OpenCV releases the GIL while decoding, so the next frames are decoded while the caller
+    is busy with the current one. The queue bound keeps memory use constant.
+
+    :param frames: Iterable of frames, e.g. from iter_frames.
+    :param max_queue_size: Maximum number of decoded frames waiting in the queue.
+    :return: Generator yielding the same items as frames.
+    """
+    frame_queue = queue.Queue(maxsize=max_queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        # Don't block forever if the consumer went away
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for item in frames:
+                if not put(item):
+                    break
+        except Exception as error:
+            put(error)
+        finally:
+            if hasattr(frames, "close"):
+                frames.close()
+            put(_END_OF_STREAM)
+
+    thread = threading.Thread(target=producer, name="frame-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frame_queue.get()
+            observe("prefetch queue depth", frame_queue.qsize())
+            if item is _END_OF_STREAM:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -1,13 +1,90 @@
 # src/visualization.py
 
-import cv2
-
+import numpy as np
 import plotly.graph_objects as go
 
-def plot_tags(tag_data):
+# Level of detail of large maps: beyond MAX_OUTLINES tags only the centers are drawn, and at most
+# MAX_LABELS evenly spread tags get their ID as label (all tags keep it as hover text)
+MAX_OUTLINES = 50_000
+MAX_LABELS = 2_000
+# Camera positions drawn at most, the trajectory is subsampled beyond this
+MAX_CAMERA_POSITIONS = 10_000
+
+def _get_corners(tag_data):
+    # Nx4x3 corners and the IDs of the tag data
+    tag_ids = np.array([tag['id'] for tag in tag_data], dtype=np.int64)
+    corners = np.array([tag['corners'] for tag in tag_data], dtype=np.float64).reshape(len(tag_data), 4, 3)
+    return tag_ids, corners
+
+def _get_outlines(corners):
+    # The closed outlines of all tags as one polyline, NaN rows separate the tags so a single
+    # trace draws them all
+    outlines = np.full((len(corners), 6, corners.shape[2]), np.nan)
+    outlines[:, :4] = corners
+    outlines[:, 4] = corners[:, 0]
+    return outlines.reshape(-1, corners.shape[2])
+
+def _get_label_step(n_tags, max_labels):
+    # Label every n-th tag so at most max_labels labels are drawn
+    return max(1, -(-n_tags // max(1, max_labels)))
+
+def _subsample(points, max_points):
+    step = max(1, -(-len(points) // max_points))
+    return points[::step]
+
+def _add_tag_traces(fig, tag_data, trace, dims, max_outlines, max_labels):
+    # Adds the outlines (or centers) and the labels of all tags as one trace each
+    tag_ids, corners = _get_corners(tag_data)
+    corners = corners[:, :, :dims]
+    centers = corners.mean(axis=1)
+    axes = ['x', 'y', 'z'][:dims]
+
+    if len(tag_data) <= max_outlines:
+        outlines = _get_outlines(corners)
+        fig.add_trace(trace(
+            **{axis: outlines[:, i] for i, axis in enumerate(axes)},
+            mode='lines',
+            line=dict(color='blue', width=2),
+            hoverinfo='skip',
+            name='Tags'
+        ))
+    else:
+        fig.add_trace(trace(
+            **{axis: centers[:, i] for i, axis in enumerate(axes)},
+            mode='markers',
+            marker=dict(color='blue', size=2),
+            hovertext=[str(tag_id) for tag_id in tag_ids],
+            hoverinfo='text',
+            name='Tags'
+        ))
+
+    step = _get_label_step(len(tag_data), max_labels)
+    fig.add_trace(trace(
+        **{axis: centers[::step, i] for i, axis in enumerate(axes)},
+        mode='text',
+        text=[str(tag_id) for tag_id in tag_ids[::step]],
+        textposition='middle center',
+        hoverinfo='text',
+        name='IDs'
+    ))
+
+def _add_camera_trace(fig, camera_positions, trace, dims):
+    camera_positions = _subsample(np.asarray(camera_positions, dtype=np.float64), MAX_CAMERA_POSITIONS)
+    fig.add_trace(trace(
+        **{axis: camera_positions[:, i] for i, axis in enumerate(['x', 'y', 'z'][:dims])},
+        mode='lines',
+        line=dict(color='red', width=2),
+        hoverinfo='skip',
+        name='Camera'
+    ))
+
+def plot_tags(tag_data, camera_positions=None, max_outlines=MAX_OUTLINES, max_labels=MAX_LABELS):
     """
     Plots all the tags as rectangles with their ID numbers inside using Plotly.
-    
+
+    All outlines are one trace and all labels another, so the figure stays small and fast with
+    thousands of tags.
+
     Args:
     - tag_data (list of dicts): A list where each element is a dictionary containing:
         - 'id': The ID of the tag.
@@ -18,47 +95,19 @@ def plot_tags(tag_data):
                 [x3, y3, z3],  # Bottom-right corner
                 [x4, y4, z4]   # Bottom-left corner
             ]
-    
+    - camera_positions (numpy array): Optional Nx3 camera positions in millimeters to draw as
+        trajectory, see get_camera_positions.
+    - max_outlines (int): Draw only the centers of the tags when there are more. Default is MAX_OUTLINES.
+    - max_labels (int): Label at most this many evenly spread tags. Default is MAX_LABELS.
+
     Returns:
     - fig (plotly.graph_objects.Figure): A Plotly figure object with the tags plotted.
     """
     fig = go.Figure()
-    print(f"Tag data: {tag_data}")
-
-    for tag in tag_data:
-        tag = tag[0] #TODO
-        tag_id = tag['id']
-        corners = tag['corners']
-
-        # Extract x, y, z coordinates of the corners
-        x_coords = [corner[0] for corner in corners] + [corners[0][0]]  # Close the rectangle by adding the first point at the end
-        y_coords = [corner[1] for corner in corners] + [corners[0][1]]
-        z_coords = [corner[2] for corner in corners] + [corners[0][2]]
-
-        # Plot the rectangle
-        fig.add_trace(go.Scatter3d(
-            x=x_coords,
-            y=y_coords,
-            z=z_coords,
-            mode='lines',
-            line=dict(color='blue', width=2),
-            name=f'Tag {tag_id}'
-        ))
-
-        # Add the tag ID in the center of the rectangle
-        center_x = sum(x_coords[:-1]) / 4
-        center_y = sum(y_coords[:-1]) / 4
-        center_z = sum(z_coords[:-1]) / 4
-
-        fig.add_trace(go.Scatter3d(
-            x=[center_x],
-            y=[center_y],
-            z=[center_z],
-            mode='text',
-            text=[str(tag_id)],
-            textposition='middle center',
-            showlegend=False
-        ))
+    if tag_data:
+        _add_tag_traces(fig, tag_data, go.Scatter3d, 3, max_outlines, max_labels)
+    if camera_positions is not None and len(camera_positions):
+        _add_camera_trace(fig, camera_positions, go.Scatter3d, 3)
 
     # Update the layout for better visualization
     fig.update_layout(
@@ -74,10 +123,13 @@ def plot_tags(tag_data):
 
     return fig
 
-def plot_tags_2d(tag_data):
+def plot_tags_2d(tag_data, camera_positions=None, max_outlines=MAX_OUTLINES, max_labels=MAX_LABELS):
     """
     Plots all the tags as rectangles with their ID numbers inside on the X-Y plane using Plotly.
-    
+
+    Drawn with WebGL (Scattergl), all outlines are one trace and all labels another, so the
+    figure stays small and fast with thousands of tags.
+
     Args:
     - tag_data (list of dicts): A list where each element is a dictionary containing:
         - 'id': The ID of the tag.
@@ -88,41 +140,19 @@ def plot_tags_2d(tag_data):
                 [x3, y3, z3],  # Bottom-right corner
                 [x4, y4, z4]   # Bottom-left corner
             ]
-    
+    - camera_positions (numpy array): Optional Nx3 camera positions in millimeters to draw as
+        trajectory, see get_camera_positions.
+    - max_outlines (int): Draw only the centers of the tags when there are more. Default is MAX_OUTLINES.
+    - max_labels (int): Label at most this many evenly spread tags. Default is MAX_LABELS.
+
     Returns:
     - fig (plotly.graph_objects.Figure): A Plotly figure object with the tags plotted on the X-Y plane.
     """
     fig = go.Figure()
-    for tag in tag_data:
-        tag = tag[0] #TODO
-        tag_id = tag['id']
-        corners = tag['corners']
-
-        # Extract x and y coordinates of the corners 
-        x_coords = [corner[0] for corner in corners] + [corners[0][0]] 
-        y_coords = [corner[1] for corner in corners] + [corners[0][1]]
-
-        # Plot the rectangle on the X-Y plane
-        fig.add_trace(go.Scatter(
-            x=x_coords,
-            y=y_coords,
-            mode='lines',
-            line=dict(color='blue', width=2),
-            name=f'Tag {tag_id}'
-        ))
-
-        # Add the tag ID in the center of the rectangle
-        center_x = sum(x_coords[:-1]) / 4
-        center_y = sum(y_coords[:-1]) / 4
-
-        fig.add_trace(go.Scatter(
-            x=[center_x],
-            y=[center_y],
-            mode='text',
-            text=[str(tag_id)],
-            textposition='middle center',
-            showlegend=False
-        ))
+    if tag_data:
+        _add_tag_traces(fig, tag_data, go.Scattergl, 2, max_outlines, max_labels)
+    if camera_positions is not None and len(camera_positions):
+        _add_camera_trace(fig, camera_positions, go.Scattergl, 2)
 
     # Update the layout for better visualization
     fig.update_layout(
@@ -132,4 +162,4 @@ def plot_tags_2d(tag_data):
         showlegend=False
     )
 
-    return fig
\ No newline at end of file
+    return fig
@@ -0,0 +1,225 @@
+# tests/benchmark.py
+#
+# Runs the mapping pipeline on a synthetic video and reports throughput, memory and accuracy.
+#
+# Usage: python -m tests.benchmark --frames 300 --family tagStandard52h13 --json benchmark.json
+
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+from src.utils import iter_frames
+from src.pipeline import detect_tags_in_video
+from src.detection_store import DetectionStore
+from src.tag_graph import TagGraph
+from src.geometry import calculate_tag_transforms, transform_tag_corners
+from src.fusion import fuse_edge_transforms
+from src.optimization import optimize_tag_poses
+from tests.synthetic_scene import make_synthetic_video, load_ground_truth, get_ground_truth_corners
+
+def get_peak_memory_mb():
+    """Returns the peak resident memory of this process and of its finished worker processes in MB."""
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+def get_corner_errors(tag_ids, transforms, ground_truth, origin_tag):
+    """
+    Compares estimated tag corners with the ground truth.
+
+    The corners are computed like make_tag_data and calculate_tag_corners do for the results,
+    without the rounding.
+
+    Returns:
+    - errors (dict): tag ID -> mean distance of its corners to the true corners in millimeters.
+    """
+    tag_size_mm = ground_truth["tag_size"] * 1000
+    true_ids, true_corners = get_ground_truth_corners(ground_truth["tags"], origin_tag, tag_size_mm)
+    true_corners = dict(zip(true_ids.tolist(), true_corners))
+    corners = transform_tag_corners(transforms, tag_size_mm)
+    return {int(tag_id): float(np.mean(np.linalg.norm(tag_corners - true_corners[int(tag_id)], axis=1)))
+            for tag_id, tag_corners in zip(tag_ids, corners)}
+
+def run_benchmark(video_path, ground_truth, origin_tag=0, workers=1, stride=1, quad_decimate=2.0,
+                  undistort_mode="image", refine_corners=False, tracking=None, selection=None,
+                  fuse_edges=False, optimize_map=False, transport="chunks"):
+    """
+    Runs every stage of the pipeline on a video and measures it.
+
+    Args:
+    - video_path (str): Path to the synthetic video.
+    - ground_truth (dict): The ground truth of the video, see load_ground_truth.
+    - origin_tag (int): The tag ID of the origin. Default is 0.
+    - The other arguments are the settings of main.py.
+
+    Returns:
+    - report (dict): Seconds and frames per second of every stage, the peak memory, and the
+        corner errors versus the ground truth.
+    """
+    K = np.array(ground_truth["K"])
+    D = np.zeros(5) if ground_truth["D"] is None else np.array(ground_truth["D"])
+    tag_size = ground_truth["tag_size"]
+    detector_settings = dict(tag_standard=ground_truth["family"],
+                             K=K, D=D, fx=K[0, 0], fy=K[1, 1], cx=K[0, 2], cy=K[1, 2],
+                             tag_size=tag_size,
+                             quad_decimate=quad_decimate,
+                             undistort_mode=undistort_mode,
+                             refine_corners=refine_corners)
+    stages = {}
+
+    def measure(name, start, frames):
+        seconds = time.perf_counter() - start
+        stages[name] = {"seconds": seconds, "fps": frames / seconds if seconds > 0 else float("inf")}
+
+    start = time.perf_counter()
+    n_frames = sum(1 for _ in iter_frames(video_path, stride=stride))
+    measure("decode", start, n_frames)
+
+    start = time.perf_counter()
+    detected_tags = DetectionStore()
+    for frame_index, tag_collection in detect_tags_in_video(video_path=video_path,
+                                                            detector_settings=detector_settings,
+                                                            workers=workers,
+                                                            stride=stride,
+                                                            tracking=tracking,
+                                                            selection=selection,
+                                                            transport=transport):
+        detected_tags.add_frame(frame_index=frame_index, detected_tags=tag_collection)
+    len(detected_tags) # consolidates the store, part of the stage
+    measure("decode + detect", start, n_frames)
+
+    start = time.perf_counter()
+    tag_graph = TagGraph()
+    for frame_index, tag_collection in detected_tags.frames():
+        tag_graph.add_frame(detected_tags=tag_collection, frame_index=frame_index)
+    measure("graph build", start, n_frames)
+
+    start = time.perf_counter()
+    parents, _ = tag_graph.shortest_path_tree(origin_tag)
+    measure("path search", start, n_frames)
+
+    edge_transforms = None
+    if fuse_edges:
+        start = time.perf_counter()
+        tree_edges = [(tag, parent) for tag, (parent, _) in parents.items() if parent is not None]
+        edge_transforms, _ = fuse_edge_transforms(tag_collection=detected_tags,
+                                                  tag_graph=tag_graph,
+                                                  pairs=tree_edges)
+        measure("fusion", start, n_frames)
+
+    start = time.perf_counter()
+    tag_ids, transforms = calculate_tag_transforms(tag_collection=detected_tags,
+                                                   parents=parents,
+                                                   origin_tag=origin_tag,
+                                                   edge_transforms=edge_transforms)
+    measure("geometry", start, n_frames)
+
+    if optimize_map:
+        start = time.perf_counter()
+        tag_ids, transforms, _ = optimize_tag_poses(detection_store=detected_tags,
+                                                    tag_ids=tag_ids,
+                                                    transforms=transforms,
+                                                    K=K,
+                                                    tag_size=tag_size)
+        measure("optimization", start, n_frames)
+
+    total = sum(stage["seconds"] for name, stage in stages.items() if name != "decode")
+    errors = get_corner_errors(tag_ids, transforms, ground_truth, origin_tag)
+    error_values = np.array(list(errors.values()))
+    own_memory, worker_memory = get_peak_memory_mb()
+    return {"frames": n_frames,
+            "detections": len(detected_tags),
+            "stages": stages,
+            "total_seconds": total,
+            "total_fps": n_frames / total,
+            "peak_memory_mb": own_memory,
+            "peak_worker_memory_mb": worker_memory,
+            "tags_mapped": len(errors),
+            "tags_in_scene": len(ground_truth["tags"]),
+            "corner_error_mm": {"mean": float(error_values.mean()),
+                                "median": float(np.median(error_values)),
+                                "p95": float(np.percentile(error_values, 95)),
+                                "max": float(error_values.max())},
+            "corner_errors_mm": errors}
+
+def print_report(report):
+    print(f".. {report['frames']} frames, {report['detections']} detections")
+    for name, stage in report["stages"].items():
+        print(f".... {name:<16} {stage['seconds']:8.3f} s {stage['fps']:10.1f} frames/s")
+    print(f".... {'total':<16} {report['total_seconds']:8.3f} s {report['total_fps']:10.1f} frames/s")
+    print(f".. peak memory {report['peak_memory_mb']:.0f} MB, workers {report['peak_worker_memory_mb']:.0f} MB")
+    error = report["corner_error_mm"]
+    print(f".. {report['tags_mapped']}/{report['tags_in_scene']} tags mapped, corner error "
+          f"mean {error['mean']:.2f} mm, median {error['median']:.2f} mm, "
+          f"p95 {error['p95']:.2f} mm, max {error['max']:.2f} mm")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark speed and accuracy on a synthetic video.")
+    parser.add_argument("--video", default=None, help="existing synthetic video, its .json is the ground truth")
+    parser.add_argument("--output-dir", default=None, help="where to render the video, default is a temporary directory")
+    parser.add_argument("--calibration", default="data/cam.json")
+    parser.add_argument("--family", default="tagStandard52h13")
+    parser.add_argument("--tags", type=int, default=30)
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--width", type=int, default=None)
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--no-distortion", action="store_true")
+    parser.add_argument("--blur", type=float, default=0.0)
+    parser.add_argument("--motion-blur", type=int, default=0)
+    parser.add_argument("--noise", type=float, default=2.0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--stride", type=int, default=1)
+    parser.add_argument("--quad-decimate", type=float, default=2.0)
+    parser.add_argument("--undistort-mode", default="image", help="image, remap or points")
+    parser.add_argument("--refine-corners", action="store_true")
+    parser.add_argument("--tracking", action="store_true")
+    parser.add_argument("--selection", action="store_true")
+    parser.add_argument("--fuse-edges", action="store_true")
+    parser.add_argument("--transport", default="chunks", help="chunks or shared_memory")
+    parser.add_argument("--optimize", action="store_true")
+    parser.add_argument("--json", default=None, help="write the report to this file")
+    args = parser.parse_args()
+
+    video_path = args.video
+    if video_path is None:
+        output_dir = args.output_dir or tempfile.mkdtemp(prefix="apriltag_benchmark_")
+        video_path = os.path.join(output_dir, "synthetic.mp4")
+        start = time.perf_counter()
+        make_synthetic_video(video_path=video_path,
+                             calibration_path=args.calibration,
+                             family=args.family,
+                             n_tags=args.tags,
+                             n_frames=args.frames,
+                             image_size=(args.width, args.height) if args.width and args.height else None,
+                             distortion=not args.no_distortion,
+                             blur_sigma=args.blur,
+                             motion_blur=args.motion_blur,
+                             noise_sigma=args.noise)
+        print(f".. rendered {video_path} in {time.perf_counter() - start:.1f} s")
+    ground_truth = load_ground_truth(os.path.splitext(video_path)[0] + ".json")
+
+    report = run_benchmark(video_path=video_path,
+                           ground_truth=ground_truth,
+                           workers=args.workers,
+                           stride=args.stride,
+                           quad_decimate=args.quad_decimate,
+                           undistort_mode=args.undistort_mode,
+                           refine_corners=args.refine_corners,
+                           tracking={} if args.tracking else None,
+                           selection={} if args.selection else None,
+                           fuse_edges=args.fuse_edges,
+                           optimize_map=args.optimize,
+                           transport=args.transport)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(report, file, indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+# tests/checks.py
+#
+# Assertion checks on a small synthetic video: the frame reader, the detection paths, the
+# detection store and the mapping back-ends must agree with each other and with the ground truth.
+# Exits with 1 if a check fails.
+#
+# Usage: python -m tests.checks --family tagStandard52h13
+
+import argparse
+import os
+import sys
+import tempfile
+import traceback
+
+import cv2
+import numpy as np
+
+from src.utils import load_calibration_data, get_D_and_K_from_calibration, iter_frames
+from src.pipeline import detect_tags_in_video
+from src.detection_store import DetectionStore
+from src.tag_graph import TagGraph
+from src.geometry import calculate_tag_transforms, calculate_all_tag_corners, calculate_tag_corners
+from tests.synthetic_scene import make_synthetic_video, load_ground_truth
+from tests.benchmark import get_corner_errors
+
+# Tolerances of the checks
+MAX_POINTS_MEAN_MM = 0.5 # mean distance of the tag positions of undistort_mode "points" and "image"
+MAX_POINTS_P95_MM = 1.5 # 95th percentile of that distance
+MAX_CORNER_ERROR_MM = 2.0 # mean corner error of the map versus the ground truth
+ORIGIN_TAG = 0
+
+def detect(video_path, detector_settings, **kwargs):
+    """Detects the tags of a video into a DetectionStore, see detect_tags_in_video."""
+    store = DetectionStore()
+    for frame_index, tag_collection in detect_tags_in_video(video_path=video_path,
+                                                            detector_settings=detector_settings,
+                                                            **kwargs):
+        store.add_frame(frame_index=frame_index, detected_tags=tag_collection)
+    return store
+
+def assert_same_detections(store, expected, name):
+    assert len(store) == len(expected), f"{name}: {len(store)} detections, expected {len(expected)}"
+    for field in expected.records.dtype.names:
+        assert np.array_equal(store.records[field], expected.records[field]), f"{name}: {field} differs"
+
+def check_iter_frames(video_path, **_):
+    # The sequential reader yields the same frames as reading every frame
+    capture = cv2.VideoCapture(video_path)
+    frames = []
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+    capture.release()
+    for prefetch in (0, 4):
+        selected = list(iter_frames(video_path, start_frame=5, stop_frame=20, stride=3, prefetch=prefetch))
+        assert [frame_index for frame_index, _ in selected] == list(range(5, 20, 3)), \
+            f"prefetch {prefetch}: frame indexes {[frame_index for frame_index, _ in selected]}"
+        for frame_index, frame in selected:
+            assert np.array_equal(frame, frames[frame_index]), f"prefetch {prefetch}: frame {frame_index} differs"
+
+def check_detection_store(store, **_):
+    # Saving and loading keeps every record, and lookups still work on the memory-mapped copy
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "detections.npy")
+        store.save(path)
+        loaded = DetectionStore.load(path)
+        assert_same_detections(loaded, store, "loaded store")
+        for frame_index, tag_collection in store.frames():
+            for tag in tag_collection:
+                assert np.array_equal(loaded.get_tag(frame_index, tag.tag_id).pose_t, tag.pose_t), \
+                    f"tag {tag.tag_id} in frame {frame_index} differs"
+        del loaded
+
+def check_workers(video_path, detector_settings, store, **_):
+    # Chunked workers detect the same as a single process
+    assert_same_detections(detect(video_path, detector_settings, workers=3), store, "3 workers")
+
+def check_shared_memory(video_path, detector_settings, store, **_):
+    # The shared memory frame ring detects the same as the chunked workers
+    assert_same_detections(detect(video_path, detector_settings, workers=2, transport="shared_memory"),
+                           store, "shared_memory")
+
+def check_undistort_modes(video_path, detector_settings, store, **_):
+    # "remap" undistorts like "image", "points" finds about the same poses
+    remap = detect(video_path, {**detector_settings, "undistort_mode": "remap"}, workers=2)
+    assert_same_detections(remap, store, "remap")
+
+    points = detect(video_path, {**detector_settings, "undistort_mode": "points"}, workers=2)
+    rows = points.rows(store.records["frame_index"], store.records["tag_id"])
+    found = rows >= 0
+    assert found.mean() > 0.95, f"points found {found.mean():.1%} of the detections of image"
+    distances = np.linalg.norm(points.records["pose_t"][rows[found]] - store.records["pose_t"][found],
+                               axis=-1).ravel() * 1000
+    mean, p95 = distances.mean(), np.percentile(distances, 95)
+    assert mean <= MAX_POINTS_MEAN_MM and p95 <= MAX_POINTS_P95_MM, \
+        f"points differs from image by {mean:.2f} mm mean, {p95:.2f} mm p95"
+
+def check_online_mapping(store, **_):
+    # The incremental map ends up equal to the shortest path tree of all frames
+    batch_graph = TagGraph()
+    online_graph = TagGraph(origin_tag=ORIGIN_TAG)
+    for frame_index, tag_collection in store.frames():
+        batch_graph.add_frame(detected_tags=tag_collection, frame_index=frame_index)
+        online_graph.add_frame(detected_tags=tag_collection, frame_index=frame_index)
+    parents, _ = batch_graph.shortest_path_tree(ORIGIN_TAG)
+    tag_ids, transforms = calculate_tag_transforms(store, parents, ORIGIN_TAG)
+    online_ids, online_transforms = online_graph.get_tag_transforms()
+    assert sorted(online_ids.tolist()) == sorted(tag_ids.tolist()), "online mapping has other tags"
+    order = np.argsort(online_ids)[np.searchsorted(np.sort(online_ids), tag_ids)]
+    assert np.allclose(online_transforms[order], transforms, atol=1e-9), "online transforms differ"
+
+def check_legacy_geometry(store, **_):
+    # The per-path functions give the corners of the batched tree
+    graph = TagGraph()
+    for frame_index, tag_collection in store.frames():
+        graph.add_frame(detected_tags=tag_collection, frame_index=frame_index)
+    parents, _ = graph.shortest_path_tree(ORIGIN_TAG)
+    corners = {tag["id"]: tag["corners"] for tag in calculate_all_tag_corners(store, parents, ORIGIN_TAG)}
+    for tag_id, path in graph.get_paths_to_origin(ORIGIN_TAG).items():
+        tag = calculate_tag_corners(store, path)[0]
+        assert np.allclose(tag["corners"], corners[tag_id], atol=0.11), f"tag {tag_id} differs"
+
+def check_accuracy(store, ground_truth, **_):
+    # The map of the default settings matches the ground truth
+    graph = TagGraph()
+    for frame_index, tag_collection in store.frames():
+        graph.add_frame(detected_tags=tag_collection, frame_index=frame_index)
+    parents, _ = graph.shortest_path_tree(ORIGIN_TAG)
+    tag_ids, transforms = calculate_tag_transforms(store, parents, ORIGIN_TAG)
+    errors = get_corner_errors(tag_ids, transforms, ground_truth, ORIGIN_TAG)
+    assert len(errors) == len(ground_truth["tags"]), f"{len(errors)}/{len(ground_truth['tags'])} tags mapped"
+    mean = float(np.mean(list(errors.values())))
+    assert mean <= MAX_CORNER_ERROR_MM, f"corner error {mean:.2f} mm"
+
+CHECKS = [check_iter_frames, check_detection_store, check_workers, check_shared_memory,
+          check_undistort_modes, check_online_mapping, check_legacy_geometry, check_accuracy]
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the pipeline on a small synthetic video.")
+    parser.add_argument("--calibration", default="data/cam.json")
+    parser.add_argument("--family", default="tagStandard52h13")
+    parser.add_argument("--tags", type=int, default=20)
+    parser.add_argument("--frames", type=int, default=40)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="apriltag_checks_") as directory:
+        video_path = os.path.join(directory, "synthetic.mp4")
+        ground_truth_path = make_synthetic_video(video_path=video_path,
+                                                 calibration_path=args.calibration,
+                                                 family=args.family,
+                                                 n_tags=args.tags,
+                                                 n_frames=args.frames,
+                                                 noise_sigma=2.0)
+        ground_truth = load_ground_truth(ground_truth_path)
+        K, D, fx, fy, cx, cy = get_D_and_K_from_calibration(load_calibration_data(args.calibration))
+        # The settings of main.py
+        detector_settings = dict(tag_standard=args.family,
+                                 K=K, D=D, fx=fx, fy=fy, cx=cx, cy=cy,
+                                 tag_size=ground_truth["tag_size"],
+                                 undistort_mode="image")
+        store = detect(video_path, detector_settings, workers=1)
+        print(f".. {len(store)} detections in {args.frames} frames")
+
+        failed = 0
+        for check in CHECKS:
+            try:
+                check(video_path=video_path, detector_settings=detector_settings, store=store,
+                      ground_truth=ground_truth)
+                print(f".... {check.__name__:<24} ok")
+            except Exception:
+                failed += 1
+                print(f".... {check.__name__:<24} FAILED\n{traceback.format_exc()}")
+    print(f".. {len(CHECKS) - failed}/{len(CHECKS)} checks passed")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
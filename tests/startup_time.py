@@ -0,0 +1,93 @@
+# tests/startup_time.py
+#
+# Measures how long a fresh run takes until the first frame is detected and checks it against a budget.
+#
+# Usage: python -m tests.startup_time --runs 5 --budget 1.5 --video data/plantage_shed.mp4
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# Must not be imported on the headless map building path
+HEAVY_MODULES = ("plotly", "scipy", "matplotlib")
+
+# Runs in a fresh interpreter, prints the seconds of every phase as JSON
+PHASES_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import main
+from src.utils import load_calibration_data, get_D_and_K_from_calibration, iter_frames
+from src.april_tag import AprilTagDetector
+phases = {"import": time.perf_counter() - start}
+heavy = sorted(name for name in sys.modules if name.split(".")[0] in HEAVY_MODULES)
+
+start = time.perf_counter()
+K, D, fx, fy, cx, cy = get_D_and_K_from_calibration(load_calibration_data(CALIBRATION))
+phases["calibration"] = time.perf_counter() - start
+
+start = time.perf_counter()
+detector = AprilTagDetector(tag_standard=FAMILY, K=K, D=D, fx=fx, fy=fy, cx=cx, cy=cy, tag_size=0.042)
+phases["detector"] = time.perf_counter() - start
+
+if VIDEO:
+    start = time.perf_counter()
+    frame_index, frame = next(iter(iter_frames(VIDEO)))
+    detector.detect(frame)
+    phases["first frame"] = time.perf_counter() - start
+print(json.dumps({"phases": phases, "heavy_modules": heavy}))
+"""
+
+def measure_startup(calibration_path="data/cam.json", family="tagStandard52h13", video_path=None):
+    """
+    Runs the startup phases in a fresh interpreter.
+
+    Returns:
+    - seconds (dict): Seconds of every phase, "total" is the wall time of the whole process
+        including the interpreter start.
+    - heavy_modules (list): Modules of HEAVY_MODULES that were imported by the imports of main.py.
+    """
+    script = (f"HEAVY_MODULES = {HEAVY_MODULES!r}\nCALIBRATION = {calibration_path!r}\n"
+              f"FAMILY = {family!r}\nVIDEO = {video_path!r}\n" + PHASES_SCRIPT)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            env={**os.environ, "HEADLESS": "1"}).stdout
+    total = time.perf_counter() - start
+    result = json.loads(output.strip().splitlines()[-1])
+    return {**result["phases"], "total": total}, result["heavy_modules"]
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of a headless run.")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=1.5, help="seconds until the first frame is detected")
+    parser.add_argument("--calibration", default="data/cam.json")
+    parser.add_argument("--family", default="tagStandard52h13")
+    parser.add_argument("--video", default=None, help="also decode and detect the first frame of this video")
+    args = parser.parse_args()
+
+    runs = []
+    for _ in range(args.runs):
+        seconds, heavy_modules = measure_startup(args.calibration, args.family, args.video)
+        runs.append(seconds)
+    for phase in runs[0]:
+        values = np.array([run[phase] for run in runs])
+        print(f".... {phase:<12} median {np.median(values):6.3f}s max {values.max():6.3f}s")
+
+    total = float(np.median([run["total"] for run in runs]))
+    failed = False
+    if heavy_modules:
+        print(f".. heavy modules imported at startup: {', '.join(heavy_modules)}")
+        failed = True
+    if total > args.budget:
+        print(f".. startup {total:.3f}s is over the budget of {args.budget:.3f}s")
+        failed = True
+    else:
+        print(f".. startup {total:.3f}s is within the budget of {args.budget:.3f}s")
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
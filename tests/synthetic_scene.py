@@ -0,0 +1,380 @@
+# tests/synthetic_scene.py
+#
+# Renders videos of AprilTags at known 3D poses, with the ground truth to check results against.
+#
+# Usage: python -m tests.synthetic_scene --output data/synthetic.mp4 --frames 300
+
+import argparse
+import json
+import os
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from moms_apriltag import TagGenerator2, TagGenerator3
+
+from src.utils import load_calibration_data, get_D_and_K_from_calibration
+from src.geometry import invert_transforms, transform_tag_corners
+
+# Width in cells of the square the detector finds, for the families with data bits outside of it
+BORDER_WIDTHS = {"tagStandard41h12": 5, "tagStandard52h13": 6, "tagCircle21h7": 5, "tagCircle49h12": 5,
+                 "tagCustom48h12": 6}
+
+@lru_cache(maxsize=None)
+def _get_generator(family):
+    # Building a generator loads the whole family
+    if family in BORDER_WIDTHS:
+        return TagGenerator3(name=family)
+    return TagGenerator2(family)
+
+def get_tag_pattern(family, tag_id):
+    """
+    Returns the cells of a tag, surrounded by a one cell wide white quiet zone.
+
+    Args:
+    - family (str): The tag family, e.g. "tagStandard52h13".
+    - tag_id (int): The tag ID.
+
+    Returns:
+    - pattern (numpy array): Square uint8 image with one pixel per cell, 0 is black and 255 white.
+    - border_width (int): Width in cells of the square the detector finds, centered in the pattern.
+    """
+    generator = _get_generator(family)
+    if family in BORDER_WIDTHS:
+        pattern = generator.generate(tag_id=tag_id)
+        border_width = BORDER_WIDTHS[family]
+    else:
+        pattern = generator.generate(tag_id)
+        border_width = pattern.shape[0]
+    pattern = np.pad(np.asarray(pattern, dtype=np.uint8), 1, constant_values=255)
+    return pattern, border_width
+
+def make_scene(tag_ids, tag_size=0.042, spacing=0.12, columns=10, rotation_jitter=np.radians(10),
+               depth_jitter=0.02, seed=0):
+    """
+    Places tags on a grid on a wall, each slightly rotated and offset from the wall.
+
+    The world frame is the frame of an unrotated tag on the wall: x right, y down, z into the wall.
+
+    Args:
+    - tag_ids (list): The tag IDs, placed row by row.
+    - tag_size (float): The size of the tags (length of a side) in meters. Default is 0.042.
+    - spacing (float): Distance between the tag centers in meters. Default is 0.12.
+    - columns (int): Number of tags per row. Default is 10.
+    - rotation_jitter (float): Standard deviation of the tag rotations in radians. Default is 10 degrees.
+    - depth_jitter (float): Standard deviation of the offsets from the wall in meters. Default is 0.02.
+    - seed (int): Seed of the random poses. Default is 0.
+
+    Returns:
+    - scene (dict): tag ID -> 4x4 transform from tag to world coordinates.
+    """
+    rng = np.random.default_rng(seed)
+    scene = {}
+    for i, tag_id in enumerate(tag_ids):
+        transform = np.eye(4)
+        rotation_vector = rng.normal(scale=rotation_jitter, size=3)
+        transform[:3, :3], _ = cv2.Rodrigues(rotation_vector)
+        transform[:3, 3] = [(i % columns) * spacing, (i // columns) * spacing, rng.normal(scale=depth_jitter)]
+        scene[int(tag_id)] = transform
+    return scene
+
+def look_at(position, target):
+    """
+    Returns the 4x4 transform from camera to world coordinates of a camera at position looking at
+    target, with the camera y axis (down in the image) pointing along the world y axis.
+    """
+    position = np.asarray(position, dtype=np.float64)
+    z_axis = np.asarray(target, dtype=np.float64) - position
+    z_axis /= np.linalg.norm(z_axis)
+    x_axis = np.cross([0.0, 1.0, 0.0], z_axis)
+    x_axis /= np.linalg.norm(x_axis)
+    y_axis = np.cross(z_axis, x_axis)
+    transform = np.eye(4)
+    transform[:3, :3] = np.column_stack([x_axis, y_axis, z_axis])
+    transform[:3, 3] = position
+    return transform
+
+def make_trajectory(scene, n_frames, distance=0.4, wobble=0.05, lead=0.1):
+    """
+    Moves the camera along the wall, from the first to the last column of tags and back.
+
+    Args:
+    - scene (dict): tag ID -> 4x4 transform from tag to world coordinates, see make_scene.
+    - n_frames (int): Number of camera poses.
+    - distance (float): Distance of the camera to the wall in meters. Default is 0.4.
+    - wobble (float): Amplitude of the up and down and back and forth motion in meters. Default is 0.05.
+    - lead (float): How far ahead along the wall the camera looks in meters. Default is 0.1.
+
+    Returns:
+    - camera_poses (numpy array): n_frames x4x4 transforms from camera to world coordinates.
+    """
+    positions = np.array([transform[:3, 3] for transform in scene.values()])
+    low, high = positions.min(axis=0), positions.max(axis=0)
+    center_y = (low[1] + high[1]) / 2
+
+    # There and back again, so the start and the end of the video overlap
+    phases = np.linspace(0, 2 * np.pi, n_frames, endpoint=False)
+    x = low[0] + (high[0] - low[0]) * (1 - np.cos(phases)) / 2
+    direction = np.sign(np.sin(phases) + 1e-9)
+    camera_poses = []
+    for phase, camera_x, camera_direction in zip(phases, x, direction):
+        position = [camera_x, center_y + wobble * np.sin(3 * phase), -distance + wobble * np.sin(5 * phase)]
+        target = [camera_x + camera_direction * lead, center_y, 0.0]
+        camera_poses.append(look_at(position, target))
+    return np.array(camera_poses)
+
+class SceneRenderer:
+    """
+    Renders the tags of a scene as seen by a calibrated camera.
+
+    The tags are drawn with homographies on a supersampled pinhole image, which is shrunk to the
+    image size and then distorted with the lens model of the calibration.
+
+    Args:
+    - scene (dict): tag ID -> 4x4 transform from tag to world coordinates, see make_scene.
+    - family (str): The tag family.
+    - tag_size (float): The size of the tags (length of a side) in meters.
+    - K (numpy array): The 3x3 camera matrix.
+    - D (numpy array): The distortion coefficients, None for a pinhole camera.
+    - image_size (tuple): (width, height) of the frames.
+    - supersample (int): Render at this multiple of the resolution for anti-aliasing. Default is 2.
+    - cell_pixels (int): Pixels per tag cell of the textures. Default is 8.
+    - background (int): Gray level of the background. Default is 128.
+    """
+    def __init__(self, scene, family, tag_size, K, D, image_size, supersample=2, cell_pixels=8, background=128):
+        self.scene = scene
+        self.tag_size = tag_size
+        self.K = np.asarray(K, dtype=np.float64)
+        self.D = None if D is None else np.asarray(D, dtype=np.float64)
+        self.image_size = tuple(image_size)
+        self.supersample = supersample
+        self.background = background
+
+        # Pixel centers of the supersampled image are at supersample * x + (supersample - 1) / 2
+        self.K_supersampled = self.K.copy()
+        self.K_supersampled[:2] *= supersample
+        self.K_supersampled[:2, 2] += (supersample - 1) / 2
+
+        # Texture of every tag and the homography from its pixels to the tag plane in meters
+        self.textures = {}
+        for tag_id in scene:
+            pattern, border_width = get_tag_pattern(family, tag_id)
+            texture = cv2.resize(src=pattern, dsize=None, fx=cell_pixels, fy=cell_pixels,
+                                 interpolation=cv2.INTER_NEAREST)
+            meters_per_pixel = tag_size / border_width / cell_pixels
+            offset = 0.5 * meters_per_pixel - texture.shape[0] * meters_per_pixel / 2
+            to_plane = np.array([[meters_per_pixel, 0, offset],
+                                 [0, meters_per_pixel, offset],
+                                 [0, 0, 1]])
+            self.textures[tag_id] = (texture, to_plane)
+
+        self.distortion_maps = None
+        if self.D is not None and np.any(self.D):
+            # For every distorted pixel, where it is in the pinhole image
+            width, height = self.image_size
+            pixels = np.stack(np.meshgrid(np.arange(width), np.arange(height)), axis=-1).astype(np.float64)
+            criteria = (cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS, 40, 1e-8)
+            if hasattr(cv2, "undistortPointsIter"):
+                # OpenCV 4
+                undistorted = cv2.undistortPointsIter(pixels.reshape(-1, 1, 2), self.K, self.D, None, self.K, criteria)
+            else:
+                undistorted = cv2.undistortPoints(src=pixels.reshape(-1, 1, 2), cameraMatrix=self.K,
+                                                  distCoeffs=self.D, P=self.K, criteria=criteria)
+            undistorted = undistorted.reshape(height, width, 2).astype(np.float32)
+            self.distortion_maps = (undistorted[..., 0].copy(), undistorted[..., 1].copy())
+
+    def render(self, camera_pose, blur_sigma=0.0, motion_blur=0, motion_angle=0.0, noise_sigma=0.0, rng=None):
+        """
+        Renders one frame.
+
+        Args:
+        - camera_pose (numpy array): 4x4 transform from camera to world coordinates.
+        - blur_sigma (float): Standard deviation of a Gaussian blur in pixels (defocus). Default is 0.
+        - motion_blur (int): Length of a linear motion blur in pixels. Default is 0.
+        - motion_angle (float): Direction of the motion blur in radians. Default is 0.
+        - noise_sigma (float): Standard deviation of Gaussian sensor noise in gray levels. Default is 0.
+        - rng (numpy Generator): Random generator of the noise.
+
+        Returns:
+        - frame (numpy array): The BGR frame.
+        """
+        width, height = self.image_size
+        canvas_width, canvas_height = width * self.supersample, height * self.supersample
+        canvas = np.full((canvas_height, canvas_width), self.background, dtype=np.uint8)
+
+        world_to_camera = invert_transforms(np.asarray(camera_pose)[None])[0]
+        tags = []
+        for tag_id, tag_to_world in self.scene.items():
+            tag_to_camera = world_to_camera @ tag_to_world
+            rotation, translation = tag_to_camera[:3, :3], tag_to_camera[:3, 3]
+            # Skip tags behind the camera or seen from the back (z points into the tag)
+            if translation[2] < 0.05 or rotation[:, 2] @ translation <= 0:
+                continue
+            tags.append((translation[2], tag_id, rotation, translation))
+
+        # Far tags first, so near tags cover them
+        for _, tag_id, rotation, translation in sorted(tags, key=lambda tag: -tag[0]):
+            texture, to_plane = self.textures[tag_id]
+            homography = self.K_supersampled @ np.column_stack([rotation[:, 0], rotation[:, 1], translation]) @ to_plane
+            size = texture.shape[0]
+            outline = cv2.perspectiveTransform(np.float64([[[0, 0], [size, 0], [size, size], [0, size]]]) - 0.5,
+                                               homography)[0]
+            x0, y0 = np.maximum(np.floor(outline.min(axis=0)).astype(int) - 1, 0)
+            x1, y1 = np.minimum(np.ceil(outline.max(axis=0)).astype(int) + 2, [canvas_width, canvas_height])
+            if x1 <= x0 or y1 <= y0:
+                continue
+            # Only warp the bounding box of the tag
+            shift = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64)
+            region = canvas[y0:y1, x0:x1].copy()
+            cv2.warpPerspective(src=texture, M=shift @ homography, dsize=(x1 - x0, y1 - y0), dst=region,
+                                flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_TRANSPARENT)
+            canvas[y0:y1, x0:x1] = region
+
+        frame = cv2.resize(src=canvas, dsize=(width, height), interpolation=cv2.INTER_AREA)
+        if self.distortion_maps is not None:
+            frame = cv2.remap(src=frame, map1=self.distortion_maps[0], map2=self.distortion_maps[1],
+                              interpolation=cv2.INTER_LINEAR, borderValue=self.background)
+        if blur_sigma > 0:
+            frame = cv2.GaussianBlur(src=frame, ksize=(0, 0), sigmaX=blur_sigma)
+        if motion_blur > 1:
+            kernel = np.zeros((motion_blur, motion_blur), dtype=np.float32)
+            middle = (motion_blur - 1) / 2
+            direction = np.array([np.cos(motion_angle), np.sin(motion_angle)])
+            for step in np.linspace(-middle, middle, 2 * motion_blur):
+                x, y = np.round(middle + step * direction).astype(int)
+                kernel[y, x] = 1
+            frame = cv2.filter2D(src=frame, ddepth=-1, kernel=kernel / kernel.sum())
+        if noise_sigma > 0:
+            rng = np.random.default_rng() if rng is None else rng
+            frame = np.clip(frame + rng.normal(scale=noise_sigma, size=frame.shape), 0, 255).astype(np.uint8)
+        return cv2.cvtColor(src=frame, code=cv2.COLOR_GRAY2BGR)
+
+def render_video(video_path, renderer, camera_poses, fps=30, seed=0, **effects):
+    """
+    Renders a frame for every camera pose into a video file.
+
+    Args:
+    - video_path (str): Path of the video, written as mp4.
+    - renderer (SceneRenderer): The renderer of the scene.
+    - camera_poses (numpy array): Nx4x4 transforms from camera to world coordinates.
+    - fps (float): Frame rate of the video. Default is 30.
+    - seed (int): Seed of the noise. Default is 0.
+    - effects: Keyword arguments for SceneRenderer.render (blur, noise).
+    """
+    directory = os.path.dirname(video_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, renderer.image_size)
+    try:
+        for camera_pose in camera_poses:
+            writer.write(renderer.render(camera_pose, rng=rng, **effects))
+    finally:
+        writer.release()
+
+def save_ground_truth(path, scene, camera_poses, family, tag_size, K, D, image_size):
+    """Saves the poses of the tags and of the camera in every frame as JSON."""
+    ground_truth = {"family": family,
+                    "tag_size": tag_size,
+                    "image_size": list(image_size),
+                    "K": np.asarray(K).tolist(),
+                    "D": None if D is None else np.asarray(D).ravel().tolist(),
+                    "tags": {str(tag_id): transform.tolist() for tag_id, transform in scene.items()},
+                    "camera_poses": np.asarray(camera_poses).tolist()}
+    with open(path, "w") as file:
+        json.dump(ground_truth, file)
+
+def load_ground_truth(path):
+    """Loads ground truth saved with save_ground_truth, the poses as numpy arrays."""
+    with open(path) as file:
+        ground_truth = json.load(file)
+    ground_truth["tags"] = {int(tag_id): np.array(transform) for tag_id, transform in ground_truth["tags"].items()}
+    ground_truth["camera_poses"] = np.array(ground_truth["camera_poses"])
+    return ground_truth
+
+def get_ground_truth_corners(scene, origin_tag, tag_size_mm):
+    """
+    Returns the true tag corners in the frame and format of the results, see make_tag_data.
+
+    Returns:
+    - tag_ids (numpy array): The tag IDs, sorted.
+    - corners (numpy array): Nx4x3 corner positions relative to the origin tag in millimeters.
+    """
+    tag_ids = np.array(sorted(scene))
+    world_to_origin = invert_transforms(scene[origin_tag][None])[0]
+    transforms = world_to_origin @ np.array([scene[tag_id] for tag_id in tag_ids])
+    return tag_ids, transform_tag_corners(transforms, tag_size_mm)
+
+def make_synthetic_video(video_path, calibration_path="data/cam.json", family="tagStandard52h13", n_tags=30,
+                         tag_size=0.042, n_frames=300, image_size=None, distortion=True, seed=0, **effects):
+    """
+    Renders a synthetic video with the intrinsics of a calibration and saves its ground truth next to it.
+
+    Args:
+    - video_path (str): Path of the video, the ground truth is written to the same path with .json.
+    - calibration_path (str): Calibration in the format of data/cam.json. Default is "data/cam.json".
+    - family (str): The tag family. Default is "tagStandard52h13".
+    - n_tags (int): Number of tags, with IDs 0 to n_tags - 1. Default is 30.
+    - tag_size (float): The size of the tags (length of a side) in meters. Default is 0.042.
+    - n_frames (int): Number of frames. Default is 300.
+    - image_size (tuple): (width, height) of the frames. Default is the size of the calibration,
+        the intrinsics are scaled to other sizes.
+    - distortion (bool): Apply the lens distortion of the calibration. Default is True.
+    - seed (int): Seed of the scene and the noise. Default is 0.
+    - effects: Keyword arguments for SceneRenderer.render (blur, noise).
+
+    Returns:
+    - ground_truth_path (str): Path of the ground truth JSON file.
+    """
+    calibration_data = load_calibration_data(calibration_path)
+    K, D, *_ = get_D_and_K_from_calibration(calibration_data)
+    calibration_size = (calibration_data["width"], calibration_data["height"])
+    image_size = calibration_size if image_size is None else tuple(image_size)
+    scale = image_size[0] / calibration_size[0]
+    K = K.copy()
+    K[:2] *= scale
+    D = D if distortion else None
+
+    scene = make_scene(range(n_tags), tag_size=tag_size, seed=seed)
+    camera_poses = make_trajectory(scene, n_frames)
+    renderer = SceneRenderer(scene, family, tag_size, K, D, image_size)
+    render_video(video_path, renderer, camera_poses, seed=seed, **effects)
+
+    ground_truth_path = os.path.splitext(video_path)[0] + ".json"
+    save_ground_truth(ground_truth_path, scene, camera_poses, family, tag_size, K, D, image_size)
+    return ground_truth_path
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a synthetic AprilTag video with ground truth.")
+    parser.add_argument("--output", default="data/synthetic.mp4")
+    parser.add_argument("--calibration", default="data/cam.json")
+    parser.add_argument("--family", default="tagStandard52h13")
+    parser.add_argument("--tags", type=int, default=30)
+    parser.add_argument("--tag-size", type=float, default=0.042)
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--width", type=int, default=None)
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--no-distortion", action="store_true")
+    parser.add_argument("--blur", type=float, default=0.0, help="Gaussian blur sigma in pixels")
+    parser.add_argument("--motion-blur", type=int, default=0, help="motion blur length in pixels")
+    parser.add_argument("--noise", type=float, default=0.0, help="noise sigma in gray levels")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    image_size = (args.width, args.height) if args.width and args.height else None
+    ground_truth_path = make_synthetic_video(video_path=args.output,
+                                             calibration_path=args.calibration,
+                                             family=args.family,
+                                             n_tags=args.tags,
+                                             tag_size=args.tag_size,
+                                             n_frames=args.frames,
+                                             image_size=image_size,
+                                             distortion=not args.no_distortion,
+                                             seed=args.seed,
+                                             blur_sigma=args.blur,
+                                             motion_blur=args.motion_blur,
+                                             noise_sigma=args.noise)
+    print(f".. rendered {args.frames} frames to {args.output}, ground truth in {ground_truth_path}")
+
+if __name__ == "__main__":
+    main()